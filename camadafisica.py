@@ -7,18 +7,43 @@ import termios
 import asyncio
 import traceback
 from collections import defaultdict
+from metricas import registro
+
+
+# Palavra de 32 bits já empacotada para cada valor de byte a transmitir
+_PALAVRAS_TX = [struct.pack('I', b) for b in range(256)]
 
 
 class ZyboSerialDriver:
     """ Driver para o hardware de https://github.com/thotypous/zybo-z7-20-uart """
 
-    def __init__(self, device='/dev/uio/user_io'):
+    def __init__(self, device='/dev/uio/user_io', lote_tx=256, orcamento_rx=1024):
         self.fd = os.open(device, os.O_RDWR)
         fcntl.fcntl(self.fd, fcntl.F_SETFL, os.O_NONBLOCK)
         self.mm = mmap.mmap(self.fd, 0x1000)
-        asyncio.get_event_loop().add_reader(self.fd, self.__irq_handler)
-        self.__irq_unmask()
+        self.registrador_rx = memoryview(self.mm)[0:4].cast('i')  # lê a fila sem criar bytes
         self.callbacks = defaultdict(lambda: lambda _: None)
+        self.lote_tx = lote_tx    # bytes escritos por porta a cada rodada do loop
+        self.filas_tx = {}        # porta -> bytearray com bytes ainda não escritos
+        self.tx_agendado = False
+        self.orcamento_rx = orcamento_rx           # elementos retirados da fila por rodada
+        self.buffers_rx = defaultdict(bytearray)   # reaproveitados entre rodadas
+        # Contadores do caminho de recepção
+        self.irqs = 0
+        self.elementos_rx = 0
+        self.orcamentos_esgotados = 0
+        registro.registrar_coletor(self.__metricas)
+        self.loop = asyncio.get_event_loop()
+        self.loop.add_reader(self.fd, self.__irq_handler)
+        self.__irq_unmask()
+
+    def fechar(self):
+        """ Para de tratar irqs, tira as métricas do registro e libera o dispositivo """
+        self.loop.remove_reader(self.fd)
+        registro.remover_coletor(self.__metricas)
+        self.registrador_rx.release()
+        self.mm.close()
+        os.close(self.fd)
 
     def obter_porta(self, port):
         """ Obtém uma porta para controlar a partir do software em Python """
@@ -32,28 +57,92 @@ class ZyboSerialDriver:
         return pty
 
     def enviar(self, port, data):
+        """
+        Enfileira os dados na fila de transmissão da porta. A escrita no
+        hardware acontece em lotes de até lote_tx bytes por porta, agendados
+        no loop, para que um quadro grande não bloqueie o loop inteiro.
+        """
         #print('send', port, data)
-        for b in data:
-            self.mm[port*4:port*4+4] = struct.pack('I', b)
+        fila = self.filas_tx.get(port)
+        if fila is None:
+            fila = self.filas_tx[port] = bytearray()
+        fila += data
+        if not self.tx_agendado:
+            self.tx_agendado = True
+            self.loop.call_soon(self.__drenar_tx)
+
+    def tamanho_fila_tx(self, port):
+        """ Retorna quantos bytes da porta ainda aguardam escrita no hardware """
+        fila = self.filas_tx.get(port)
+        return len(fila) if fila else 0
+
+    def __drenar_tx(self):
+        self.tx_agendado = False
+        mm = self.mm
+        palavras = _PALAVRAS_TX
+        pendente = False
+        for port, fila in self.filas_tx.items():
+            if not fila:
+                continue
+            lote = fila[:self.lote_tx]
+            ini, fim = port*4, port*4+4
+            for b in lote:
+                mm[ini:fim] = palavras[b]
+            del fila[:len(lote)]   # remover do início de um bytearray é O(1) amortizado
+            if fila:
+                pendente = True
+        if pendente:
+            self.tx_agendado = True
+            self.loop.call_soon(self.__drenar_tx)
 
     def registrar_recebedor(self, port, callback):
         self.callbacks[port] = callback
 
     def __irq_handler(self):
         os.read(self.fd, 4)   # diz ao SO que coletamos a irq
-        buffers = defaultdict(lambda: bytearray())
-        while True:
-            elem, = struct.unpack('i', self.mm[0:4])  # retira da fila do hardware
-            if elem == -1: break                      # fila vazia
-            port, b = elem>>8, elem&0xff
-            buffers[port].append(b)
+        self.irqs += 1
+        self.__drenar_rx()
+
+    def __drenar_rx(self):
+        """
+        Retira no máximo orcamento_rx elementos da fila do hardware. Se o
+        orçamento se esgotar, entrega o que foi lido e agenda outra rodada com
+        call_soon em vez de desmascarar a irq, para que timers e outras portas
+        não fiquem sem vez no loop.
+        """
+        registrador = self.registrador_rx
+        buffers = self.buffers_rx
+        orcamento = self.orcamento_rx
+        n = 0
+        while n < orcamento:
+            elem = registrador[0]          # retira da fila do hardware
+            if elem == -1: break           # fila vazia
+            buffers[elem>>8].append(elem&0xff)
+            n += 1
+        self.elementos_rx += n
         for port, dados in buffers.items():
+            if not dados:
+                continue
             try:
                 #print('recv', port, dados)
                 self.callbacks[port](bytes(dados))
             except:
                 traceback.print_exc()
-        self.__irq_unmask()
+            finally:
+                dados.clear()
+        if n == orcamento:
+            self.orcamentos_esgotados += 1
+            self.loop.call_soon(self.__drenar_rx)
+        else:
+            self.__irq_unmask()
+
+    def __metricas(self):
+        return {
+            'driver.irqs': self.irqs,
+            'driver.elementos_rx': self.elementos_rx,
+            'driver.orcamentos_esgotados': self.orcamentos_esgotados,
+            'driver.fila_tx': sum(len(fila) for fila in self.filas_tx.values()),
+        }
 
     def __irq_unmask(self):
         os.write(self.fd, b'\x01\x00\x00\x00')
@@ -73,6 +162,11 @@ class ZyboSerialPort:
         Envia dados para a linha serial
         """
         self.driver.enviar(self.port, dados)
+    def tamanho_fila_tx(self):
+        """
+        Retorna quantos bytes ainda aguardam transmissão nesta porta
+        """
+        return self.driver.tamanho_fila_tx(self.port)
 
 
 class PTY:
@@ -0,0 +1,92 @@
+import struct
+from functools import lru_cache
+from tcputils import str2addr
+
+
+def soma(dados, inicial=0):
+    """
+    Calcula a soma complemento-de-um (16 bits, ainda não invertida) dos dados
+    fornecidos, que podem ser bytes, bytearray ou memoryview (sem cópia).
+
+    Como 2**16 deixa resto 1 na divisão por 0xFFFF, somar as palavras de 16
+    bits com "vai-um" circular equivale a tomar o buffer inteiro como um
+    único inteiro e calcular o resto por 0xFFFF, o que é feito em C.
+
+    Somas parciais podem ser combinadas passando uma delas em `inicial`
+    ou com combinar(). Todas as partes, exceto a última, devem ter
+    tamanho par (como o pseudocabeçalho e o cabeçalho TCP).
+    """
+    n = int.from_bytes(dados, 'big')
+    if len(dados) % 2 == 1:
+        # se for ímpar, faz padding à direita
+        n <<= 8
+    return combinar(inicial, n)
+
+
+def combinar(*somas):
+    """
+    Combina somas parciais calculadas por soma().
+    """
+    total = sum(somas)
+    resto = total % 0xFFFF
+    if resto == 0 and total != 0:
+        # A soma complemento-de-um de dados não nulos nunca é 0, e sim 0xFFFF
+        return 0xFFFF
+    return resto
+
+
+@lru_cache(maxsize=1024)
+def _soma_enderecos(src_addr, dst_addr):
+    return soma(str2addr(src_addr) + str2addr(dst_addr))
+
+
+def soma_pseudocabecalho(src_addr, dst_addr, comprimento, protocolo=0x0006):
+    """
+    Calcula a soma parcial do pseudocabeçalho TCP/UDP. Os endereços IPv4
+    devem ser passados como string (no formato x.y.z.w).
+    """
+    return combinar(_soma_enderecos(src_addr, dst_addr), protocolo, comprimento)
+
+
+def finalizar(soma_total):
+    """
+    Converte uma soma complemento-de-um no valor do campo de checksum.
+    """
+    return ~soma_total & 0xffff
+
+
+def calc_checksum(segment, src_addr=None, dst_addr=None):
+    """
+    Mesma interface e resultado de tcputils.calc_checksum, mas somando o
+    buffer inteiro de uma vez.
+    """
+    if src_addr is None and dst_addr is None:
+        return finalizar(soma(segment))
+    return finalizar(soma(segment, soma_pseudocabecalho(src_addr, dst_addr, len(segment))))
+
+
+def fix_checksum(segment, src_addr, dst_addr):
+    """
+    Corrige o checksum de um segmento TCP, somando por fora o campo antigo
+    de checksum em vez de zerá-lo em uma cópia.
+    """
+    visao = memoryview(segment)
+    total = soma(visao[18:], soma(visao[:16], soma_pseudocabecalho(
+        src_addr, dst_addr, len(segment))))
+    return b''.join((visao[:16], struct.pack('!H', finalizar(total)), visao[18:]))
+
+
+def montar_segmento(header, payload, src_addr, dst_addr, soma_payload=None):
+    """
+    Monta cabeçalho + payload com o checksum correto, somando o cabeçalho e
+    o payload separadamente. O campo de checksum do cabeçalho deve estar zerado.
+
+    Se a soma do payload já for conhecida (soma(payload)), pode ser passada
+    em soma_payload para não percorrer o payload de novo.
+    """
+    parcial = soma(header, soma_pseudocabecalho(src_addr, dst_addr, len(header) + len(payload)))
+    if soma_payload is None:
+        total = soma(payload, parcial)
+    else:
+        total = combinar(parcial, soma_payload)
+    return b''.join((header[:16], struct.pack('!H', finalizar(total)), header[18:], payload))
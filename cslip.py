@@ -0,0 +1,296 @@
+"""
+Compressão de cabeçalhos TCP/IP de Van Jacobson (CSLIP, RFC 1144), no
+mesmo formato do slhc do Linux, para interoperar com slattach -p cslip.
+
+Cada ponta guarda, por conexão TCP, o último cabeçalho IP+TCP enviado ou
+recebido, em até MAX_ESTADOS posições. Um segmento TCP que só tem ACK
+ligado e cujos campos mudaram pouco em relação ao anterior da mesma
+conexão vai comprimido: um byte dizendo o que mudou, o checksum TCP e as
+diferenças (seq, ack, janela, identificação IP), normalmente de 3 a 7
+bytes no lugar de 40. Os demais vão inteiros, como TCP não comprimido
+(que também atualiza a posição da conexão do outro lado) ou como IP.
+
+O tipo do quadro está no primeiro byte: 0x4X para IP, 0x7X para TCP não
+comprimido (o byte de protocolo do cabeçalho IP leva o número da
+posição) e 0x80 ligado para TCP comprimido.
+"""
+import struct
+from checksum import calc_checksum
+
+TIPO_IP = 0x40
+TIPO_TCP_NAO_COMPRIMIDO = 0x70
+TIPO_TCP_COMPRIMIDO = 0x80
+
+# Bits do byte de mudanças de um quadro comprimido
+NOVO_C = 0x40   # número da posição (conexão) presente
+NOVO_I = 0x20   # identificação IP não é a anterior + 1
+PUSH = 0x10     # flag PSH do TCP
+NOVO_S = 0x08
+NOVO_A = 0x04
+NOVO_W = 0x02
+NOVO_U = 0x01
+# Combinações impossíveis de S, A, W e U, usadas para casos frequentes
+ESPECIAIS = NOVO_S | NOVO_A | NOVO_W | NOVO_U
+ESPECIAL_I = NOVO_S | NOVO_W | NOVO_U           # seq e ack avançaram o tamanho dos dados anteriores
+ESPECIAL_D = NOVO_S | NOVO_A | NOVO_W | NOVO_U  # seq avançou o tamanho dos dados anteriores
+
+# Conexões lembradas por padrão, como no Linux. O número da posição ocupa
+# um byte, então o máximo possível é 256
+MAX_ESTADOS = 16
+
+_TCP_FIN = 0x01
+_TCP_SYN = 0x02
+_TCP_RST = 0x04
+_TCP_PSH = 0x08
+_TCP_ACK = 0x10
+_TCP_URG = 0x20
+
+_PALAVRA = struct.Struct('!H')
+_SEQ_ACK = struct.Struct('!II')
+
+
+def _codificar(n, saida):
+    # Diferença de 1 a 255 em um byte; 0 e as demais em três (0, alto, baixo)
+    if 0 < n < 256:
+        saida.append(n)
+    else:
+        saida += bytes((0, n >> 8, n & 0xff))
+
+
+def _decodificar(quadro, i):
+    if quadro[i]:
+        return quadro[i], i + 1
+    return (quadro[i + 1] << 8) | quadro[i + 2], i + 3
+
+
+class Compressor:
+    def __init__(self, n_estados=MAX_ESTADOS):
+        self.cabecalhos = [None] * n_estados   # posição -> último cabeçalho enviado
+        self.chaves = [None] * n_estados       # posição -> endereços e portas
+        self.posicoes = {}                     # endereços e portas -> posição
+        self.uso = list(range(n_estados))      # da menos para a mais recentemente usada
+        self.ultima = None                     # posição do último quadro TCP enviado
+
+    def comprimir(self, datagrama):
+        """
+        Retorna o quadro a transmitir no lugar do datagrama: o próprio
+        datagrama, se não for comprimível.
+        """
+        if len(datagrama) < 40 or datagrama[9] != 6 or datagrama[6] & 0x3f or datagrama[7]:
+            return datagrama    # não é TCP, é curto demais ou é fragmento
+        ihl = 4 * (datagrama[0] & 0xf)
+        hlen = ihl + 4 * (datagrama[ihl + 12] >> 4)
+        flags = datagrama[ihl + 13]
+        if flags & (_TCP_SYN | _TCP_FIN | _TCP_RST | _TCP_ACK) != _TCP_ACK or len(datagrama) < hlen:
+            return datagrama
+
+        chave = bytes(datagrama[12:20]) + datagrama[ihl:ihl+4]
+        posicao = self.posicoes.get(chave)
+        if posicao is None:
+            # Conexão nova: reaproveita a posição usada há mais tempo
+            posicao = self.uso[0]
+            if self.chaves[posicao] is not None:
+                del self.posicoes[self.chaves[posicao]]
+            self.chaves[posicao] = chave
+            self.posicoes[chave] = posicao
+            self.cabecalhos[posicao] = None
+        self.uso.remove(posicao)
+        self.uso.append(posicao)
+
+        anterior = self.cabecalhos[posicao]
+        if anterior is None or len(anterior) != hlen \
+                or datagrama[0:2] != anterior[0:2] \
+                or datagrama[6:10] != anterior[6:10] \
+                or datagrama[20:ihl] != anterior[20:ihl] \
+                or datagrama[ihl+20:hlen] != anterior[ihl+20:hlen] \
+                or (flags ^ anterior[ihl + 13]) & _TCP_URG:
+            # Versão, TOS, fragmentação, TTL, opções ou a flag URG mudaram
+            # (as codificações especiais não desligariam a URG)
+            return self._nao_comprimido(datagrama, posicao, hlen)
+
+        deltas = bytearray()
+        mudancas = 0
+        if flags & _TCP_URG:
+            _codificar(_PALAVRA.unpack_from(datagrama, ihl + 18)[0], deltas)
+            mudancas |= NOVO_U
+        elif datagrama[ihl+18:ihl+20] != anterior[ihl+18:ihl+20]:
+            return self._nao_comprimido(datagrama, posicao, hlen)
+
+        delta_w = (_PALAVRA.unpack_from(datagrama, ihl + 14)[0] -
+                   _PALAVRA.unpack_from(anterior, ihl + 14)[0]) & 0xffff
+        if delta_w:
+            _codificar(delta_w, deltas)
+            mudancas |= NOVO_W
+
+        seq, ack = _SEQ_ACK.unpack_from(datagrama, ihl + 4)
+        seq_anterior, ack_anterior = _SEQ_ACK.unpack_from(anterior, ihl + 4)
+        delta_a = (ack - ack_anterior) & 0xffffffff
+        if delta_a:
+            if delta_a > 0xffff:
+                return self._nao_comprimido(datagrama, posicao, hlen)
+            _codificar(delta_a, deltas)
+            mudancas |= NOVO_A
+        delta_s = (seq - seq_anterior) & 0xffffffff
+        if delta_s:
+            if delta_s > 0xffff:
+                return self._nao_comprimido(datagrama, posicao, hlen)
+            _codificar(delta_s, deltas)
+            mudancas |= NOVO_S
+
+        total = _PALAVRA.unpack_from(datagrama, 2)[0]
+        total_anterior = _PALAVRA.unpack_from(anterior, 2)[0]
+        if mudancas == 0:
+            # Nada mudou: só comprime se for o primeiro dado depois de um ACK
+            # puro. Senão é uma retransmissão (ou ACK repetido), que vai
+            # inteira, caso o outro lado tenha perdido a versão comprimida
+            if total == total_anterior or total_anterior != hlen:
+                return self._nao_comprimido(datagrama, posicao, hlen)
+        elif mudancas in (ESPECIAL_I, ESPECIAL_D):
+            # Coincidem com as codificações especiais
+            return self._nao_comprimido(datagrama, posicao, hlen)
+        elif mudancas == NOVO_S | NOVO_A:
+            if delta_s == delta_a == total_anterior - hlen:
+                mudancas = ESPECIAL_I
+                deltas.clear()
+        elif mudancas == NOVO_S:
+            if delta_s == total_anterior - hlen:
+                mudancas = ESPECIAL_D
+                deltas.clear()
+
+        delta_i = (_PALAVRA.unpack_from(datagrama, 4)[0] - _PALAVRA.unpack_from(anterior, 4)[0]) & 0xffff
+        if delta_i != 1:
+            _codificar(delta_i, deltas)
+            mudancas |= NOVO_I
+        if flags & _TCP_PSH:
+            mudancas |= PUSH
+
+        self.cabecalhos[posicao] = bytes(datagrama[:hlen])
+        if self.ultima == posicao:
+            inicio = bytes((TIPO_TCP_COMPRIMIDO | mudancas,))
+        else:
+            self.ultima = posicao
+            inicio = bytes((TIPO_TCP_COMPRIMIDO | NOVO_C | mudancas, posicao))
+        return b''.join((inicio, datagrama[ihl+16:ihl+18], deltas, datagrama[hlen:total]))
+
+    def _nao_comprimido(self, datagrama, posicao, hlen):
+        self.cabecalhos[posicao] = bytes(datagrama[:hlen])
+        self.ultima = posicao
+        quadro = bytearray(datagrama)
+        quadro[0] |= TIPO_TCP_NAO_COMPRIMIDO
+        quadro[9] = posicao
+        return quadro
+
+
+class Descompressor:
+    def __init__(self, n_estados=MAX_ESTADOS):
+        self.cabecalhos = [None] * n_estados   # posição -> último cabeçalho recebido
+        self.ultima = None
+        # Depois de um quadro com erro, não se sabe a que conexão os
+        # próximos quadros comprimidos sem NOVO_C pertencem: descarta-os
+        # até chegar um que diga a posição
+        self.descartando = False
+
+    def erro(self):
+        """
+        Avisa que um quadro foi perdido ou recebido com erro.
+        """
+        self.descartando = True
+
+    def descomprimir(self, quadro):
+        """
+        Retorna o datagrama IP reconstruído a partir do quadro, ou None se
+        o quadro deve ser descartado.
+        """
+        if not quadro:
+            return None
+        tipo = quadro[0]
+        if tipo & TIPO_TCP_COMPRIMIDO:
+            try:
+                return self._comprimido(quadro)
+            except IndexError:
+                self.descartando = True
+                return None
+        if tipo < TIPO_TCP_NAO_COMPRIMIDO:
+            return quadro
+
+        datagrama = bytearray(quadro)
+        datagrama[0] &= 0x4f
+        posicao = datagrama[9]
+        ihl = 4 * (datagrama[0] & 0xf)
+        if posicao >= len(self.cabecalhos) or len(datagrama) < ihl + 20 \
+                or len(datagrama) < ihl + 4 * (datagrama[ihl + 12] >> 4):
+            self.descartando = True
+            return None
+        datagrama[9] = 6
+        self.cabecalhos[posicao] = datagrama[:ihl + 4 * (datagrama[ihl + 12] >> 4)]
+        self.ultima = posicao
+        self.descartando = False
+        return bytes(datagrama)
+
+    def _comprimido(self, quadro):
+        mudancas = quadro[0]
+        i = 1
+        if mudancas & NOVO_C:
+            posicao = quadro[1]
+            i = 2
+            if posicao >= len(self.cabecalhos) or self.cabecalhos[posicao] is None:
+                self.descartando = True
+                return None
+            self.ultima = posicao
+            self.descartando = False
+        elif self.descartando or self.ultima is None:
+            return None
+
+        cabecalho = self.cabecalhos[self.ultima]
+        ihl = 4 * (cabecalho[0] & 0xf)
+        hlen = len(cabecalho)
+        checksum_tcp = quadro[i:i+2]
+        if len(checksum_tcp) != 2:
+            raise IndexError
+        i += 2
+
+        flags = cabecalho[ihl + 13]
+        flags = flags | _TCP_PSH if mudancas & PUSH else flags & ~_TCP_PSH
+        seq, ack = _SEQ_ACK.unpack_from(cabecalho, ihl + 4)
+        total_anterior = _PALAVRA.unpack_from(cabecalho, 2)[0]
+        especiais = mudancas & ESPECIAIS
+        if especiais == ESPECIAL_I:
+            ack += total_anterior - hlen
+            seq += total_anterior - hlen
+        elif especiais == ESPECIAL_D:
+            seq += total_anterior - hlen
+        else:
+            if mudancas & NOVO_U:
+                flags |= _TCP_URG
+                urgente, i = _decodificar(quadro, i)
+                _PALAVRA.pack_into(cabecalho, ihl + 18, urgente)
+            else:
+                flags &= ~_TCP_URG
+            if mudancas & NOVO_W:
+                delta, i = _decodificar(quadro, i)
+                janela = _PALAVRA.unpack_from(cabecalho, ihl + 14)[0]
+                _PALAVRA.pack_into(cabecalho, ihl + 14, (janela + delta) & 0xffff)
+            if mudancas & NOVO_A:
+                delta, i = _decodificar(quadro, i)
+                ack += delta
+            if mudancas & NOVO_S:
+                delta, i = _decodificar(quadro, i)
+                seq += delta
+        identificacao = _PALAVRA.unpack_from(cabecalho, 4)[0]
+        if mudancas & NOVO_I:
+            delta, i = _decodificar(quadro, i)
+            identificacao += delta
+        else:
+            identificacao += 1
+        if i > len(quadro):
+            raise IndexError
+
+        dados = quadro[i:]
+        cabecalho[ihl + 13] = flags
+        _SEQ_ACK.pack_into(cabecalho, ihl + 4, seq & 0xffffffff, ack & 0xffffffff)
+        cabecalho[ihl+16:ihl+18] = checksum_tcp
+        _PALAVRA.pack_into(cabecalho, 2, hlen + len(dados))
+        _PALAVRA.pack_into(cabecalho, 4, identificacao & 0xffff)
+        cabecalho[10:12] = b'\x00\x00'
+        _PALAVRA.pack_into(cabecalho, 10, calc_checksum(cabecalho[:ihl]))
+        return bytes(cabecalho) + dados
@@ -0,0 +1,124 @@
+import asyncio
+from tcp import JANELA_RECEPCAO
+
+
+# Acima deste número de bytes no buffer de envio, drenar() passa a esperar
+LIMITE_ALTO = 4*JANELA_RECEPCAO
+
+
+class Fluxo:
+    """
+    Interface com await sobre uma tcp.Conexao, no estilo de
+    asyncio.StreamReader/StreamWriter: ler()/ler_linha() equivalem a
+    read()/readline(), escrever() a write() e drenar() a drain().
+
+    Leitura: os dados recebidos ficam no buffer do Fluxo e só são
+    informados à conexão como consumidos (Conexao.consumir) quando a
+    aplicação os lê. Se a aplicação parar de ler, a janela de recepção se
+    fecha e o cliente para de enviar.
+
+    Escrita: escrever() nunca bloqueia; drenar() espera enquanto o buffer
+    de envio tiver mais que limite_alto bytes, até ele baixar de
+    limite_baixo. Para desconectar clientes lentos, basta usar
+    asyncio.wait_for(fluxo.drenar(), prazo) e fechar em caso de timeout.
+    Quem espera em drenar() também é acordado quando o cliente encerra a
+    conexão (drenar() retorna: não há por que esperar um ACK que pode não
+    vir) e quando o Fluxo é fechado (drenar() lança ConnectionResetError,
+    como StreamWriter.drain() depois de close()).
+    """
+    def __init__(self, conexao, limite_alto=LIMITE_ALTO, limite_baixo=None):
+        self.conexao = conexao
+        self.limite_alto = limite_alto
+        self.limite_baixo = limite_alto // 4 if limite_baixo is None else limite_baixo
+        self.buffer = bytearray()
+        self.eof = False
+        self.fechado = False
+        self._esperando_dados = None
+        self._esperando_drenagem = None
+        conexao.registrar_recebedor(self._dados_recebidos, consumo_manual=True)
+        conexao.registrar_monitor_de_envio(self._envio_liberado)
+
+    def _dados_recebidos(self, conexao, dados):
+        if dados:
+            self.buffer += dados
+        else:
+            self.eof = True
+            self._esperando_drenagem = _acordar(self._esperando_drenagem)
+        self._esperando_dados = _acordar(self._esperando_dados)
+
+    def _envio_liberado(self, conexao):
+        if self.tamanho_buffer_envio() <= self.limite_baixo:
+            self._esperando_drenagem = _acordar(self._esperando_drenagem)
+
+    def _retirar(self, n):
+        dados = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        self.conexao.consumir(len(dados))
+        return dados
+
+    async def _esperar_dados(self):
+        if self._esperando_dados is None:
+            self._esperando_dados = asyncio.get_running_loop().create_future()
+        await self._esperando_dados
+
+    async def ler(self, n=-1):
+        """
+        Lê até n bytes, esperando se ainda não houver nenhum. Com n < 0, lê
+        tudo até o fim da conexão. Retorna b'' no fim da conexão.
+        """
+        if n < 0:
+            while not self.eof:
+                await self._esperar_dados()
+            return self._retirar(len(self.buffer))
+        while not self.buffer and not self.eof:
+            await self._esperar_dados()
+        return self._retirar(n)
+
+    async def ler_linha(self, separador=b'\n'):
+        """
+        Lê até o separador, inclusive. No fim da conexão, retorna o que
+        sobrou (possivelmente b'').
+        """
+        inicio = 0
+        while True:
+            fim = self.buffer.find(separador, inicio)
+            if fim >= 0:
+                return self._retirar(fim + len(separador))
+            if self.eof:
+                return self._retirar(len(self.buffer))
+            inicio = max(0, len(self.buffer) - len(separador) + 1)
+            await self._esperar_dados()
+
+    def escrever(self, dados):
+        self.conexao.enviar(dados)
+
+    def tamanho_buffer_envio(self):
+        return len(self.conexao.buffer_envio)
+
+    async def drenar(self):
+        """
+        Espera o buffer de envio esvaziar até limite_baixo, se tiver passado
+        de limite_alto. Retorna sem esperar depois do fim da conexão e lança
+        ConnectionResetError se o Fluxo for (ou já estiver) fechado.
+        """
+        if not self.fechado and (self.eof or self.tamanho_buffer_envio() <= self.limite_alto):
+            return
+        if not self.fechado:
+            if self._esperando_drenagem is None:
+                self._esperando_drenagem = asyncio.get_running_loop().create_future()
+            await self._esperando_drenagem
+        if self.fechado:
+            raise ConnectionResetError('conexão fechada')
+
+    def fechar(self):
+        self.fechado = True
+        self._esperando_drenagem = _acordar(self._esperando_drenagem)
+        self.conexao.fechar()
+
+
+def _acordar(futuro):
+    # Conclui o futuro de quem está esperando, se houver, e retorna None
+    # para limpar o atributo correspondente
+    if futuro is not None and not futuro.done():
+        futuro.set_result(None)
+    return None
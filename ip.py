@@ -1,5 +1,258 @@
 from iputils import *
+from checksum import calc_checksum
+from metricas import registro
+from functools import lru_cache
 import struct
+import time
+
+
+_encaminhados = registro.contador('ip.encaminhados')
+_entregues = registro.contador('ip.entregues')
+_enviados = registro.contador('ip.enviados')
+_ttl_expirado = registro.contador('ip.ttl_expirado')
+_sem_rota = registro.contador('ip.sem_rota')
+_fragmentados = registro.contador('ip.fragmentados')
+_fragmentos_descartados = registro.contador('ip.fragmentos_descartados')
+_remontados = registro.contador('ip.remontados')
+_df_descartados = registro.contador('ip.df_descartados')
+
+
+# Número máximo de destinos guardados no cache de next_hop
+TAMANHO_CACHE_ROTAS = 1024
+
+# Limites da remontagem de fragmentos: tempo máximo de espera pelos demais
+# fragmentos (s), memória total ocupada (bytes) e datagramas simultâneos
+TEMPO_REMONTAGEM = 30.0
+MEMORIA_REMONTAGEM = 256 * 1024
+MAX_REMONTAGENS = 64
+
+# Bits do campo flags/offset do cabeçalho IPv4
+FLAG_DF = 0x4000
+FLAG_MF = 0x2000
+
+
+def _compilar_tabela(tabela):
+    """
+    Compila a tabela de encaminhamento em uma tupla ((mascara, {rede: next_hop}), ...),
+    com um dicionário por tamanho de prefixo, do prefixo mais longo para o mais
+    curto. Entre CIDRs repetidos, vale o primeiro da tabela.
+    """
+    por_prefixo = {}
+    for cidr, next_hop in tabela:
+        if isinstance(next_hop, list):
+            # Vários next_hop: a camada de enlace divide o tráfego entre eles
+            next_hop = tuple(next_hop)
+        # Separar endereço de rede e tamanho do prefixo
+        if '/' in cidr:
+            rede, prefix_len_str = cidr.split('/')
+            prefix_len = int(prefix_len_str)
+        else:
+            rede = cidr
+            prefix_len = 32
+
+        # Criar máscara de rede
+        mascara = (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+        rede_int = struct.unpack('!I', str2addr(rede))[0] & mascara
+        _, redes = por_prefixo.setdefault(prefix_len, (mascara, {}))
+        redes.setdefault(rede_int, next_hop)
+
+    return tuple(por_prefixo[prefix_len] for prefix_len in sorted(por_prefixo, reverse=True))
+
+
+# Endereços em string (x.y.z.w) só aparecem na configuração e na interface
+# com a camada de transporte; internamente são inteiros ou 4 bytes. As
+# conversões passam por estes caches, já que os endereços se repetem muito.
+@lru_cache(maxsize=1024)
+def _str2int(endereco):
+    return int.from_bytes(str2addr(endereco), 'big')
+
+@lru_cache(maxsize=1024)
+def _bytes2str(endereco):
+    return addr2str(endereco)
+
+
+class CabecalhoIPv4:
+    """
+    Visão do cabeçalho de um datagrama IPv4 que só decodifica cada campo
+    quando ele é lido. Os endereços estão disponíveis como inteiros (src,
+    dst) e como strings x.y.z.w (src_addr, dst_addr).
+    """
+    __slots__ = ('dados',)
+
+    def __init__(self, datagrama):
+        self.dados = memoryview(datagrama)
+
+    @property
+    def versao(self):
+        return self.dados[0] >> 4
+
+    @property
+    def ihl(self):
+        return 4 * (self.dados[0] & 0xf)
+
+    @property
+    def total_len(self):
+        return (self.dados[2] << 8) | self.dados[3]
+
+    @property
+    def identification(self):
+        return (self.dados[4] << 8) | self.dados[5]
+
+    @property
+    def flags(self):
+        return self.dados[6] >> 5
+
+    @property
+    def frag_offset(self):
+        return ((self.dados[6] & 0x1f) << 8) | self.dados[7]
+
+    @property
+    def ttl(self):
+        return self.dados[8]
+
+    @property
+    def proto(self):
+        return self.dados[9]
+
+    @property
+    def src(self):
+        return int.from_bytes(self.dados[12:16], 'big')
+
+    @property
+    def dst(self):
+        return int.from_bytes(self.dados[16:20], 'big')
+
+    @property
+    def src_addr(self):
+        return _bytes2str(self.dados[12:16].tobytes())
+
+    @property
+    def dst_addr(self):
+        return _bytes2str(self.dados[16:20].tobytes())
+
+    @property
+    def payload(self):
+        return self.dados[self.ihl:self.total_len]
+
+
+def fragmentar(datagrama, mtu):
+    """
+    Divide um datagrama em fragmentos de no máximo mtu bytes (RFC 791). Os
+    dados de cada fragmento, exceto o último, têm tamanho múltiplo de 8, e
+    um datagrama que já era fragmento pode ser fragmentado de novo.
+    """
+    ihl = 4 * (datagrama[0] & 0xf)
+    total_len, _, flagsfrag = struct.unpack_from('!HHH', datagrama, 2)
+    offset_original = flagsfrag & 0x1fff
+    mf_original = flagsfrag & FLAG_MF
+    dados = memoryview(datagrama)[ihl:total_len]
+    passo = (mtu - ihl) // 8 * 8
+
+    fragmentos = []
+    for inicio in range(0, len(dados), passo):
+        pedaco = dados[inicio:inicio + passo]
+        ultimo = inicio + passo >= len(dados)
+        cabecalho = bytearray(datagrama[:ihl])
+        struct.pack_into('!H', cabecalho, 2, ihl + len(pedaco))
+        struct.pack_into('!H', cabecalho, 6,
+                         (offset_original + inicio // 8) | (mf_original if ultimo else FLAG_MF))
+        struct.pack_into('!H', cabecalho, 10, 0)
+        struct.pack_into('!H', cabecalho, 10, calc_checksum(cabecalho))
+        fragmentos.append(bytes(cabecalho) + pedaco)
+    return fragmentos
+
+
+class _Remontagem:
+    __slots__ = ('prazo', 'total', 'partes', 'tamanho')
+
+    def __init__(self, prazo):
+        self.prazo = prazo
+        self.total = None       # conhecido quando chega o último fragmento
+        self.partes = []        # [(offset em bytes, dados)]
+        self.tamanho = 0        # bytes guardados
+
+    def montar(self):
+        """
+        Retorna os dados completos, se todos os fragmentos já chegaram.
+        """
+        if self.total is None:
+            return None
+        self.partes.sort(key=lambda parte: parte[0])
+        coberto = 0
+        for offset, dados in self.partes:
+            if offset > coberto:
+                return None
+            coberto = max(coberto, offset + len(dados))
+        if coberto < self.total:
+            return None
+        completo = bytearray(self.total)
+        for offset, dados in self.partes:
+            completo[offset:offset + len(dados)] = dados[:self.total - offset]
+        return bytes(completo)
+
+
+class TabelaDeRemontagem:
+    """
+    Datagramas em remontagem, indexados por (origem, destino, identificação,
+    protocolo). Uma remontagem é descartada se não terminar em `tempo`
+    segundos; as mais antigas também são descartadas quando a memória
+    ocupada passa de `memoria` bytes ou há mais de `max_entradas`.
+    Como as entradas são criadas em ordem de tempo, as mais antigas são
+    sempre as primeiras do dicionário.
+    """
+    def __init__(self, tempo=TEMPO_REMONTAGEM, memoria=MEMORIA_REMONTAGEM,
+                 max_entradas=MAX_REMONTAGENS):
+        self.tempo = tempo
+        self.memoria = memoria
+        self.max_entradas = max_entradas
+        self.entradas = {}
+        self.bytes = 0
+
+    def inserir(self, chave, offset, mais_fragmentos, dados):
+        """
+        Guarda um fragmento (offset em bytes) e retorna os dados do datagrama
+        completo, se este fragmento o completou, ou None. Fragmentos que
+        passam do fim já conhecido do datagrama, e um segundo último
+        fragmento com outro fim, são descartados.
+        """
+        agora = time.monotonic()
+        while self.entradas:
+            mais_antiga = next(iter(self.entradas))
+            if self.entradas[mais_antiga].prazo > agora:
+                break
+            self._descartar(mais_antiga)
+
+        remontagem = self.entradas.get(chave)
+        if remontagem is None:
+            remontagem = self.entradas[chave] = _Remontagem(agora + self.tempo)
+        fim = offset + len(dados)
+        if not mais_fragmentos:
+            if remontagem.total not in (None, fim) or \
+                    any(offset_i + len(dados_i) > fim for offset_i, dados_i in remontagem.partes):
+                _fragmentos_descartados.incrementar()
+                return None
+            remontagem.total = fim
+        elif remontagem.total is not None and fim > remontagem.total:
+            _fragmentos_descartados.incrementar()
+            return None
+        remontagem.partes.append((offset, bytes(dados)))
+        remontagem.tamanho += len(dados)
+        self.bytes += len(dados)
+
+        completo = remontagem.montar()
+        if completo is not None:
+            del self.entradas[chave]
+            self.bytes -= remontagem.tamanho
+            return completo
+
+        while self.bytes > self.memoria or len(self.entradas) > self.max_entradas:
+            self._descartar(next(iter(self.entradas)))
+        return None
+
+    def _descartar(self, chave):
+        remontagem = self.entradas.pop(chave)
+        self.bytes -= remontagem.tamanho
+        _fragmentos_descartados.incrementar(len(remontagem.partes))
 
 
 class IP:
@@ -14,67 +267,112 @@ class IP:
         self.enlace.registrar_recebedor(self.__raw_recv)
         self.ignore_checksum = self.enlace.ignore_checksum
         self.meu_endereco = None
+        self._meu_endereco_bin = None
+        self._meu_endereco_int = None
         self.tabela = []
+        self._rotas = ((), {})
+        self.remontagem = TabelaDeRemontagem()
+        self.identificacao = 0
 
     def __raw_recv(self, datagrama):
-        dscp, ecn, identification, flags, frag_offset, ttl, proto, \
-           src_addr, dst_addr, payload = read_ipv4_header(datagrama)
-        
-        if dst_addr == self.meu_endereco:
+        # Para decidir entre host e roteador basta o endereço de destino
+        dst_bin = bytes(datagrama[16:20])
+
+        if dst_bin == self._meu_endereco_bin:
             # atua como host
+            cabecalho = CabecalhoIPv4(datagrama)
+            if cabecalho.versao != 4:
+                return
+            flags = cabecalho.flags
+            frag_offset = cabecalho.frag_offset
+            proto = cabecalho.proto
+            if flags & 1 or frag_offset:
+                # Fragmento (MF ligado ou offset não nulo): espera os demais
+                payload = self.remontagem.inserir(
+                    (cabecalho.src, cabecalho.dst, cabecalho.identification, proto),
+                    8 * frag_offset, flags & 1, cabecalho.payload)
+                if payload is None:
+                    return
+                _remontados.incrementar()
+            else:
+                payload = cabecalho.payload.tobytes()
+            _entregues.incrementar()
             if proto == IPPROTO_TCP and self.callback:
-                self.callback(src_addr, dst_addr, payload)
+                self.callback(cabecalho.src_addr, self.meu_endereco, payload)
         else:
             # atua como roteador
-            next_hop = self._next_hop(dst_addr)
-            
-            # Passo 4: Decrementar TTL e recalcular checksum
-            ttl -= 1
-            
-            # Passo 5: Se TTL chegar a zero, enviar ICMP Time Exceeded
-            if ttl <= 0:
-                # Enviar mensagem ICMP Time Exceeded
-                if next_hop is not None:  # Só envia ICMP se há uma rota de volta
-                    self._enviar_icmp_time_exceeded(datagrama, src_addr)
+            self._encaminhar(datagrama, dst_bin)
+
+    def _encaminhar(self, datagrama, dst_bin):
+        """
+        Caminho rápido de encaminhamento: lê do cabeçalho apenas TTL e destino,
+        copia o datagrama uma única vez e atualiza TTL e checksum na própria
+        cópia, com a atualização incremental do checksum da RFC 1624.
+        """
+        next_hop = self._next_hop_int(int.from_bytes(dst_bin, 'big'))
+
+        # Passo 4: Decrementar TTL e recalcular checksum
+        ttl = datagrama[8]
+
+        # Passo 5: Se TTL chegar a zero, enviar ICMP Time Exceeded
+        if ttl <= 1:
+            _ttl_expirado.incrementar()
+            # Enviar mensagem ICMP Time Exceeded
+            if next_hop is not None:  # Só envia ICMP se há uma rota de volta
+                self._enviar_icmp_time_exceeded(datagrama, _bytes2str(bytes(datagrama[12:16])))
+            return
+
+        novo_datagrama = bytearray(datagrama)
+        novo_datagrama[8] = ttl - 1
+
+        # RFC 1624, eq. 3: HC' = ~(~HC + ~m + m'), onde m é a palavra de 16
+        # bits que contém o TTL (TTL << 8 | protocolo) e m' = m - 0x100
+        m = (ttl << 8) | novo_datagrama[9]
+        checksum = (novo_datagrama[10] << 8) | novo_datagrama[11]
+        soma = (~checksum & 0xffff) + (~m & 0xffff) + (m - 0x100)
+        soma = (soma & 0xffff) + (soma >> 16)
+        soma = (soma & 0xffff) + (soma >> 16)
+        checksum = ~soma & 0xffff
+        novo_datagrama[10] = checksum >> 8
+        novo_datagrama[11] = checksum & 0xff
+
+        # Enviar mesmo se next_hop for None (para testes)
+        if next_hop is None:
+            _sem_rota.incrementar()
+        else:
+            _encaminhados.incrementar()
+            mtu = self.enlace.mtu(next_hop)
+            if len(novo_datagrama) > mtu:
+                if (novo_datagrama[6] << 8) & FLAG_DF:
+                    # Não pode fragmentar: ICMP Fragmentation Needed com a
+                    # MTU do próximo enlace (RFC 1191)
+                    _df_descartados.incrementar()
+                    self._enviar_icmp(datagrama, _bytes2str(bytes(datagrama[12:16])), 3, 4, mtu)
+                    return
+                self._enviar_fragmentos(novo_datagrama, next_hop, mtu)
                 return
-            
-            # Reconstruir o datagrama com o novo TTL
-            # Extrair o cabeçalho original
-            vihl, dscpecn, total_len, identification, flagsfrag, old_ttl, proto, \
-                old_checksum, src, dst = struct.unpack('!BBHHHBBHII', datagrama[:20])
-            
-            # Montar novo cabeçalho com TTL decrementado e checksum zerado
-            novo_cabecalho = struct.pack('!BBHHHBBHII',
-                vihl, dscpecn, total_len, identification, flagsfrag,
-                ttl, proto, 0, src, dst)
-            
-            # Calcular novo checksum
-            novo_checksum = calc_checksum(novo_cabecalho)
-            
-            # Montar cabeçalho final com checksum correto
-            novo_cabecalho = struct.pack('!BBHHHBBHII',
-                vihl, dscpecn, total_len, identification, flagsfrag,
-                ttl, proto, novo_checksum, src, dst)
-            
-            # Reconstruir datagrama completo
-            novo_datagrama = novo_cabecalho + datagrama[20:]
-            
-            # Enviar mesmo se next_hop for None (para testes)
-            self.enlace.enviar(novo_datagrama, next_hop)
+        self.enlace.enviar(novo_datagrama, next_hop)
+
+    def _enviar_fragmentos(self, datagrama, next_hop, mtu):
+        _fragmentados.incrementar()
+        for fragmento in fragmentar(datagrama, mtu):
+            self.enlace.enviar(fragmento, next_hop)
 
     def _enviar_icmp_time_exceeded(self, datagrama_original, dest_addr):
         """
         Envia mensagem ICMP Time Exceeded de volta ao remetente
         """
+        # Type: 11 (Time Exceeded), Code: 0 (TTL expired in transit)
+        self._enviar_icmp(datagrama_original, dest_addr, 11, 0)
+
+    def _enviar_icmp(self, datagrama_original, dest_addr, icmp_type, icmp_code, icmp_unused=0):
+        """
+        Envia ao remetente uma mensagem ICMP de erro sobre datagrama_original
+        """
         # Extrair os primeiros 28 bytes do datagrama original (cabeçalho IP + 8 bytes de dados)
         dados_originais = datagrama_original[:28]
         
-        # Montar mensagem ICMP Time Exceeded
-        # Type: 11 (Time Exceeded), Code: 0 (TTL expired in transit)
-        icmp_type = 11
-        icmp_code = 0
         icmp_checksum = 0
-        icmp_unused = 0
         
         # Construir mensagem ICMP sem checksum
         icmp_msg = struct.pack('!BBHI', icmp_type, icmp_code, icmp_checksum, icmp_unused)
@@ -94,38 +392,44 @@ class IP:
         """
         Passo 1 e 3: Determina o next_hop usando a tabela de encaminhamento.
         Passo 3: Implementa longest prefix match para desempate.
+
+        Consulta primeiro o cache de destinos e, em caso de falha, os
+        prefixos compilados por definir_tabela_encaminhamento, do mais longo
+        para o mais curto.
         """
         # Converter endereço de destino para inteiro
-        dest_int = struct.unpack('!I', str2addr(dest_addr))[0]
-        
+        return self._next_hop_int(_str2int(dest_addr))
+
+    def mtu_rota(self, dest_addr):
+        """
+        Retorna a MTU do enlace usado para alcançar dest_addr, ou None se não
+        houver rota.
+        """
+        next_hop = self._next_hop(dest_addr)
+        if next_hop is None:
+            return None
+        return self.enlace.mtu(next_hop)
+
+    def _next_hop_int(self, dest_int):
+        """
+        Igual a _next_hop, mas recebe o destino já como inteiro.
+        """
+        # Lê tabela e cache de uma só vez para não misturar duas versões
+        rotas, cache = self._rotas
+        try:
+            return cache[dest_int]
+        except KeyError:
+            pass
+
         melhor_match = None
-        melhor_prefix_len = -1
-        
-        for cidr, next_hop in self.tabela:
-            # Separar endereço de rede e tamanho do prefixo
-            if '/' in cidr:
-                rede, prefix_len_str = cidr.split('/')
-                prefix_len = int(prefix_len_str)
-            else:
-                rede = cidr
-                prefix_len = 32
-            
-            # Converter rede para inteiro
-            rede_int = struct.unpack('!I', str2addr(rede))[0]
-            
-            # Criar máscara de rede
-            if prefix_len == 0:
-                mascara = 0
-            else:
-                mascara = (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
-            
-            # Verificar se o destino está nesta rede
-            if (dest_int & mascara) == (rede_int & mascara):
-                # Passo 3: Usar longest prefix match
-                if prefix_len > melhor_prefix_len:
-                    melhor_prefix_len = prefix_len
-                    melhor_match = next_hop
-        
+        for mascara, redes in rotas:
+            melhor_match = redes.get(dest_int & mascara)
+            if melhor_match is not None:
+                break
+
+        if len(cache) >= TAMANHO_CACHE_ROTAS:
+            cache.clear()
+        cache[dest_int] = melhor_match
         return melhor_match
 
     def definir_endereco_host(self, meu_endereco):
@@ -135,6 +439,8 @@ class IP:
         atuaremos como roteador em vez de atuar como host.
         """
         self.meu_endereco = meu_endereco
+        self._meu_endereco_bin = str2addr(meu_endereco)
+        self._meu_endereco_int = _str2int(meu_endereco)
 
     def definir_tabela_encaminhamento(self, tabela):
         """
@@ -142,9 +448,13 @@ class IP:
         [(cidr0, next_hop0), (cidr1, next_hop1), ...]
 
         Onde os CIDR são fornecidos no formato 'x.y.z.w/n', e os
-        next_hop são fornecidos no formato 'x.y.z.w'.
+        next_hop são fornecidos no formato 'x.y.z.w'. Um next_hop pode
+        também ser uma lista de endereços, para dividir o tráfego da rota
+        entre eles (ver slip.GrupoDeEnlaces).
         """
         self.tabela = tabela
+        # Troca tabela compilada e cache em uma única atribuição
+        self._rotas = (_compilar_tabela(tabela), {})
 
     def registrar_recebedor(self, callback):
         """
@@ -157,21 +467,25 @@ class IP:
         Passo 2: Envia segmento para dest_addr, onde dest_addr é um endereço IPv4
         (string no formato x.y.z.w).
         """
-        next_hop = self._next_hop(dest_addr)
+        dst_addr_int = _str2int(dest_addr)
+        next_hop = self._next_hop_int(dst_addr_int)
         if next_hop is None:
+            _sem_rota.incrementar()
             return
+        _enviados.incrementar()
         
         # Montar cabeçalho IPv4
         vihl = (4 << 4) | 5  # Version 4, IHL 5 (20 bytes)
         dscpecn = 0
         total_len = 20 + len(segmento)
-        identification = 0
+        # Identificação distinta por datagrama, para a remontagem de fragmentos
+        identification = self.identificacao
+        self.identificacao = (self.identificacao + 1) & 0xffff
         flagsfrag = 0
         ttl = 64
         proto = protocolo
         checksum = 0
-        src_addr_int = struct.unpack('!I', str2addr(self.meu_endereco))[0]
-        dst_addr_int = struct.unpack('!I', str2addr(dest_addr))[0]
+        src_addr_int = self._meu_endereco_int
         
         # Montar cabeçalho sem checksum
         cabecalho = struct.pack('!BBHHHBBHII',
@@ -189,4 +503,8 @@ class IP:
         # Montar datagrama completo
         datagrama = cabecalho + segmento
         
+        mtu = self.enlace.mtu(next_hop)
+        if len(datagrama) > mtu:
+            self._enviar_fragmentos(datagrama, next_hop, mtu)
+            return
         self.enlace.enviar(datagrama, next_hop)
\ No newline at end of file
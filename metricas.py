@@ -0,0 +1,137 @@
+import asyncio
+import weakref
+from bisect import bisect_left
+
+
+class Contador:
+    """
+    Contador monotônico. Incrementar custa uma soma em um atributo.
+    """
+    __slots__ = ('nome', 'valor')
+
+    def __init__(self, nome):
+        self.nome = nome
+        self.valor = 0
+
+    def incrementar(self, n=1):
+        self.valor += n
+
+
+class Histograma:
+    """
+    Histograma com limites fixos: contagens[i] conta as observações
+    <= limites[i], e a última posição conta as que passam do último limite.
+    """
+    __slots__ = ('nome', 'limites', 'contagens', 'soma', 'total')
+
+    def __init__(self, nome, limites):
+        self.nome = nome
+        self.limites = sorted(limites)
+        self.contagens = [0] * (len(self.limites) + 1)
+        self.soma = 0
+        self.total = 0
+
+    def observar(self, valor):
+        self.contagens[bisect_left(self.limites, valor)] += 1
+        self.soma += valor
+        self.total += 1
+
+
+class Registro:
+    """
+    Registro das métricas de todas as camadas. Contadores e histogramas com
+    o mesmo nome são compartilhados, então instâncias diferentes de uma
+    camada (por exemplo, vários Enlace) somam no mesmo contador.
+
+    Valores que as camadas já mantêm em atributos são lidos só na hora do
+    instantâneo, por coletores: funções que retornam {nome: valor}. Valores
+    de coletores com o mesmo nome são somados. Um coletor que é método de um
+    objeto é guardado por referência fraca e sai do registro junto com o
+    objeto; remover_coletor o tira antes disso.
+    """
+    def __init__(self):
+        self.contadores = {}
+        self.histogramas = {}
+        self.coletores = []
+
+    def contador(self, nome):
+        contador = self.contadores.get(nome)
+        if contador is None:
+            contador = self.contadores[nome] = Contador(nome)
+        return contador
+
+    def histograma(self, nome, limites):
+        histograma = self.histogramas.get(nome)
+        if histograma is None:
+            histograma = self.histogramas[nome] = Histograma(nome, limites)
+        return histograma
+
+    def registrar_coletor(self, coletor):
+        if hasattr(coletor, '__self__'):
+            referencia = weakref.WeakMethod(coletor, self._descartar_coletor)
+        else:
+            referencia = lambda: coletor
+        self.coletores.append(referencia)
+
+    def remover_coletor(self, coletor):
+        self.coletores = [referencia for referencia in self.coletores
+                          if referencia() not in (None, coletor)]
+
+    def _descartar_coletor(self, referencia):
+        # O objeto do coletor foi coletado pelo GC
+        if referencia in self.coletores:
+            self.coletores.remove(referencia)
+
+    def instantaneo(self):
+        """
+        Retorna um dicionário com o valor atual de todas as métricas.
+        """
+        valores = {nome: contador.valor for nome, contador in self.contadores.items()}
+        for referencia in list(self.coletores):
+            coletor = referencia()
+            if coletor is None:
+                continue
+            for nome, valor in coletor().items():
+                valores[nome] = valores.get(nome, 0) + valor
+        for nome, histograma in self.histogramas.items():
+            valores[nome] = {
+                'limites': list(histograma.limites),
+                'contagens': list(histograma.contagens),
+                'soma': histograma.soma,
+                'total': histograma.total,
+            }
+        return valores
+
+    def texto(self):
+        """
+        Formata o instantâneo em texto, uma métrica por linha.
+        """
+        linhas = []
+        for nome, valor in sorted(self.instantaneo().items()):
+            if isinstance(valor, dict):
+                acumulado = 0
+                for limite, contagem in zip(valor['limites'] + ['+Inf'], valor['contagens']):
+                    acumulado += contagem
+                    linhas.append('%s_bucket{le="%s"} %s' % (nome, limite, acumulado))
+                linhas.append('%s_soma %s' % (nome, valor['soma']))
+                linhas.append('%s_total %s' % (nome, valor['total']))
+            else:
+                linhas.append('%s %s' % (nome, valor))
+        return '\n'.join(linhas) + '\n'
+
+    async def servir(self, porta, host='127.0.0.1'):
+        """
+        Abre um endpoint TCP local que responde a cada conexão com as
+        métricas em texto e fecha (ex.: nc 127.0.0.1 <porta>). Retorna o
+        asyncio.Server; erros ao abrir a porta (já em uso, por exemplo) são
+        lançados aqui.
+        """
+        async def atender(reader, writer):
+            writer.write(self.texto().encode())
+            await writer.drain()
+            writer.close()
+        return await asyncio.start_server(atender, host, porta)
+
+
+# Registro usado por toda a pilha
+registro = Registro()
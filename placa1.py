@@ -1,39 +1,68 @@
 #!/usr/bin/env python3
+import os
 import asyncio
 from camadafisica import PTY, ZyboSerialDriver
 from ip import IP               # copie o arquivo do T3
-from slip import CamadaEnlace   # copie o arquivo do T4
+from slip import CamadaEnlace, MODO_SLIP, MAX_ESTADOS   # copie o arquivo do T4
+from metricas import registro
 
 
-driver = ZyboSerialDriver()
-
-serial1 = driver.obter_porta(0)
-pty1 = PTY()
-
 outra_ponta = '192.168.200.1'
 nossa_ponta = '192.168.200.2'
 
-print('Para conectar a outra ponta da camada física, execute em outro terminal:')
-print('  sudo slattach -v -p slip {}'.format(pty1.pty_name))
-print()
-print('E, em um terceiro terminal, execute:')
-print('  sudo ifconfig sl0 {} pointopoint {}'.format(outra_ponta, nossa_ponta))
-print('  sudo ip route add 192.168.200.0/24 via {}'.format(nossa_ponta))
-print()
-
-# Os endereços IP que especificamos abaixo são os endereços da outra ponta do enlace.
-enlace = CamadaEnlace({outra_ponta: pty1,
-                       '192.168.200.3': serial1,})
-
-rede = IP(enlace)
-rede.definir_endereco_host(nossa_ponta)
-
-# A tabela de encaminhamento define através de qual enlace (especificado pelo IP
-# que está na outra ponta daquele enlace) o nosso roteador pode alcançar cada
-# faixa de endereços IP.
-rede.definir_tabela_encaminhamento([
-    ('192.168.200.1/32', outra_ponta),
-    ('192.168.200.0/24', '192.168.200.3'),
-])
-
-asyncio.get_event_loop().run_forever()
\ No newline at end of file
+
+def montar_rede(pty1, serial1, modo=MODO_SLIP, estados=MAX_ESTADOS):
+    """
+    Monta a pilha da placa 1 sobre as linhas seriais dadas (a PTY ligada ao
+    Linux e a porta ligada à placa 2) e retorna a camada de rede. serial1
+    pode ser uma lista de portas, se houver mais de uma linha até a placa 2.
+    modo e estados configuram a compressão de cabeçalhos dos enlaces (ver
+    slip.CamadaEnlace); na PTY, o modo deve ser o mesmo passado ao
+    slattach -p e estados deve ficar em 16, como no Linux.
+    """
+    # Os endereços IP que especificamos abaixo são os endereços da outra ponta do enlace.
+    enlace = CamadaEnlace({outra_ponta: pty1,
+                           '192.168.200.3': serial1,},
+                          modos={outra_ponta: modo,
+                                 '192.168.200.3': modo,},
+                          estados=estados)
+
+    rede = IP(enlace)
+    rede.definir_endereco_host(nossa_ponta)
+
+    # A tabela de encaminhamento define através de qual enlace (especificado pelo IP
+    # que está na outra ponta daquele enlace) o nosso roteador pode alcançar cada
+    # faixa de endereços IP.
+    rede.definir_tabela_encaminhamento([
+        ('192.168.200.1/32', outra_ponta),
+        ('192.168.200.0/24', '192.168.200.3'),
+    ])
+    return rede
+
+
+if __name__ == '__main__':
+    driver = ZyboSerialDriver()
+
+    serial1 = driver.obter_porta(0)
+    pty1 = PTY()
+    # Modo dos enlaces: slip, cslip ou adaptive, como no slattach -p. Deve
+    # ser o mesmo nas placas 2 e 3 (ex.: SLIP_MODO=cslip)
+    modo = os.environ.get('SLIP_MODO', MODO_SLIP)
+
+    print('Para conectar a outra ponta da camada física, execute em outro terminal:')
+    print('  sudo slattach -v -p {} {}'.format(modo, pty1.pty_name))
+    print()
+    print('E, em um terceiro terminal, execute:')
+    print('  sudo ifconfig sl0 {} pointopoint {}'.format(outra_ponta, nossa_ponta))
+    print('  sudo ip route add 192.168.200.0/24 via {}'.format(nossa_ponta))
+    print()
+
+    rede = montar_rede(pty1, serial1, modo)
+
+    # Exporta as métricas da pilha em texto, se pedido
+    # (ex.: METRICAS_PORTA=9101 e depois nc 127.0.0.1 9101)
+    if 'METRICAS_PORTA' in os.environ:
+        servidor_metricas = asyncio.get_event_loop().run_until_complete(
+            registro.servir(int(os.environ['METRICAS_PORTA'])))
+
+    asyncio.get_event_loop().run_forever()
\ No newline at end of file
@@ -1,23 +1,48 @@
 #!/usr/bin/env python3
+import os
 import asyncio
 from camadafisica import ZyboSerialDriver
 from ip import IP               # copie o arquivo do T3
-from slip import CamadaEnlace   # copie o arquivo do T4
+from slip import CamadaEnlace, MODO_SLIP, MAX_ESTADOS   # copie o arquivo do T4
+from metricas import registro
 
 
-driver = ZyboSerialDriver()
+def montar_rede(serial1, serial2, modo=MODO_SLIP, estados=MAX_ESTADOS):
+    """
+    Monta a pilha da placa 2 sobre as linhas seriais dadas (a porta ligada
+    à placa 3 e a porta ligada à placa 1) e retorna a camada de rede.
+    Qualquer uma delas pode ser uma lista de portas, se houver mais de uma
+    linha até a mesma placa. modo e estados configuram a compressão de
+    cabeçalhos dos enlaces (ver slip.CamadaEnlace).
+    """
+    enlace = CamadaEnlace({'192.168.200.4': serial1,
+                           '192.168.200.2': serial2,},
+                          modos={'192.168.200.4': modo,
+                                 '192.168.200.2': modo,},
+                          estados=estados)
 
-serial1 = driver.obter_porta(0)
-serial2 = driver.obter_porta(4)
+    rede = IP(enlace)
+    rede.definir_endereco_host('192.168.200.3')
+    rede.definir_tabela_encaminhamento([
+        ('192.168.200.0/24', '192.168.200.2'),
+        ('192.168.200.4/32', '192.168.200.4'),
+    ])
+    return rede
 
-enlace = CamadaEnlace({'192.168.200.4': serial1,
-                       '192.168.200.2': serial2,})
 
-rede = IP(enlace)
-rede.definir_endereco_host('192.168.200.3')
-rede.definir_tabela_encaminhamento([
-    ('192.168.200.0/24', '192.168.200.2'),
-    ('192.168.200.4/32', '192.168.200.4'),
-])
+if __name__ == '__main__':
+    driver = ZyboSerialDriver()
 
-asyncio.get_event_loop().run_forever()
\ No newline at end of file
+    serial1 = driver.obter_porta(0)
+    serial2 = driver.obter_porta(4)
+
+    # O modo dos enlaces (SLIP_MODO=cslip, por exemplo) deve ser o mesmo nas placas 1 e 3
+    rede = montar_rede(serial1, serial2, os.environ.get('SLIP_MODO', MODO_SLIP))
+
+    # Exporta as métricas da pilha em texto, se pedido
+    # (ex.: METRICAS_PORTA=9101 e depois nc 127.0.0.1 9101)
+    if 'METRICAS_PORTA' in os.environ:
+        servidor_metricas = asyncio.get_event_loop().run_until_complete(
+            registro.servir(int(os.environ['METRICAS_PORTA'])))
+
+    asyncio.get_event_loop().run_forever()
\ No newline at end of file
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
+import os
 import asyncio
 from camadafisica import ZyboSerialDriver
-from tcp import Servidor        # copie o arquivo do T2
+from tcp import Servidor, enviar_multicast, JANELA_RECEPCAO        # copie o arquivo do T2
 from ip import IP               # copie o arquivo do T3
-from slip import CamadaEnlace   # copie o arquivo do T4
+from slip import CamadaEnlace, MODO_SLIP, MAX_ESTADOS   # copie o arquivo do T4
+from metricas import registro
 import re
 
 ## ============================================================================
@@ -11,11 +13,135 @@ import re
 ## ============================================================================
 
 mapa_conexoes_usuario = {}
+# Índices mantidos juntos em NICK/JOIN/PART/QUIT:
+# apelido em minúsculas -> conexão
+conexoes_por_apelido = {}
+# canal em minúsculas -> conjunto de conexões
 grupos_de_canais = {}
+# conexão -> conjunto de canais (em minúsculas) em que ela está
+canais_por_conexao = {}
+
+# Tamanho máximo de uma linha IRC, contando o \r\n final (RFC 1459)
+TAMANHO_MAXIMO_LINHA = 512
+
+# Máximo de bytes aguardando envio em cada conexão ("SendQ"): um cliente que
+# não consome o que recebe é desconectado ao passar disto
+LIMITE_BUFFER_ENVIO = 16*JANELA_RECEPCAO
+# Conexões lentas cuja remoção já foi agendada
+desconectando = set()
+# Função usada para todos os envios (ver definir_envio)
+envio_multicast = enviar_multicast
+
+class SeparadorDeLinhas:
+    """
+    Separa o fluxo recebido de uma conexão em linhas terminadas por \r\n.
+    Lembra até onde já procurou o terminador, para não varrer de novo os
+    dados de uma linha que chega aos poucos, copia cada linha uma única vez
+    e só compacta o buffer uma vez por chamada.
+
+    Linhas maiores que TAMANHO_MAXIMO_LINHA são truncadas e o excesso é
+    descartado até o próximo \r\n, então o buffer nunca passa do limite.
+    """
+    def __init__(self, limite=TAMANHO_MAXIMO_LINHA):
+        self.buffer = bytearray()
+        self.buscado = 0            # posição até onde não há \r\n no buffer
+        self.limite = limite - 2    # sem contar o \r\n
+        self.descartando = False    # dentro do excesso de uma linha longa
+
+    def alimentar(self, dados):
+        """
+        Acrescenta os dados recebidos e retorna a lista das linhas completas
+        (sem o \r\n).
+        """
+        buffer = self.buffer
+        buffer += dados
+        linhas = []
+        inicio = 0
+        with memoryview(buffer) as visao:
+            fim = buffer.find(b'\r\n', self.buscado)
+            while fim >= 0:
+                if self.descartando:
+                    self.descartando = False
+                else:
+                    linhas.append(bytes(visao[inicio:min(fim, inicio + self.limite)]))
+                inicio = fim + 2
+                fim = buffer.find(b'\r\n', inicio)
+
+            if len(buffer) - inicio > self.limite:
+                # Linha longa demais sem terminador: entrega truncada e
+                # descarta o resto, guardando só o último byte (pode ser \r)
+                if not self.descartando:
+                    linhas.append(bytes(visao[inicio:inicio + self.limite]))
+                    self.descartando = True
+                inicio = len(buffer) - 1
+        del buffer[:inicio]
+        # O último byte pode ser o \r de um terminador que ainda vai chegar
+        self.buscado = max(0, len(buffer) - 1)
+        return linhas
 
 def validar_nome_de_recurso(nome):
     return re.match(br'^[a-zA-Z][a-zA-Z0-9_-]*$', nome) is not None
 
+def membros_em_comum(conexao):
+    """
+    Conexões que compartilham algum canal com `conexao` (exceto ela mesma).
+    """
+    membros_a_notificar = set()
+    for canal in canais_por_conexao.get(conexao, ()):
+        membros_a_notificar.update(grupos_de_canais[canal])
+    membros_a_notificar.discard(conexao)
+    return membros_a_notificar
+
+def sair_do_canal(conexao, canal_lwr):
+    membros = grupos_de_canais[canal_lwr]
+    membros.discard(conexao)
+    if not membros:
+        del grupos_de_canais[canal_lwr]
+    canais_por_conexao[conexao].discard(canal_lwr)
+
+def definir_envio(funcao):
+    """
+    Troca a função que faz os envios do IRC, com a interface de
+    tcp.enviar_multicast (o padrão): recebe as conexões e os dados e
+    retorna as conexões que falharam. Os trabalhadores (trabalhadores.py)
+    usam isso para juntar as respostas em quadros para a pilha.
+    """
+    global envio_multicast
+    envio_multicast = funcao
+
+def enviar_para(conexao, dados):
+    difundir((conexao,), dados)
+
+def difundir(conexoes, dados):
+    """
+    Envia os dados às conexões (por envio_multicast) e desconecta as que
+    não os aceitarem.
+
+    O servidor responde dentro dos callbacks da pilha e não pode esperar
+    (como em fluxo.Fluxo.drenar) que um cliente lento libere espaço: isso
+    seguraria a difusão para todos os outros membros do canal. Em vez disso,
+    o buffer de envio de cada conexão é limitado (LIMITE_BUFFER_ENVIO) e
+    quem passa do limite é desconectado, como o "SendQ exceeded" dos
+    servidores IRC.
+    """
+    for conexao in envio_multicast(conexoes, dados):
+        desconectar_lento(conexao)
+
+def desconectar_lento(conexao):
+    # A remoção fica para a próxima volta do loop: a falha acontece no meio
+    # de uma difusão que ainda está percorrendo os membros dos canais
+    if conexao not in desconectando:
+        desconectando.add(conexao)
+        asyncio.get_event_loop().call_soon(_remover_lento, conexao)
+
+def _remover_lento(conexao):
+    desconectando.discard(conexao)
+    if conexao in mapa_conexoes_usuario:
+        print(conexao, 'buffer de envio cheio')
+        # O que o cliente ainda enviar é ignorado
+        conexao.registrar_recebedor(lambda conexao, dados: None)
+        remover_conexao(conexao)
+
 def remover_conexao(conexao_cliente):
     print(conexao_cliente, 'conexão fechada')
     estado_saindo = mapa_conexoes_usuario.get(conexao_cliente)
@@ -23,31 +149,22 @@ def remover_conexao(conexao_cliente):
     if not estado_saindo or 'apelido' not in estado_saindo:
         if conexao_cliente in mapa_conexoes_usuario:
             del mapa_conexoes_usuario[conexao_cliente]
+        canais_por_conexao.pop(conexao_cliente, None)
         conexao_cliente.fechar()
         return
 
     apelido_usuario = estado_saindo['apelido']
-    membros_a_notificar = set()
-    
-    for membros in grupos_de_canais.values():
-        if conexao_cliente in membros:
-            for membro in membros:
-                if membro != conexao_cliente:
-                    membros_a_notificar.add(membro)
+    membros_a_notificar = membros_em_comum(conexao_cliente)
 
     msg_quit = b':' + apelido_usuario + b' QUIT :Connection closed\r\n'
-    for membro in membros_a_notificar:
-        try:
-            membro.enviar(msg_quit)
-        except (BrokenPipeError, OSError):
-            pass
-
-    for nome, membros in list(grupos_de_canais.items()):
-        if conexao_cliente in membros:
-            membros.remove(conexao_cliente)
-            if not membros:
-                del grupos_de_canais[nome]
+    difundir(membros_a_notificar, msg_quit)
+
+    for canal in list(canais_por_conexao[conexao_cliente]):
+        sair_do_canal(conexao_cliente, canal)
+    del canais_por_conexao[conexao_cliente]
 
+    if conexoes_por_apelido.get(apelido_usuario.lower()) is conexao_cliente:
+        del conexoes_por_apelido[apelido_usuario.lower()]
     del mapa_conexoes_usuario[conexao_cliente]
     conexao_cliente.fechar()
 
@@ -57,16 +174,15 @@ def dados_recebidos(conexao, dados):
         return
     
     estado_usuario = mapa_conexoes_usuario[conexao]
-    estado_usuario['buffer'] += dados
-
-    while b'\r\n' in estado_usuario['buffer']:
-        msg, msg_restante = estado_usuario['buffer'].split(b'\r\n', 1)
-        estado_usuario['buffer'] = msg_restante
+    for msg in estado_usuario['separador'].alimentar(dados):
         processar_entrada(conexao, msg)
 
 def conexao_aceita(conexao):
     print(conexao, 'nova conexão')
-    mapa_conexoes_usuario[conexao] = {'buffer': b''}
+    mapa_conexoes_usuario[conexao] = {'separador': SeparadorDeLinhas()}
+    canais_por_conexao[conexao] = set()
+    # Junta as respostas de um mesmo comando em segmentos maiores
+    conexao.adiar_envio = True
     conexao.registrar_recebedor(dados_recebidos)
 
 def processar_entrada(conexao, mensagem_completa):
@@ -82,29 +198,18 @@ def processar_entrada(conexao, mensagem_completa):
     estado_cliente = mapa_conexoes_usuario[conexao]
     apelido_cliente = estado_cliente.get('apelido')
 
-    if apelido_cliente is None and comando_principal not in [b'NICK', b'PING']:
+    if apelido_cliente is None and comando_principal not in COMANDOS_SEM_REGISTRO:
         return
-        
-    if comando_principal == b'PING':
-        handle_ping(conexao, argumentos)
-    elif comando_principal == b'NICK':
-        handle_nick(conexao, argumentos)
-    elif comando_principal == b'JOIN':
-        handle_join(conexao, argumentos)
-    elif comando_principal == b'PART':
-        handle_part(conexao, argumentos)
-    elif comando_principal == b'PRIVMSG':
-        handle_privmsg(conexao, argumentos)
+
+    handler = COMANDOS.get(comando_principal)
+    if handler:
+        handler(conexao, argumentos)
 
 def encontrar_conexao_por_apelido(apelido):
-    apelido = apelido.lower()
-    for conexao, estado in mapa_conexoes_usuario.items():
-        if estado.get('apelido', b'').lower() == apelido:
-            return conexao
-    return None
+    return conexoes_por_apelido.get(apelido.lower())
 
 def handle_ping(conexao, argumentos):
-    conexao.enviar(b':server PONG server :' + argumentos + b'\r\n')
+    enviar_para(conexao, b':server PONG server :' + argumentos + b'\r\n')
 
 def handle_nick(conexao, argumentos):
     novo_apelido = argumentos.strip()
@@ -112,29 +217,25 @@ def handle_nick(conexao, argumentos):
     apelido_atual = estado_usuario.get('apelido', b'*')
 
     if not validar_nome_de_recurso(novo_apelido):
-        conexao.enviar(b':server 432 ' + apelido_atual + b' ' + novo_apelido + b' :Erroneous nickname\r\n')
+        enviar_para(conexao, b':server 432 ' + apelido_atual + b' ' + novo_apelido + b' :Erroneous nickname\r\n')
         return
         
     conexao_existente = encontrar_conexao_por_apelido(novo_apelido)
     if conexao_existente and conexao_existente != conexao:
-        conexao.enviar(b':server 433 ' + apelido_atual + b' ' + novo_apelido + b' :Nickname is already in use\r\n')
+        enviar_para(conexao, b':server 433 ' + apelido_atual + b' ' + novo_apelido + b' :Nickname is already in use\r\n')
     else:
         if apelido_atual != b'*':
-            membros_a_notificar = set()
-            for membros in grupos_de_canais.values():
-                if conexao in membros:
-                    for membro in membros:
-                        if membro != conexao:
-                            membros_a_notificar.add(membro)
-            
+            membros_a_notificar = membros_em_comum(conexao)
+
             msg_nick = b':' + apelido_atual + b' NICK ' + novo_apelido + b'\r\n'
-            conexao.enviar(msg_nick)
-            for membro in membros_a_notificar:
-                membro.enviar(msg_nick)
+            difundir([conexao, *membros_a_notificar], msg_nick)
         else:
-            conexao.enviar(b':server 001 ' + novo_apelido + b' :Welcome\r\n')
-            conexao.enviar(b':server 422 ' + novo_apelido + b' :MOTD File is missing\r\n')
+            enviar_para(conexao, b':server 001 ' + novo_apelido + b' :Welcome\r\n')
+            enviar_para(conexao, b':server 422 ' + novo_apelido + b' :MOTD File is missing\r\n')
         
+        if apelido_atual != b'*':
+            del conexoes_por_apelido[apelido_atual.lower()]
+        conexoes_por_apelido[novo_apelido.lower()] = conexao
         estado_usuario['apelido'] = novo_apelido
 
 def handle_privmsg(conexao, argumentos):
@@ -148,13 +249,11 @@ def handle_privmsg(conexao, argumentos):
     if destinatario.startswith(b'#'):
         canal_lwr = destinatario.lower()
         if canal_lwr in grupos_de_canais and conexao in grupos_de_canais[canal_lwr]:
-            for membro in grupos_de_canais[canal_lwr]:
-                if membro != conexao:
-                    membro.enviar(msg)
+            difundir((membro for membro in grupos_de_canais[canal_lwr] if membro != conexao), msg)
     else:
         conexao_destino = encontrar_conexao_por_apelido(destinatario)
         if conexao_destino:
-            conexao_destino.enviar(msg)
+            enviar_para(conexao_destino, msg)
 
 def handle_join(conexao, argumentos):
     if 'apelido' not in mapa_conexoes_usuario[conexao]:
@@ -164,22 +263,22 @@ def handle_join(conexao, argumentos):
     nome_do_canal = argumentos.split(b' ')[0]
 
     if not nome_do_canal.startswith(b'#') or not validar_nome_de_recurso(nome_do_canal[1:]):
-        conexao.enviar(b':server 403 ' + nome_do_canal + b' :No such channel\r\n')
+        enviar_para(conexao, b':server 403 ' + nome_do_canal + b' :No such channel\r\n')
         return
         
     canal_lwr = nome_do_canal.lower()
         
     if canal_lwr not in grupos_de_canais:
-        grupos_de_canais[canal_lwr] = []
+        grupos_de_canais[canal_lwr] = set()
     
     if conexao in grupos_de_canais[canal_lwr]:
         return
     
-    grupos_de_canais[canal_lwr].append(conexao)
+    grupos_de_canais[canal_lwr].add(conexao)
+    canais_por_conexao[conexao].add(canal_lwr)
     
     msg_join = b':' + remetente + b' JOIN :' + nome_do_canal + b'\r\n'
-    for membro in grupos_de_canais[canal_lwr]:
-        membro.enviar(msg_join)
+    difundir(grupos_de_canais[canal_lwr], msg_join)
     
     membros_atuais = sorted([
         mapa_conexoes_usuario[c]['apelido'] 
@@ -198,7 +297,7 @@ def handle_join(conexao, argumentos):
     for membro in membros_atuais:
         tamanho_membro = len(membro) + 1
         if tamanho_atual + tamanho_membro > limite and lista_atual:
-            conexao.enviar(prefixo + b' '.join(lista_atual) + b'\r\n')
+            enviar_para(conexao, prefixo + b' '.join(lista_atual) + b'\r\n')
             lista_atual = []
             tamanho_atual = 0
         
@@ -206,9 +305,9 @@ def handle_join(conexao, argumentos):
         tamanho_atual += tamanho_membro
     
     if lista_atual:
-        conexao.enviar(prefixo + b' '.join(lista_atual) + b'\r\n')
+        enviar_para(conexao, prefixo + b' '.join(lista_atual) + b'\r\n')
     
-    conexao.enviar(b':server 366 ' + remetente + b' ' + nome_do_canal + b' :End of /NAMES list.\r\n')
+    enviar_para(conexao, b':server 366 ' + remetente + b' ' + nome_do_canal + b' :End of /NAMES list.\r\n')
 
 def handle_part(conexao, argumentos):
     remetente = mapa_conexoes_usuario[conexao]['apelido']
@@ -219,12 +318,20 @@ def handle_part(conexao, argumentos):
         membros = grupos_de_canais[canal_lwr]
         msg_part = b':' + remetente + b' PART ' + nome_do_canal + b'\r\n'
         
-        for membro in membros:
-            membro.enviar(msg_part)
+        difundir(membros, msg_part)
             
-        membros.remove(conexao)
-        if not membros:
-            del grupos_de_canais[canal_lwr]
+        sair_do_canal(conexao, canal_lwr)
+
+# Tabela de despacho: comando -> handler(conexao, argumentos)
+COMANDOS = {
+    b'PING': handle_ping,
+    b'NICK': handle_nick,
+    b'JOIN': handle_join,
+    b'PART': handle_part,
+    b'PRIVMSG': handle_privmsg,
+}
+# Comandos aceitos antes de o cliente escolher um apelido
+COMANDOS_SEM_REGISTRO = {b'NICK', b'PING'}
 
 ## ============================================================================
 ## Integração com as demais camadas
@@ -234,25 +341,57 @@ nossa_ponta = '192.168.200.4'
 outra_ponta = '192.168.200.3'
 porta_tcp = 7000
 
-driver = ZyboSerialDriver()
-linha_serial = driver.obter_porta(0)
 
-enlace = CamadaEnlace({outra_ponta: linha_serial})
-
-rede = IP(enlace)
-rede.definir_endereco_host(nossa_ponta)
-rede.definir_tabela_encaminhamento([
-    ('0.0.0.0/0', outra_ponta)
-])
-
-servidor = Servidor(rede, porta_tcp)
-servidor.registrar_monitor_de_conexoes_aceitas(conexao_aceita)
-
-print('=' * 70)
-print('🚀 PLACA 3 - Servidor IRC')
-print('=' * 70)
-print(f'Endereço: {nossa_ponta}:{porta_tcp}')
-print('Aguardando conexões...')
-print('=' * 70)
+def montar_servidor(linha_serial, monitor=None, modo=MODO_SLIP, estados=MAX_ESTADOS):
+    """
+    Monta a pilha da placa 3 sobre a linha serial dada (ligada à placa 2,
+    ou uma lista de linhas paralelas até ela) e retorna o servidor TCP, já
+    atendendo o IRC. Por padrão o IRC roda neste processo (conexao_aceita);
+    monitor permite trocar o tratamento das conexões aceitas, por exemplo
+    por trabalhadores.Distribuidor. modo e estados configuram a compressão
+    de cabeçalhos do enlace (ver slip.CamadaEnlace).
+    """
+    enlace = CamadaEnlace({outra_ponta: linha_serial}, modos={outra_ponta: modo}, estados=estados)
+
+    rede = IP(enlace)
+    rede.definir_endereco_host(nossa_ponta)
+    rede.definir_tabela_encaminhamento([
+        ('0.0.0.0/0', outra_ponta)
+    ])
 
-asyncio.get_event_loop().run_forever()
\ No newline at end of file
+    servidor = Servidor(rede, porta_tcp, LIMITE_BUFFER_ENVIO)
+    servidor.registrar_monitor_de_conexoes_aceitas(monitor or conexao_aceita)
+    return servidor
+
+
+if __name__ == '__main__':
+    monitor = None
+    if 'IRC_TRABALHADORES' in os.environ:
+        # Lógica do IRC em processos separados (ver trabalhadores.py),
+        # criados antes de abrir o hardware
+        from trabalhadores import Distribuidor
+        distribuidor = Distribuidor()
+        asyncio.get_event_loop().run_until_complete(
+            distribuidor.iniciar(int(os.environ['IRC_TRABALHADORES'])))
+        monitor = distribuidor.conexao_aceita
+
+    driver = ZyboSerialDriver()
+    linha_serial = driver.obter_porta(0)
+
+    # O modo do enlace (SLIP_MODO=cslip, por exemplo) deve ser o mesmo na placa 2
+    servidor = montar_servidor(linha_serial, monitor, os.environ.get('SLIP_MODO', MODO_SLIP))
+
+    print('=' * 70)
+    print('🚀 PLACA 3 - Servidor IRC')
+    print('=' * 70)
+    print(f'Endereço: {nossa_ponta}:{porta_tcp}')
+    print('Aguardando conexões...')
+    print('=' * 70)
+
+    # Exporta as métricas da pilha em texto, se pedido
+    # (ex.: METRICAS_PORTA=9101 e depois nc 127.0.0.1 9101)
+    if 'METRICAS_PORTA' in os.environ:
+        servidor_metricas = asyncio.get_event_loop().run_until_complete(
+            registro.servir(int(os.environ['METRICAS_PORTA'])))
+
+    asyncio.get_event_loop().run_forever()
\ No newline at end of file
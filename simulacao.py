@@ -0,0 +1,1086 @@
+#!/usr/bin/env python3
+"""
+Topologia das três placas simulada em um único processo, sem o hardware.
+
+As linhas seriais são pares de LinhaSerialSimulada, com banda, latência,
+perda e corrupção configuráveis. As placas 1 e 2 são montadas com
+placa1.montar_rede/placa2.montar_rede e a placa 3 com placa3.montar_servidor.
+O Linux do outro lado da PTY da placa 1 é um HostSimulado, com clientes TCP
+mínimos que servem de gerador de carga.
+
+Uso: python3 simulacao.py [encaminhamento|irc|parser|slip|checksum|driver|perda|temporizadores|ack|fechamento|trabalhadores|todos] [opções]
+"""
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import random
+import signal
+import selectors
+import struct
+import tempfile
+import time
+from collections import deque
+import checksum
+import tcputils
+from camadafisica import ZyboSerialDriver
+from checksum import calc_checksum
+from ip import IP
+from metricas import registro
+from slip import CamadaEnlace, Enlace, MTU_PADRAO, MODO_SLIP, MODO_CSLIP, MODO_ADAPTATIVO
+from cslip import MAX_ESTADOS
+from tcp import (ATRASO_ACK, RodaDeTemporizadores, Servidor, Temporizador, enviar_multicast,
+                 make_segment, opcao_mss)
+from tcputils import FLAGS_SYN, FLAGS_ACK, FLAGS_FIN, MSS, read_header
+import placa1
+import placa2
+import placa3
+from trabalhadores import CONCLUIDO, Distribuidor
+
+
+class LinhaSerialSimulada:
+    """
+    Uma ponta de uma linha serial em memória, com a mesma interface de
+    ZyboSerialPort e PTY (registrar_recebedor/enviar). Criada aos pares
+    por par_de_linhas().
+
+    Cada chamada a enviar() ocupa a linha por len(dados)*10/banda segundos
+    (8N1: 10 bits por byte) e chega à outra ponta `latencia` segundos depois
+    de transmitida, sempre na ordem de envio. Perda e corrupção são sorteadas
+    por chamada: uma chamada perdida some inteira e uma corrompida tem um
+    byte trocado.
+    """
+    def __init__(self, banda=None, latencia=0.0, perda=0.0, corrupcao=0.0, aleatorio=None):
+        self.outra_ponta = None
+        self.callback = None
+        self.banda = banda            # bits/s (None = infinita)
+        self.latencia = latencia
+        self.perda = perda
+        self.corrupcao = corrupcao
+        self.aleatorio = aleatorio or random.Random()
+        self.livre_em = 0.0           # instante em que a linha termina de transmitir
+        self.fila = deque()           # (instante de entrega, dados)
+        self.bytes_enviados = 0
+        self.chamadas_perdidas = 0
+        self.chamadas_corrompidas = 0
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, dados):
+        dados = bytes(dados)
+        self.bytes_enviados += len(dados)
+        loop = asyncio.get_event_loop()
+        agora = loop.time()
+        inicio = max(agora, self.livre_em)
+        self.livre_em = inicio + (len(dados) * 10 / self.banda if self.banda else 0.0)
+
+        if self.perda and self.aleatorio.random() < self.perda:
+            self.chamadas_perdidas += 1
+            return
+        if self.corrupcao and dados and self.aleatorio.random() < self.corrupcao:
+            self.chamadas_corrompidas += 1
+            i = self.aleatorio.randrange(len(dados))
+            dados = dados[:i] + bytes([dados[i] ^ (1 + self.aleatorio.randrange(255))]) + dados[i+1:]
+
+        self.fila.append((self.livre_em + self.latencia, dados))
+        if len(self.fila) == 1:
+            loop.call_at(self.fila[0][0], self._entregar)
+
+    def _entregar(self):
+        loop = asyncio.get_event_loop()
+        agora = loop.time()
+        while self.fila and self.fila[0][0] <= agora:
+            _, dados = self.fila.popleft()
+            if self.outra_ponta.callback:
+                self.outra_ponta.callback(dados)
+        if self.fila:
+            loop.call_at(self.fila[0][0], self._entregar)
+
+    def tamanho_fila_tx(self):
+        """ Bytes que ainda não terminaram de ser transmitidos """
+        if not self.banda:
+            return 0
+        restante = self.livre_em - asyncio.get_event_loop().time()
+        return max(0, int(restante * self.banda / 10))
+
+
+def par_de_linhas(**parametros):
+    """
+    Cria as duas pontas de uma linha serial simulada. Os parâmetros são os
+    de LinhaSerialSimulada e valem para os dois sentidos.
+    """
+    a = LinhaSerialSimulada(**parametros)
+    b = LinhaSerialSimulada(**parametros)
+    a.outra_ponta, b.outra_ponta = b, a
+    return a, b
+
+
+def linhas_paralelas(n, **parametros):
+    """
+    Como par_de_linhas, mas com n linhas em paralelo entre as mesmas duas
+    pontas: retorna duas listas (ou as próprias linhas, se n == 1), no
+    formato aceito por CamadaEnlace.
+    """
+    if n == 1:
+        return par_de_linhas(**parametros)
+    pares = [par_de_linhas(**parametros) for _ in range(n)]
+    return [a for a, _ in pares], [b for _, b in pares]
+
+
+class HostSimulado:
+    """
+    Host com um único enlace (como o Linux ligado à PTY da placa 1) que
+    distribui os segmentos TCP recebidos entre os ClienteTCP pela porta.
+    """
+    def __init__(self, linha, endereco, vizinho, modo=MODO_SLIP, estados=MAX_ESTADOS, mtu=MTU_PADRAO):
+        self.endereco = endereco
+        self.rede = IP(CamadaEnlace({vizinho: linha}, mtus={vizinho: mtu}, modos={vizinho: modo},
+                                    estados=estados))
+        self.rede.definir_endereco_host(endereco)
+        self.rede.definir_tabela_encaminhamento([('0.0.0.0/0', vizinho)])
+        self.rede.registrar_recebedor(self._rdt_rcv)
+        self.clientes = {}
+
+    def _rdt_rcv(self, src_addr, dst_addr, segmento):
+        if calc_checksum(segmento, src_addr, dst_addr) != 0:
+            return
+        src_port, dst_port, seq_no, ack_no, flags, janela, _, _ = read_header(segmento)
+        cliente = self.clientes.get(dst_port)
+        if cliente:
+            payload = segmento[4 * (flags >> 12):]
+            cliente._rdt_rcv(seq_no, ack_no, flags, payload, janela)
+
+
+class ClienteTCP:
+    """
+    Cliente TCP mínimo para gerar carga: janela fixa, ACK imediato e descarte
+    de segmentos fora de ordem. No timeout reenvia só o primeiro segmento não
+    confirmado e, até confirmar tudo o que já tinha enviado, reenvia o
+    seguinte a cada ACK parcial (como o NewReno): o que o receptor guardou
+    fora de ordem não é enviado de novo.
+    """
+    TIMEOUT = 0.3
+
+    def __init__(self, host, porta, servidor, porta_servidor):
+        self.host = host
+        self.porta = porta
+        self.servidor = servidor
+        self.porta_servidor = porta_servidor
+        host.clientes[porta] = self
+        self.loop = asyncio.get_event_loop()
+        isn = random.randint(0, 0xFFFFFFFF)
+        self.seq_nao_ack = isn          # inteiros sem módulo; o módulo é aplicado ao enviar
+        self.seq_a_enviar = isn
+        self.seq_esperado = 0
+        self.dados = bytearray()        # não confirmados, a partir de seq_nao_ack
+        self.janela = 8 * MSS
+        self.mss = min(MSS, host.rede.mtu_rota(servidor) - 40)
+        self.conectado = self.loop.create_future()
+        self.callback = None
+        self._timer = None
+        self.recuperacao = None         # seq_a_enviar no último timeout
+        self.bytes_retransmitidos = 0
+
+    def conectar(self):
+        self.seq_a_enviar = self.seq_nao_ack + 1
+        self._enviar_segmento(self.seq_nao_ack, FLAGS_SYN, opcoes=opcao_mss(self.mss))
+        self._armar_timer()
+        return self.conectado
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, dados):
+        self.dados += dados
+        self._transmitir()
+
+    def _enviar_segmento(self, seq, flags, payload=b'', opcoes=b''):
+        seg = make_segment(self.host.endereco, self.servidor, self.porta, self.porta_servidor,
+                           seq & 0xFFFFFFFF, self.seq_esperado, flags, payload, opcoes=opcoes)
+        self.host.rede.enviar(seg, self.servidor)
+
+    def _transmitir(self):
+        if not self.conectado.done():
+            return
+        deslocamento = self.seq_a_enviar - self.seq_nao_ack
+        limite = min(len(self.dados), self.janela)
+        while deslocamento < limite:
+            n = min(self.mss, limite - deslocamento)
+            self._enviar_segmento(self.seq_a_enviar, FLAGS_ACK,
+                                  bytes(self.dados[deslocamento:deslocamento + n]))
+            self.seq_a_enviar += n
+            deslocamento += n
+        self._armar_timer()
+
+    def _armar_timer(self):
+        if self._timer is None and self.seq_a_enviar != self.seq_nao_ack:
+            self._timer = self.loop.call_later(self.TIMEOUT, self._timeout)
+
+    def _timeout(self):
+        self._timer = None
+        if not self.conectado.done():
+            self._enviar_segmento(self.seq_nao_ack, FLAGS_SYN, opcoes=opcao_mss(self.mss))
+            self._armar_timer()
+            return
+        self.recuperacao = self.seq_a_enviar
+        self._retransmitir_primeiro()
+
+    def _retransmitir_primeiro(self):
+        n = min(self.mss, self.seq_a_enviar - self.seq_nao_ack)
+        self._enviar_segmento(self.seq_nao_ack, FLAGS_ACK, bytes(self.dados[:n]))
+        self.bytes_retransmitidos += n
+        self._armar_timer()
+
+    def _rdt_rcv(self, seq_no, ack_no, flags, payload, janela):
+        if flags & FLAGS_SYN and flags & FLAGS_ACK:
+            if not self.conectado.done():
+                self.seq_esperado = (seq_no + 1) & 0xFFFFFFFF
+                self.seq_nao_ack = self.seq_a_enviar
+                self._timer.cancel()
+                self._timer = None
+                self.conectado.set_result(True)
+            self._enviar_segmento(self.seq_a_enviar, FLAGS_ACK)
+            return
+
+        self.janela = janela
+        if flags & FLAGS_ACK:
+            confirmados = (ack_no - self.seq_nao_ack) & 0xFFFFFFFF
+            if 0 < confirmados <= self.seq_a_enviar - self.seq_nao_ack:
+                del self.dados[:confirmados]
+                self.seq_nao_ack += confirmados
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                if self.recuperacao is not None:
+                    if self.seq_nao_ack < self.recuperacao:
+                        self._retransmitir_primeiro()   # ACK parcial: a próxima lacuna
+                    else:
+                        self.recuperacao = None
+        self._transmitir()
+
+        if payload or flags & FLAGS_FIN:
+            if seq_no == self.seq_esperado:
+                self.seq_esperado = (self.seq_esperado + len(payload)) & 0xFFFFFFFF
+                if flags & FLAGS_FIN:
+                    self.seq_esperado = (self.seq_esperado + 1) & 0xFFFFFFFF
+                if payload and self.callback:
+                    self.callback(self, payload)
+            self._enviar_segmento(self.seq_a_enviar, FLAGS_ACK)
+
+
+def percentis(amostras, ps=(50, 90, 99)):
+    if not amostras:
+        return {p: float('nan') for p in ps}
+    ordenadas = sorted(amostras)
+    return {p: ordenadas[min(len(ordenadas) - 1, len(ordenadas) * p // 100)] for p in ps}
+
+
+def imprimir_resultado(nome, bytes_uteis, parede, cpu, latencias, extra=''):
+    pcts = percentis(latencias)
+    print(f'== {nome}')
+    print(f'   bytes úteis entregues: {bytes_uteis}  tempo: {parede:.3f} s  '
+          f'vazão: {bytes_uteis / parede / 1e3 if parede else 0:.1f} kB/s')
+    if latencias:
+        print(f'   latência p50/p90/p99: ' + ' / '.join(f'{pcts[p] * 1e3:.2f} ms' for p in (50, 90, 99)))
+    print(f'   CPU por byte: {cpu / bytes_uteis * 1e9 if bytes_uteis else 0:.0f} ns')
+    if extra:
+        print(f'   {extra}')
+
+
+def instante():
+    return time.perf_counter(), time.process_time()
+
+
+async def esperar(condicao, prazo):
+    limite = asyncio.get_event_loop().time() + prazo
+    while not condicao() and asyncio.get_event_loop().time() < limite:
+        await asyncio.sleep(0.001)
+
+
+async def bench_encaminhamento(linha, args):
+    """
+    Host (192.168.200.1) -> placa 1 -> placa 2 -> sumidouro no lugar da
+    placa 3 (192.168.200.4): mede o encaminhamento nas placas 1 e 2. Os
+    datagramas levam portas TCP de origem distintas para formar
+    args.fluxos fluxos.
+    """
+    l_host, l_p1_pty = linhas_paralelas(args.paralelas, **linha)
+    l_p1_serial, l_p2_serial2 = linhas_paralelas(args.paralelas, **linha)
+    l_p2_serial1, l_sumidouro = linhas_paralelas(args.paralelas, **linha)
+    placa1.montar_rede(l_p1_pty, l_p1_serial, args.modo, args.estados)
+    placa2.montar_rede(l_p2_serial1, l_p2_serial2, args.modo, args.estados)
+    host = HostSimulado(l_host, '192.168.200.1', '192.168.200.2', args.modo, args.estados)
+
+    loop = asyncio.get_event_loop()
+    latencias = []
+    # Tempo e CPU medidos até a última entrega, não até o fim do prazo
+    ultima_entrega = [None]
+
+    def ao_receber(src_addr, dst_addr, payload):
+        latencias.append(loop.time() - struct.unpack('!d', payload[4:12])[0])
+        ultima_entrega[0] = instante()
+
+    sumidouro = IP(CamadaEnlace({'192.168.200.3': l_sumidouro}, modos={'192.168.200.3': args.modo},
+                                estados=args.estados))
+    sumidouro.definir_endereco_host('192.168.200.4')
+    sumidouro.definir_tabela_encaminhamento([('0.0.0.0/0', '192.168.200.3')])
+    sumidouro.registrar_recebedor(ao_receber)
+
+    enchimento = bytes(max(0, args.tamanho - 12))
+    inicio = instante()
+    for i in range(args.datagramas):
+        cabecalho = struct.pack('!HHd', 50000 + i % args.fluxos, 9, loop.time())
+        host.rede.enviar(cabecalho + enchimento, '192.168.200.4')
+        if i % 32 == 31:
+            await asyncio.sleep(0)
+    await esperar(lambda: len(latencias) >= args.datagramas, args.prazo)
+    fim = ultima_entrega[0] or instante()
+    parede, cpu = fim[0] - inicio[0], fim[1] - inicio[1]
+
+    return ('encaminhamento (2 saltos)', len(latencias) * args.tamanho, parede, cpu,
+            latencias, f'datagramas entregues: {len(latencias)}/{args.datagramas}')
+
+
+async def bench_irc(linha, args):
+    """
+    Host com vários clientes IRC -> placas 1 e 2 -> servidor IRC da placa 3.
+    Todos entram em #bench e um deles envia mensagens ao canal.
+    """
+    l_host, l_p1_pty = linhas_paralelas(args.paralelas, **linha)
+    l_p1_serial, l_p2_serial2 = linhas_paralelas(args.paralelas, **linha)
+    l_p2_serial1, l_p3 = linhas_paralelas(args.paralelas, **linha)
+    placa1.montar_rede(l_p1_pty, l_p1_serial, args.modo, args.estados)
+    placa2.montar_rede(l_p2_serial1, l_p2_serial2, args.modo, args.estados)
+    monitor = None
+    if args.trabalhadores:
+        distribuidor = Distribuidor()
+        await distribuidor.iniciar(args.trabalhadores)
+        monitor = distribuidor.conexao_aceita
+    placa3.montar_servidor(l_p3, monitor, args.modo, args.estados)
+    host = HostSimulado(l_host, '192.168.200.1', '192.168.200.2', args.modo, args.estados)
+
+    loop = asyncio.get_event_loop()
+    recebido = {}
+    latencias = []
+    mensagens = {}
+    ultima_entrega = [None]
+
+    def ao_receber(cliente, dados):
+        buffer = recebido[cliente] + dados
+        *linhas, recebido[cliente] = buffer.split(b'\r\n')
+        for linha_irc in linhas:
+            if b' PRIVMSG #bench :' in linha_irc:
+                mensagens[cliente] += 1
+                latencias.append(loop.time() - float(linha_irc.rsplit(b':', 1)[1]))
+                ultima_entrega[0] = instante()
+            elif b' 366 ' in linha_irc:
+                mensagens[cliente] = 0
+
+    clientes = []
+    for i in range(args.clientes):
+        cliente = ClienteTCP(host, 40000 + i, placa3.nossa_ponta, placa3.porta_tcp)
+        recebido[cliente] = b''
+        cliente.registrar_recebedor(ao_receber)
+        clientes.append(cliente)
+    await asyncio.gather(*(cliente.conectar() for cliente in clientes))
+    for i, cliente in enumerate(clientes):
+        cliente.enviar(b'NICK u%d\r\nJOIN #bench\r\n' % i)
+    await esperar(lambda: len(mensagens) == len(clientes), args.prazo)
+
+    remetente, receptores = clientes[0], clientes[1:]
+    esperado = args.mensagens
+    inicio = instante()
+    for i in range(args.mensagens):
+        remetente.enviar(b'PRIVMSG #bench :%.6f\r\n' % loop.time())
+        await asyncio.sleep(0)
+    await esperar(lambda: all(mensagens.get(c, 0) >= esperado for c in receptores), args.prazo)
+    fim = ultima_entrega[0] or instante()
+    parede, cpu = fim[0] - inicio[0], fim[1] - inicio[1]
+
+    entregues = sum(mensagens.get(c, 0) for c in receptores)
+    tamanho_linha = len(b':u0 PRIVMSG #bench :0000000000.000000\r\n')
+    retransmitidos = sum(c.bytes_retransmitidos for c in clientes)
+    return (f'IRC fan-out ({len(receptores)} receptores)', entregues * tamanho_linha,
+            parede, cpu, latencias,
+            f'mensagens entregues: {entregues}/{esperado * len(receptores)}, '
+            f'bytes retransmitidos pelos clientes: {retransmitidos}')
+
+
+async def bench_perda(linha, args):
+    """
+    Host -> placas 1 e 2 -> receptor TCP (tcp.Servidor) no lugar da placa 3,
+    com perda nas linhas (--perda, 2% se não for dada): um cliente envia
+    --volume bytes duas vezes, com a fila de segmentos fora de ordem do
+    receptor e com ela desligada (limite 0), e compara os bytes
+    retransmitidos.
+    """
+    resultados = []
+    for nome, limite in (('com fila fora de ordem', None), ('sem fila fora de ordem', 0)):
+        # Mesma sequência de perdas nas duas rodadas
+        parametros = dict(linha, perda=args.perda or 0.02, aleatorio=random.Random(args.semente))
+        l_host, l_p1_pty = linhas_paralelas(args.paralelas, **parametros)
+        l_p1_serial, l_p2_serial2 = linhas_paralelas(args.paralelas, **parametros)
+        l_p2_serial1, l_receptor = linhas_paralelas(args.paralelas, **parametros)
+        placa1.montar_rede(l_p1_pty, l_p1_serial, args.modo, args.estados)
+        placa2.montar_rede(l_p2_serial1, l_p2_serial2, args.modo, args.estados)
+        host = HostSimulado(l_host, '192.168.200.1', '192.168.200.2', args.modo, args.estados)
+
+        rede = IP(CamadaEnlace({'192.168.200.3': l_receptor}, modos={'192.168.200.3': args.modo},
+                               estados=args.estados))
+        rede.definir_endereco_host('192.168.200.4')
+        rede.definir_tabela_encaminhamento([('0.0.0.0/0', '192.168.200.3')])
+        servidor = Servidor(rede, 7000)
+        recebido = bytearray()
+        ultima_entrega = [None]
+
+        def ao_receber(conexao, dados):
+            recebido.extend(dados)
+            ultima_entrega[0] = instante()
+
+        def ao_aceitar(conexao):
+            if limite is not None:
+                conexao.fora_de_ordem.limite = limite
+            conexao.registrar_recebedor(ao_receber)
+
+        servidor.registrar_monitor_de_conexoes_aceitas(ao_aceitar)
+        cliente = ClienteTCP(host, 40000, '192.168.200.4', 7000)
+        await cliente.conectar()
+        dados = random.Random(args.semente).randbytes(args.volume)
+        inicio = instante()
+        cliente.enviar(dados)
+        await esperar(lambda: len(recebido) >= len(dados), args.prazo)
+        fim = ultima_entrega[0] or instante()
+        assert recebido == dados[:len(recebido)]
+        servidor.fechar()
+        resultados.append((f'upload com {parametros["perda"]:.0%} de perda, {nome}', len(recebido),
+                           fim[0] - inicio[0], fim[1] - inicio[1], [],
+                           f'bytes entregues: {len(recebido)}/{len(dados)}, '
+                           f'bytes retransmitidos: {cliente.bytes_retransmitidos}'))
+    return resultados
+
+
+async def _carga_de_temporizadores(armar, ociosas, ativas, rodadas):
+    """
+    Arma um temporizador longo (60 s) para cada conexão ociosa e, a cada
+    rodada de 1 ms, rearma o de retransmissão (RTO de 0,2 s) de cada conexão
+    ativa, como a chegada de um ACK. No fim espera os das ativas expirarem.
+    armar(i, atraso, callback) arma ou rearma o temporizador da conexão i.
+    Retorna (rearmes por segundo de CPU, temporizadores expirados).
+    """
+    expirados = []
+    for i in range(ociosas):
+        armar(i, 60.0, expirados.append)
+    ativas = range(ociosas, ociosas + ativas)
+    cpu = 0.0
+    for _ in range(rodadas):
+        inicio = time.process_time()
+        for i in ativas:
+            armar(i, 0.2, expirados.append)
+        cpu += time.process_time() - inicio
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(0.3)
+    return rodadas * len(ativas) / cpu, len(expirados)
+
+
+async def bench_temporizadores(args, ociosas=10000, ativas=1000, rodadas=200):
+    """
+    Temporizadores de ociosas + ativas conexões na RodaDeTemporizadores do
+    tcp.Servidor e, para comparar, um call_later do loop por temporizador
+    (cancelado e recriado a cada rearme).
+    """
+    loop = asyncio.get_running_loop()
+    resultados = []
+
+    roda = RodaDeTemporizadores()
+    temporizadores = {}
+
+    def armar_na_roda(i, atraso, callback):
+        if i not in temporizadores:
+            temporizadores[i] = Temporizador(lambda: callback(i))
+        roda.armar(temporizadores[i], atraso)
+
+    handles = {}
+
+    def armar_no_loop(i, atraso, callback):
+        if i in handles:
+            handles[i].cancel()
+        handles[i] = loop.call_later(atraso, callback, i)
+
+    for nome, armar in (('RodaDeTemporizadores', armar_na_roda), ('loop.call_later', armar_no_loop)):
+        inicio = instante()
+        taxa, expirados = await _carga_de_temporizadores(armar, ociosas, ativas, rodadas)
+        fim = instante()
+        agendados = len(getattr(loop, '_scheduled', ()))
+        resultados.append((f'temporizadores: {ociosas} ociosos + {ativas} ativos, {nome}', 0,
+                           fim[0] - inicio[0], fim[1] - inicio[1], [],
+                           f'rearmes/s de CPU: {taxa:.0f}, expirados: {expirados}/{ativas}, '
+                           f'callbacks na fila do loop: {agendados}'))
+        for handle in handles.values():
+            handle.cancel()
+        for temporizador in temporizadores.values():
+            roda.cancelar(temporizador)
+    return resultados
+
+
+async def bench_ack(linha, args):
+    """
+    Host ligado direto a um tcp.Servidor por um enlace com MTU 576 (MSS de
+    536 dos dois lados) e, para comparar, com MTU 1500: o cliente envia 6
+    segmentos completos e depois mais um. Confere que o servidor confirma a
+    cada dois segmentos completos do MSS da conexão (3 ACKs) e que o
+    segmento avulso é confirmado pelo ACK atrasado.
+    """
+    resultados = []
+    segmentos_tx = registro.contador('tcp.segmentos_tx')
+    for mtu in (576, 1500):
+        l_host, l_servidor = par_de_linhas(**dict(linha, perda=0.0, corrupcao=0.0))
+        host = HostSimulado(l_host, '192.168.200.1', '192.168.200.4', mtu=mtu)
+        rede = IP(CamadaEnlace({'192.168.200.1': l_servidor}, mtus={'192.168.200.1': mtu}))
+        rede.definir_endereco_host('192.168.200.4')
+        rede.definir_tabela_encaminhamento([('0.0.0.0/0', '192.168.200.1')])
+        servidor = Servidor(rede, 7000)
+        recebido = bytearray()
+        servidor.registrar_monitor_de_conexoes_aceitas(
+            lambda conexao: conexao.registrar_recebedor(lambda conexao, dados: recebido.extend(dados)))
+        cliente = ClienteTCP(host, 40000, '192.168.200.4', 7000)
+        await cliente.conectar()
+        await asyncio.sleep(0.1)
+
+        acks = []
+        for n_segmentos in (6, 1):
+            antes = segmentos_tx.valor
+            inicio = instante()
+            cliente.enviar(bytes(n_segmentos * cliente.mss))
+            await esperar(lambda: cliente.seq_nao_ack == cliente.seq_a_enviar, args.prazo)
+            await asyncio.sleep(2 * ATRASO_ACK)
+            acks.append(segmentos_tx.valor - antes)
+        fim = instante()
+        servidor.fechar()
+        assert acks == [3, 1], (mtu, cliente.mss, acks)
+        resultados.append((f'ACK atrasado com MTU {mtu} (MSS {cliente.mss})', len(recebido),
+                           fim[0] - inicio[0], fim[1] - inicio[1], [],
+                           f'ACKs para 6 segmentos completos: {acks[0]}, para 1 segmento: {acks[1]}'))
+    return resultados
+
+
+async def bench_fechamento(linha, args):
+    """
+    Dois clientes ligados direto a um tcp.Servidor. O servidor envia dados
+    aos dois, fecha a primeira conexão e então tenta enviar de novo, direto
+    e por enviar_multicast. Confere que o envio após fechar() lança
+    BrokenPipeError, que enviar_multicast retorna só a conexão fechada e
+    continua com a outra, e que nada chega ao primeiro cliente depois do
+    FIN.
+    """
+    l_host, l_servidor = par_de_linhas(**dict(linha, perda=0.0, corrupcao=0.0))
+    host = HostSimulado(l_host, '192.168.200.1', '192.168.200.4')
+    rede = IP(CamadaEnlace({'192.168.200.1': l_servidor}))
+    rede.definir_endereco_host('192.168.200.4')
+    rede.definir_tabela_encaminhamento([('0.0.0.0/0', '192.168.200.1')])
+    servidor = Servidor(rede, 7000)
+    aceitas = []
+    servidor.registrar_monitor_de_conexoes_aceitas(aceitas.append)
+    recebido = {}
+
+    def ao_receber(cliente, dados):
+        recebido[cliente] += dados
+
+    clientes = []
+    for porta in (40000, 40001):
+        cliente = ClienteTCP(host, porta, '192.168.200.4', 7000)
+        cliente.registrar_recebedor(ao_receber)
+        recebido[cliente] = b''
+        clientes.append(cliente)
+        await cliente.conectar()
+    await esperar(lambda: len(aceitas) == 2, args.prazo)
+    fechada, aberta = sorted(aceitas, key=lambda conexao: conexao.id_conexao[1])
+
+    inicio = instante()
+    enviar_multicast(aceitas, b'antes\r\n')
+    fechada.fechar()
+    try:
+        fechada.enviar(b'depois\r\n')
+        erro = None
+    except BrokenPipeError as e:
+        erro = e
+    falhas = enviar_multicast(aceitas, b'depois\r\n')
+    await esperar(lambda: recebido[clientes[1]] == b'antes\r\ndepois\r\n', args.prazo)
+    await asyncio.sleep(0.1)
+    fim = instante()
+    servidor.fechar()
+
+    assert erro is not None, 'enviar() após fechar() não falhou'
+    assert falhas == [fechada], falhas
+    assert recebido[clientes[0]] == b'antes\r\n', recebido[clientes[0]]
+    assert recebido[clientes[1]] == b'antes\r\ndepois\r\n', recebido[clientes[1]]
+    return [('envio após fechar()', sum(map(len, recebido.values())),
+             fim[0] - inicio[0], fim[1] - inicio[1], [],
+             f'enviar() lançou {type(erro).__name__}; enviar_multicast falhou só na conexão '
+             f'fechada; nada chegou ao cliente depois do FIN')]
+
+
+class ConexaoNula:
+    """
+    Conexão falsa para exercitar só a camada de aplicação da placa 3.
+    """
+    def registrar_recebedor(self, callback):
+        pass
+
+    def enviar(self, dados, soma_dados=None):
+        pass
+
+    def fechar(self):
+        pass
+
+
+class ConexaoGravada(ConexaoNula):
+    """
+    Conexão falsa que guarda as linhas enviadas a ela e permite entregar
+    linhas como se viessem do cliente.
+    """
+    def __init__(self):
+        self.callback = None
+        self.recebido = b''
+        self.fechada = False
+        self.adiar_envio = False
+
+    def registrar_recebedor(self, callback, consumo_manual=False):
+        self.callback = callback
+
+    def enviar(self, dados, soma_dados=None):
+        self.recebido += dados
+
+    def fechar(self):
+        self.fechada = True
+
+    def linhas(self, trecho):
+        return [linha for linha in self.recebido.split(b'\r\n') if trecho in linha]
+
+
+async def bench_trabalhadores(args):
+    """
+    trabalhadores.Distribuidor de ponta a ponta, com dois processos
+    trabalhadores e conexões falsas (sem a rede): NICK/JOIN, PRIVMSG para
+    canais dos dois trabalhadores, troca de apelido (vista uma só vez por
+    quem divide canal) e, depois de matar um trabalhador, confere que as
+    conexões dele foram fechadas, que não sobram eventos pendentes e que os
+    canais do outro trabalhador continuam funcionando. Apelidos e canais são
+    diferentes dos do cenário irc, porque os trabalhadores herdam no fork o
+    estado do placa3 deste processo.
+    """
+    distribuidor = Distribuidor()
+    await distribuidor.iniciar(2)
+    conexoes = [ConexaoGravada() for _ in range(6)]
+    for i, conexao in enumerate(conexoes):
+        distribuidor.conexao_aceita(conexao)
+        conexao.callback(conexao, b'NICK w%d\r\nJOIN #t%d\r\n' % (i, i % 3))
+    await esperar(lambda: all(c.linhas(b' 366 ') for c in conexoes), args.prazo)
+    assert all(c.linhas(b' 366 ') for c in conexoes), 'JOIN sem resposta'
+
+    inicio = instante()
+    for i in range(3):
+        conexoes[i].callback(conexoes[i], b'PRIVMSG #t%d :oi %d\r\n' % (i, i))
+    await esperar(lambda: all(conexoes[i + 3].linhas(b'PRIVMSG') for i in range(3)), args.prazo)
+    for i in range(3):
+        assert conexoes[i + 3].linhas(b'PRIVMSG') == [b':w%d PRIVMSG #t%d :oi %d' % (i, i, i)]
+        assert not conexoes[i].linhas(b'PRIVMSG')
+
+    # NICK vai a todos os trabalhadores; a pilha descarta as respostas repetidas
+    conexoes[1].callback(conexoes[1], b'NICK w1novo\r\n')
+    await esperar(lambda: conexoes[4].linhas(b' NICK '), args.prazo)
+    await asyncio.sleep(0.1)
+    assert conexoes[4].linhas(b' NICK ') == [b':w1 NICK w1novo']
+    assert conexoes[1].linhas(b' NICK ') == [b':w1 NICK w1novo']
+    fim = instante()
+
+    # Quadro de um evento já encerrado é ignorado
+    distribuidor._quadro_recebido(distribuidor.ligacoes[0], CONCLUIDO, 0xFFFFFFFF, (), b'')
+
+    os.kill(multiprocessing.active_children()[0].pid, signal.SIGKILL)
+    await esperar(lambda: not all(ligacao.viva for ligacao in distribuidor.ligacoes), args.prazo)
+    morta, = [ligacao for ligacao in distribuidor.ligacoes if not ligacao.viva]
+    assert not distribuidor.eventos, distribuidor.eventos
+    vivas = [c for c in conexoes if not c.fechada]
+    fechadas = [c for c in conexoes if c.fechada]
+    assert set(distribuidor.ids) == set(vivas)
+    assert all(distribuidor._ligacao(b'%d' % distribuidor.ids[c][0]) is not morta for c in vivas)
+
+    # As conexões restantes se encontram em um canal do trabalhador vivo
+    canal = next(b'#tv%d' % i for i in range(100) if distribuidor._ligacao(b'#tv%d' % i) is not morta)
+    for conexao in vivas:
+        conexao.callback(conexao, b'JOIN ' + canal + b'\r\n')
+    await esperar(lambda: all(c.linhas(b' ' + canal + b' :End of /NAMES') for c in vivas), args.prazo)
+    vivas[0].callback(vivas[0], b'PRIVMSG ' + canal + b' :depois\r\n')
+    await esperar(lambda: all(c.linhas(b':depois') for c in vivas[1:]), args.prazo)
+    assert all(c.linhas(b':depois') for c in vivas[1:])
+
+    return [('trabalhadores: 2 processos, um deles morto no meio', 0,
+             fim[0] - inicio[0], fim[1] - inicio[1], [],
+             f'conexões fechadas com o trabalhador morto: {len(fechadas)}/{len(conexoes)}, '
+             f'eventos pendentes: {len(distribuidor.eventos)}, '
+             f'canal {canal.decode()} no trabalhador vivo entregou a {len(vivas) - 1} membros')]
+
+
+def bench_parser(args):
+    """
+    Entrega ao servidor IRC rajadas de linhas enfileiradas (pipelining),
+    tanto de uma vez só quanto em pedaços do tamanho de um segmento, sem
+    passar pela rede: mede a separação de linhas e o despacho de comandos.
+    """
+    rajada = b'NICK parser\r\nJOIN #parser\r\n' + b''.join(
+        b'PRIVMSG #parser :mensagem %d de uma rajada enfileirada\r\n' % i if i % 4 else b'PING %d\r\n' % i
+        for i in range(args.linhas))
+    resultados = []
+    for nome, tamanho_pedaco in (('rajada inteira', len(rajada)), (f'pedaços de {MSS} bytes', MSS)):
+        conexao = ConexaoNula()
+        placa3.conexao_aceita(conexao)
+        inicio = instante()
+        for i in range(0, len(rajada), tamanho_pedaco):
+            placa3.dados_recebidos(conexao, rajada[i:i + tamanho_pedaco])
+        fim = instante()
+        placa3.dados_recebidos(conexao, b'')
+        resultados.append((f'parser IRC, {args.linhas} linhas, {nome}', len(rajada),
+                           fim[0] - inicio[0], fim[1] - inicio[1], [],
+                           f'linhas por segundo: {args.linhas / (fim[0] - inicio[0]):.0f}'))
+    return resultados
+
+
+class LinhaNula:
+    """
+    Linha serial que só guarda o que foi escrito, para os cenários que medem
+    uma camada isolada.
+    """
+    def __init__(self):
+        self.callback = None
+        self.escrito = []
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, dados):
+        self.escrito.append(dados)
+
+
+def _escapar_byte_a_byte(datagrama):
+    """
+    Codificador SLIP original, byte a byte: referência de bench_slip.
+    """
+    quadro = bytearray(b'\xc0')
+    for byte in datagrama:
+        if byte == 0xC0:
+            quadro += b'\xdb\xdc'
+        elif byte == 0xDB:
+            quadro += b'\xdb\xdd'
+        else:
+            quadro.append(byte)
+    quadro.append(0xC0)
+    return bytes(quadro)
+
+
+def _desescapar_byte_a_byte(dados):
+    """
+    Decodificador SLIP original, byte a byte: referência de bench_slip.
+    """
+    datagramas = []
+    datagrama = bytearray()
+    escapando = False
+    for byte in dados:
+        if escapando:
+            escapando = False
+            if byte == 0xDC:
+                datagrama.append(0xC0)
+            elif byte == 0xDD:
+                datagrama.append(0xDB)
+        elif byte == 0xDB:
+            escapando = True
+        elif byte == 0xC0:
+            if datagrama:
+                datagramas.append(bytes(datagrama))
+            datagrama = bytearray()
+        else:
+            datagrama.append(byte)
+    return datagramas
+
+
+def bench_slip(args):
+    """
+    Codificação SLIP de args.datagramas datagramas aleatórios de vários
+    tamanhos: codificador byte a byte original, Enlace.enviar e
+    Enlace.enviar_lote, conferindo que os três geram os mesmos bytes. Depois
+    decodifica o resultado com o decodificador byte a byte original e com
+    Enlace, conferindo que os datagramas voltam iguais.
+    """
+    aleatorio = random.Random(args.semente)
+    resultados = []
+    for tamanho, nome_caso in ((40, '40 B'), (576, '576 B'), (1500, '1500 B'), (1500, '1500 B, 2/3 escapes')):
+        if 'escapes' in nome_caso:
+            datagramas = [bytes(aleatorio.choice((0xC0, 0xDB, 0x41)) for _ in range(tamanho))
+                          for _ in range(args.datagramas)]
+        else:
+            datagramas = [aleatorio.randbytes(tamanho) for _ in range(args.datagramas)]
+        total = tamanho * len(datagramas)
+
+        inicio = instante()
+        referencia = b''.join(_escapar_byte_a_byte(datagrama) for datagrama in datagramas)
+        fim = instante()
+        resultados.append((f'SLIP byte a byte, {nome_caso}', total, fim[0] - inicio[0], fim[1] - inicio[1], [],
+                           f'quadros por segundo: {len(datagramas) / (fim[0] - inicio[0]):.0f}'))
+
+        linha_serial = LinhaNula()
+        enlace = Enlace(linha_serial)
+        inicio = instante()
+        for datagrama in datagramas:
+            enlace.enviar(datagrama)
+        fim = instante()
+        assert b''.join(linha_serial.escrito) == referencia
+        resultados.append((f'Enlace.enviar, {nome_caso}', total, fim[0] - inicio[0], fim[1] - inicio[1], [],
+                           f'quadros por segundo: {len(datagramas) / (fim[0] - inicio[0]):.0f}'))
+
+        linha_serial = LinhaNula()
+        enlace = Enlace(linha_serial)
+        inicio = instante()
+        for i in range(0, len(datagramas), 8):
+            enlace.enviar_lote(datagramas[i:i + 8])
+        fim = instante()
+        # Entre dois quadros de um lote vão dois END, como em enviar()
+        assert b''.join(linha_serial.escrito) == referencia
+        resultados.append((f'Enlace.enviar_lote (8 por lote), {nome_caso}', total,
+                           fim[0] - inicio[0], fim[1] - inicio[1], [],
+                           f'quadros por segundo: {len(datagramas) / (fim[0] - inicio[0]):.0f}, '
+                           f'escritas na linha: {len(linha_serial.escrito)}'))
+
+        # Decodificação do mesmo fluxo, entregue em pedaços de MSS bytes
+        pedacos = [referencia[i:i + MSS] for i in range(0, len(referencia), MSS)]
+        inicio = instante()
+        decodificados = _desescapar_byte_a_byte(referencia)
+        fim = instante()
+        assert decodificados == datagramas
+        resultados.append((f'SLIP byte a byte (recepção), {nome_caso}', total,
+                           fim[0] - inicio[0], fim[1] - inicio[1], [],
+                           f'quadros por segundo: {len(datagramas) / (fim[0] - inicio[0]):.0f}'))
+
+        recebidos = []
+        enlace = Enlace(LinhaNula())
+        enlace.registrar_recebedor(recebidos.append)
+        inicio = instante()
+        for pedaco in pedacos:
+            enlace.linha_serial.callback(pedaco)
+        fim = instante()
+        assert recebidos == datagramas
+        resultados.append((f'Enlace (recepção, pedaços de {MSS} B), {nome_caso}', total,
+                           fim[0] - inicio[0], fim[1] - inicio[1], [],
+                           f'quadros por segundo: {len(datagramas) / (fim[0] - inicio[0]):.0f}'))
+    return resultados
+
+
+def bench_checksum(args):
+    """
+    Checksum de segmentos TCP de 20 bytes até MSS, com pseudocabeçalho:
+    tcputils.calc_checksum (palavra a palavra) contra checksum.calc_checksum
+    e contra a soma do payload reaproveitada (checksum.montar_segmento com
+    soma_payload, como em enviar_multicast). Confere que os resultados são
+    iguais.
+    """
+    aleatorio = random.Random(args.semente)
+    repeticoes = args.datagramas
+    resultados = []
+    for tamanho in (20, 40, 536, MSS):
+        segmentos = [aleatorio.randbytes(tamanho) for _ in range(64)]
+        esperados = [tcputils.calc_checksum(segmento, '192.168.200.1', '192.168.200.4')
+                     for segmento in segmentos]
+        assert esperados == [checksum.calc_checksum(segmento, '192.168.200.1', '192.168.200.4')
+                             for segmento in segmentos]
+        total = tamanho * repeticoes
+
+        for nome, funcao in (('tcputils.calc_checksum', tcputils.calc_checksum),
+                             ('checksum.calc_checksum', checksum.calc_checksum)):
+            inicio = instante()
+            for i in range(repeticoes):
+                funcao(segmentos[i & 63], '192.168.200.1', '192.168.200.4')
+            fim = instante()
+            resultados.append((f'{nome}, {tamanho} B', total, fim[0] - inicio[0], fim[1] - inicio[1], [],
+                               f'ns por segmento: {(fim[0] - inicio[0]) / repeticoes * 1e9:.0f}'))
+
+        if tamanho > 20:
+            # Cabeçalho de 20 bytes + payload cuja soma já é conhecida
+            cabecalho = bytes(20)
+            payloads = [segmento[20:] for segmento in segmentos]
+            somas = [checksum.soma(payload) for payload in payloads]
+            for i in range(64):
+                segmento = checksum.montar_segmento(cabecalho, payloads[i], '192.168.200.1', '192.168.200.4', somas[i])
+                assert checksum.calc_checksum(segmento, '192.168.200.1', '192.168.200.4') == 0
+            inicio = instante()
+            for i in range(repeticoes):
+                checksum.montar_segmento(cabecalho, payloads[i & 63], '192.168.200.1', '192.168.200.4', somas[i & 63])
+            fim = instante()
+            resultados.append((f'montar_segmento com soma do payload, {tamanho} B', total,
+                               fim[0] - inicio[0], fim[1] - inicio[1], [],
+                               f'ns por segmento: {(fim[0] - inicio[0]) / repeticoes * 1e9:.0f}'))
+    return resultados
+
+
+class RegistradoresGravados:
+    """
+    Espaço de registradores de ZyboSerialDriver sobre o mmap de um arquivo
+    temporário, que além de escrever no mmap guarda a sequência de palavras
+    escritas no registrador de cada porta.
+    """
+    def __init__(self, mm):
+        self.mm = mm
+        self.escritas = {}
+
+    def __getitem__(self, fatia):
+        return self.mm[fatia]
+
+    def __setitem__(self, fatia, palavra):
+        self.mm[fatia] = palavra
+        self.escritas.setdefault(fatia.start // 4, []).extend(struct.unpack('I', palavra))
+
+
+def _uma_rodada(loop):
+    # Executa só os callbacks já agendados no loop (uma iteração)
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+
+
+def bench_driver(args):
+    """
+    Caminho de transmissão de ZyboSerialDriver com um arquivo temporário no
+    lugar de /dev/uio: confere que as palavras saem em ordem no registrador
+    de cada porta, a profundidade da fila a cada rodada e que uma fila maior
+    que lote_tx é drenada em parte por rodada, sem bloquear o loop. Depois
+    mede a drenagem de quadros de 1500 bytes.
+    """
+    aleatorio = random.Random(args.semente)
+    loop = asyncio.SelectorEventLoop(selectors.SelectSelector())   # aceita arquivos comuns
+    asyncio.set_event_loop(loop)
+    with tempfile.NamedTemporaryFile() as arquivo:
+        arquivo.write(struct.pack('i', -1) + bytes(0x1000 - 4))   # fila de recepção vazia
+        arquivo.flush()
+        driver = ZyboSerialDriver(arquivo.name, lote_tx=256)
+        # Um arquivo comum está sempre pronto para leitura: sem irqs aqui
+        loop.remove_reader(driver.fd)
+        registradores = driver.mm = RegistradoresGravados(driver.mm)
+        porta1, porta2 = driver.obter_porta(1), driver.obter_porta(2)
+
+        dados1, dados2 = aleatorio.randbytes(1000), aleatorio.randbytes(300)
+        porta1.enviar(dados1)
+        porta2.enviar(dados2)
+        assert (porta1.tamanho_fila_tx(), porta2.tamanho_fila_tx()) == (1000, 300)
+        assert not registradores.escritas   # nada é escrito dentro de enviar()
+
+        # Rodada 1: no máximo lote_tx bytes por porta; o que foi agendado
+        # depois de enviar() roda antes do fim da drenagem
+        outro_callback = []
+        loop.call_soon(outro_callback.append, driver.tamanho_fila_tx(1))
+        _uma_rodada(loop)
+        assert (porta1.tamanho_fila_tx(), porta2.tamanho_fila_tx()) == (744, 44)
+        assert outro_callback == [1000]
+        assert registradores.escritas == {1: list(dados1[:256]), 2: list(dados2[:256])}
+
+        # Dados enfileirados durante a drenagem vão depois dos anteriores
+        porta2.enviar(b'fim')
+        profundidades = []
+        while driver.tx_agendado:
+            _uma_rodada(loop)
+            profundidades.append((porta1.tamanho_fila_tx(), porta2.tamanho_fila_tx()))
+        assert profundidades == [(488, 0), (232, 0), (0, 0)], profundidades
+        assert registradores.escritas == {1: list(dados1), 2: list(dados2 + b'fim')}
+        # O último byte de cada porta ficou no registrador do arquivo
+        assert registradores.mm[4:8] == struct.pack('I', dados1[-1])
+        assert registradores.mm[8:12] == struct.pack('I', ord('m'))
+
+        # Medida: quadros de 1500 bytes drenados até o fim
+        driver.mm = registradores.mm
+        quadros = [aleatorio.randbytes(1500) for _ in range(max(1, args.datagramas // 20))]
+        inicio = instante()
+        for quadro in quadros:
+            porta1.enviar(quadro)
+        while driver.tx_agendado:
+            _uma_rodada(loop)
+        fim = instante()
+        driver.fechar()
+    loop.close()
+    asyncio.set_event_loop(None)
+    total = 1500 * len(quadros)
+    return [(f'ZyboSerialDriver (arquivo temporário), {len(quadros)} quadros de 1500 B', total,
+             fim[0] - inicio[0], fim[1] - inicio[1], [],
+             f'ordem, profundidade da fila e drenagem parcial conferidas; '
+             f'µs por quadro: {(fim[0] - inicio[0]) / len(quadros) * 1e6:.0f}')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('cenario', nargs='?', default='todos', choices=['encaminhamento', 'irc', 'parser', 'slip', 'checksum', 'driver', 'perda', 'temporizadores', 'ack', 'fechamento', 'trabalhadores', 'todos'])
+    parser.add_argument('--banda', type=float, default=0, help='bits/s por linha (0 = infinita)')
+    parser.add_argument('--latencia', type=float, default=0.0, help='segundos')
+    parser.add_argument('--perda', type=float, default=0.0, help='probabilidade por escrita')
+    parser.add_argument('--corrupcao', type=float, default=0.0, help='probabilidade por escrita')
+    parser.add_argument('--semente', type=int, default=None)
+    parser.add_argument('--modo', default=MODO_SLIP, choices=[MODO_SLIP, MODO_CSLIP, MODO_ADAPTATIVO],
+                        help='modo de todos os enlaces (compressão de cabeçalhos)')
+    parser.add_argument('--estados', type=int, default=MAX_ESTADOS,
+                        help='conexões lembradas pela compressão em cada enlace (máx. 256)')
+    parser.add_argument('--paralelas', type=int, default=1, help='linhas seriais em paralelo em cada enlace')
+    parser.add_argument('--datagramas', type=int, default=2000)
+    parser.add_argument('--fluxos', type=int, default=8, help='fluxos do cenário de encaminhamento')
+    parser.add_argument('--tamanho', type=int, default=1000, help='bytes por datagrama')
+    parser.add_argument('--clientes', type=int, default=20)
+    parser.add_argument('--mensagens', type=int, default=200)
+    parser.add_argument('--trabalhadores', type=int, default=0,
+                        help='processos trabalhadores do IRC (0 = IRC no mesmo processo)')
+    parser.add_argument('--volume', type=int, default=200000, help='bytes enviados no cenário de perda')
+    parser.add_argument('--linhas', type=int, default=20000, help='linhas por rajada do parser')
+    parser.add_argument('--prazo', type=float, default=60.0, help='tempo máximo de cada cenário (s)')
+    args = parser.parse_args()
+
+    random.seed(args.semente)
+    aleatorio = random.Random(args.semente)
+    linha = dict(banda=args.banda or None, latencia=args.latencia, perda=args.perda,
+                 corrupcao=args.corrupcao, aleatorio=aleatorio)
+
+    if args.cenario in ('encaminhamento', 'todos'):
+        imprimir_resultado(*asyncio.run(bench_encaminhamento(linha, args)))
+    if args.cenario in ('irc', 'todos'):
+        # O servidor IRC imprime cada comando; não conta para o resultado
+        with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+            resultado = asyncio.run(bench_irc(linha, args))
+        imprimir_resultado(*resultado)
+    if args.cenario in ('perda', 'todos'):
+        for resultado in asyncio.run(bench_perda(linha, args)):
+            imprimir_resultado(*resultado)
+    if args.cenario in ('temporizadores', 'todos'):
+        for resultado in asyncio.run(bench_temporizadores(args)):
+            imprimir_resultado(*resultado)
+    if args.cenario in ('ack', 'todos'):
+        for resultado in asyncio.run(bench_ack(linha, args)):
+            imprimir_resultado(*resultado)
+    if args.cenario in ('fechamento', 'todos'):
+        for resultado in asyncio.run(bench_fechamento(linha, args)):
+            imprimir_resultado(*resultado)
+    if args.cenario in ('trabalhadores', 'todos'):
+        # Os trabalhadores imprimem cada comando; não conta para o resultado
+        with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+            resultados = asyncio.run(bench_trabalhadores(args))
+        for resultado in resultados:
+            imprimir_resultado(*resultado)
+    if args.cenario in ('parser', 'todos'):
+        with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+            resultados = bench_parser(args)
+        for resultado in resultados:
+            imprimir_resultado(*resultado)
+    if args.cenario in ('slip', 'todos'):
+        for resultado in bench_slip(args):
+            imprimir_resultado(*resultado)
+    if args.cenario in ('checksum', 'todos'):
+        for resultado in bench_checksum(args):
+            imprimir_resultado(*resultado)
+    if args.cenario in ('driver', 'todos'):
+        for resultado in bench_driver(args):
+            imprimir_resultado(*resultado)
+
+
+if __name__ == '__main__':
+    main()
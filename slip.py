@@ -1,16 +1,63 @@
+import time
+from collections import OrderedDict
+from cslip import Compressor, Descompressor, MAX_ESTADOS, TIPO_TCP_COMPRIMIDO, TIPO_TCP_NAO_COMPRIMIDO
+from metricas import registro
+
+_quadros_tx = registro.contador('slip.quadros_tx')
+_quadros_rx = registro.contador('slip.quadros_rx')
+_escapes_tx = registro.contador('slip.escapes_tx')
+_escapes_rx = registro.contador('slip.escapes_rx')
+_escapes_invalidos = registro.contador('slip.escapes_invalidos')
+_erros_escrita = registro.contador('slip.erros_escrita')
+_cslip_comprimidos = registro.contador('slip.cslip_comprimidos')
+_cslip_descartados = registro.contador('slip.cslip_descartados')
+
+# MTU dos enlaces para os quais nenhuma outra foi informada
+MTU_PADRAO = 1500
+
+# Modos de um enlace, com os nomes do slattach -p: SLIP puro, SLIP com
+# compressão de cabeçalhos (RFC 1144) e adaptativo, que começa sem
+# comprimir e passa a comprimir quando recebe um quadro comprimido
+MODO_SLIP = 'slip'
+MODO_CSLIP = 'cslip'
+MODO_ADAPTATIVO = 'adaptive'
+
+# Um enlace com bytes na fila de transmissão e que não transmite nenhum por
+# este tempo (s), ou cuja escrita na linha serial gerou erro há menos que
+# isso, sai do conjunto de enlaces paralelos
+TEMPO_FALHA = 2.0
+
+# Máximo de fluxos lembrados por GrupoDeEnlaces
+MAX_FLUXOS = 4096
+
+
 class CamadaEnlace:
     ignore_checksum = False
 
-    def __init__(self, linhas_seriais):
+    def __init__(self, linhas_seriais, mtus=None, modos=None, estados=MAX_ESTADOS):
         """
         Inicia uma camada de enlace com um ou mais enlaces, cada um conectado
-        a uma linha serial distinta.
+        a uma linha serial distinta. mtus pode dar a MTU de cada enlace, no
+        formato {ip_outra_ponta: mtu}; os demais usam MTU_PADRAO. Da mesma
+        forma, modos pode dar o modo de cada enlace (MODO_SLIP, MODO_CSLIP
+        ou MODO_ADAPTATIVO); os demais usam MODO_SLIP. estados é o número
+        de conexões TCP lembradas pela compressão em cada enlace; as duas
+        pontas precisam usar o mesmo (o Linux usa 16).
+
+        Se várias linhas seriais ligam ao mesmo vizinho, passe uma lista
+        delas no lugar da linha: o tráfego para ele é dividido entre as
+        linhas por um GrupoDeEnlaces.
         """
         self.enlaces = {}
         self.callback = None
         # Constrói um Enlace para cada linha serial
         for ip_outra_ponta, linha_serial in linhas_seriais.items():
-            enlace = Enlace(linha_serial)
+            mtu = (mtus or {}).get(ip_outra_ponta, MTU_PADRAO)
+            modo = (modos or {}).get(ip_outra_ponta, MODO_SLIP)
+            if isinstance(linha_serial, (list, tuple)):
+                enlace = GrupoDeEnlaces([Enlace(linha, mtu, modo, estados) for linha in linha_serial])
+            else:
+                enlace = Enlace(linha_serial, mtu, modo, estados)
             self.enlaces[ip_outra_ponta] = enlace
             enlace.registrar_recebedor(self._callback)
 
@@ -20,18 +67,142 @@ class CamadaEnlace:
         """
         self.callback = callback
 
+    def mtu(self, next_hop):
+        """
+        Retorna a MTU do enlace que alcança next_hop.
+        """
+        return (self.enlaces.get(next_hop) or self._grupo(next_hop)).mtu
+
     def enviar(self, datagrama, next_hop):
         """
         Envia datagrama para next_hop.
         """
         # Encontra o Enlace capaz de alcançar next_hop e envia por ele
-        self.enlaces[next_hop].enviar(datagrama)
+        (self.enlaces.get(next_hop) or self._grupo(next_hop)).enviar(datagrama)
+
+    def enviar_lote(self, datagramas, next_hop):
+        """
+        Envia vários datagramas para next_hop com uma única escrita na linha serial.
+        """
+        (self.enlaces.get(next_hop) or self._grupo(next_hop)).enviar_lote(datagramas)
+
+    def _grupo(self, next_hops):
+        """
+        Rota com vários next_hop (uma tupla de endereços, ver
+        IP.definir_tabela_encaminhamento): cria, na primeira vez, um
+        GrupoDeEnlaces com os enlaces de todos eles.
+        """
+        if not isinstance(next_hops, tuple):
+            raise KeyError(next_hops)
+        enlaces = []
+        for next_hop in next_hops:
+            enlace = self.enlaces[next_hop]
+            enlaces.extend(enlace.enlaces if isinstance(enlace, GrupoDeEnlaces) else [enlace])
+        grupo = self.enlaces[next_hops] = GrupoDeEnlaces(enlaces)
+        return grupo
 
     def _callback(self, datagrama):
         if self.callback:
             self.callback(datagrama)
 
 
+def _chave_de_fluxo(datagrama):
+    """
+    Identifica o fluxo de um datagrama IPv4: endereços, protocolo e, para
+    TCP e UDP, as portas. Fragmentos ficam sem as portas (só o primeiro as
+    tem), para que todos os de um datagrama sigam pelo mesmo enlace.
+    """
+    if datagrama[9] in (6, 17) and not (datagrama[6] & 0x3f or datagrama[7]):
+        ihl = 4 * (datagrama[0] & 0xf)
+        return bytes(datagrama[12:20]) + datagrama[ihl:ihl+4] + datagrama[9:10]
+    return bytes(datagrama[12:20]) + datagrama[9:10]
+
+
+class GrupoDeEnlaces:
+    """
+    Enlaces paralelos usados como um só: mesma interface de Enlace, com a
+    menor MTU entre eles.
+
+    Cada fluxo (ver _chave_de_fluxo) fica preso a um enlace enquanto houver
+    datagramas seus na fila de transmissão desse enlace, o que mantém os
+    segmentos TCP em ordem. Com a fila vazia, tudo o que o fluxo enviou já
+    saiu da linha, e o próximo datagrama pode ir para o enlace de menor
+    fila sem risco de ultrapassar os anteriores. Empates são decididos pelo
+    hash do fluxo, espalhando fluxos entre linhas ociosas (e entre linhas
+    que não informam a fila, como a PTY).
+
+    Enlaces em falha (ver Enlace.ativo) não recebem fluxos; se todos
+    estiverem em falha, usa-se todos. Uma escrita que falha é refeita pelos
+    enlaces que ainda não falharam nesse envio; o erro só é lançado se
+    nenhum deles aceitar os dados. Acima de MAX_FLUXOS fluxos lembrados,
+    os usados há mais tempo são esquecidos.
+    """
+    def __init__(self, enlaces):
+        self.enlaces = list(enlaces)
+        self.mtu = min(enlace.mtu for enlace in self.enlaces)
+        self.fluxos = OrderedDict()    # chave do fluxo -> Enlace, do uso mais antigo ao mais recente
+
+    def registrar_recebedor(self, callback):
+        for enlace in self.enlaces:
+            enlace.registrar_recebedor(callback)
+
+    def _escolher(self, datagrama, agora, falhos=()):
+        chave = _chave_de_fluxo(datagrama)
+        enlace = self.fluxos.get(chave)
+        if enlace is not None:
+            self.fluxos.move_to_end(chave)
+            if enlace.fila_tx() and enlace.ativo(agora) and enlace not in falhos:
+                return enlace
+        elif len(self.fluxos) >= MAX_FLUXOS:
+            self.fluxos.popitem(last=False)
+
+        candidatos = [enlace for enlace in self.enlaces if enlace not in falhos]
+        ativos = [enlace for enlace in candidatos if enlace.ativo(agora)] or candidatos
+        inicio = hash(chave) % len(ativos)
+        enlace = min(ativos[inicio:] + ativos[:inicio], key=Enlace.fila_tx)
+        self.fluxos[chave] = enlace
+        return enlace
+
+    def enviar(self, datagrama):
+        agora = time.monotonic()
+        falhos = set()
+        while True:
+            enlace = self._escolher(datagrama, agora, falhos)
+            try:
+                enlace.enviar(datagrama)
+                return
+            except OSError:
+                # O enlace agora está em falha: tenta de novo por outro
+                falhos.add(enlace)
+                if len(falhos) == len(self.enlaces):
+                    raise
+
+    def _distribuir(self, datagramas, agora, falhos):
+        por_enlace = {}
+        for datagrama in datagramas:
+            por_enlace.setdefault(self._escolher(datagrama, agora, falhos), []).append(datagrama)
+        return por_enlace
+
+    def enviar_lote(self, datagramas):
+        agora = time.monotonic()
+        falhos = set()
+        pendentes = datagramas
+        while pendentes:
+            nao_enviados = []
+            for enlace, lote in self._distribuir(pendentes, agora, falhos).items():
+                try:
+                    enlace.enviar_lote(lote)
+                except OSError as e:
+                    # O enlace agora está em falha: o lote vai pelos outros
+                    # na próxima volta, e os demais lotes seguem
+                    falhos.add(enlace)
+                    nao_enviados += lote
+                    erro = e
+            if nao_enviados and len(falhos) == len(self.enlaces):
+                raise erro
+            pendentes = nao_enviados
+
+
 class Enlace:
     # Constantes SLIP conforme RFC 1055
     END = b'\xc0'    # Delimitador de quadro
@@ -39,13 +210,27 @@ class Enlace:
     ESC_END = b'\xdc' # Sequência de escape para o byte 0xC0
     ESC_ESC = b'\xdd' # Sequência de escape para o byte 0xDB
     
-    def __init__(self, linha_serial):
+    def __init__(self, linha_serial, mtu=MTU_PADRAO, modo=MODO_SLIP, estados=MAX_ESTADOS):
         self.linha_serial = linha_serial
+        self.mtu = mtu    # maior datagrama que a camada de rede pode enviar por aqui
         self.linha_serial.registrar_recebedor(self.__raw_recv)
         self.callback = None
-        self.buffer = bytearray()  # Buffer para armazenar dados brutos recebidos
         self.datagrama = bytearray() # Buffer para o datagrama que está sendo decodificado
         self.escapando = False  # Flag para indicar que o byte anterior foi 0xDB
+        self.quadro_invalido = False  # Houve escape inválido no quadro atual
+        # Compressão de cabeçalhos TCP/IP (RFC 1144), nos modos cslip e adaptive
+        if modo not in (MODO_SLIP, MODO_CSLIP, MODO_ADAPTATIVO):
+            raise ValueError('modo de enlace desconhecido: %r' % (modo,))
+        self.modo = modo
+        self.comprimindo = modo == MODO_CSLIP
+        self.compressor = Compressor(estados) if modo != MODO_SLIP else None
+        self.descompressor = Descompressor(estados) if modo != MODO_SLIP else None
+        # Para detectar falhas quando usado em um GrupoDeEnlaces
+        self._tamanho_fila_tx = getattr(linha_serial, 'tamanho_fila_tx', None)
+        self.bytes_tx = 0       # bytes entregues à linha serial
+        self._drenado = 0       # bytes_tx - fila_tx() na última verificação
+        self._progresso_em = None
+        self.erro_em = None     # instante do último erro de escrita
 
     def registrar_recebedor(self, callback):
         self.callback = callback
@@ -54,81 +239,209 @@ class Enlace:
         """
         Passo 1 & 2: Delimita o quadro com 0xC0 e aplica sequências de escape.
         """
-        quadro = bytearray()
-        quadro.extend(self.END)  # Delimitador inicial (0xC0)
-        
-        for byte in datagrama:
-            if byte == 0xC0:
-                # Escapa 0xC0 com 0xDB 0xDC
-                quadro.extend(self.ESC)
-                quadro.extend(self.ESC_END)
-            elif byte == 0xDB:
-                # Escapa 0xDB com 0xDB 0xDD
-                quadro.extend(self.ESC)
-                quadro.extend(self.ESC_ESC)
-            else:
-                quadro.append(byte)
-                
-        quadro.extend(self.END)  # Delimitador final (0xC0)
-        self.linha_serial.enviar(bytes(quadro))
+        if self.comprimindo:
+            datagrama = self._comprimir(datagrama)
+        quadro = self._escapar(datagrama)
+        _quadros_tx.incrementar()
+        _escapes_tx.incrementar(len(quadro) - len(datagrama))  # cada escape acrescenta um byte
+        self._escrever(b''.join((self.END, quadro, self.END)))
+
+    def enviar_lote(self, datagramas):
+        """
+        Delimita vários datagramas em um único buffer e o entrega à linha
+        serial com uma só chamada. Os bytes gerados são os mesmos de chamar
+        enviar() para cada datagrama, na mesma ordem.
+        """
+        if self.comprimindo:
+            datagramas = [self._comprimir(datagrama) for datagrama in datagramas]
+        else:
+            datagramas = list(datagramas)
+        quadros = [self._escapar(datagrama) for datagrama in datagramas]
+        if not quadros:
+            return
+        _quadros_tx.incrementar(len(quadros))
+        _escapes_tx.incrementar(sum(map(len, quadros)) - sum(map(len, datagramas)))
+        separador = self.END + self.END  # Fim de um quadro e início do próximo
+        self._escrever(b''.join((self.END, separador.join(quadros), self.END)))
+
+    def _comprimir(self, datagrama):
+        quadro = self.compressor.comprimir(datagrama)
+        if quadro[0] & TIPO_TCP_COMPRIMIDO:
+            _cslip_comprimidos.incrementar()
+        return quadro
+
+    def _descomprimir(self, quadro):
+        """
+        Retorna o datagrama IP correspondente ao quadro recebido, ou None se
+        ele deve ser descartado.
+        """
+        if self.quadro_invalido:
+            # Não se sabe o que foi perdido: o descompressor passa a
+            # descartar quadros até receber um com a conexão explícita
+            self.descompressor.erro()
+            _cslip_descartados.incrementar()
+            return None
+        if quadro[0] >= TIPO_TCP_NAO_COMPRIMIDO and not self.comprimindo:
+            # Modo adaptativo: o outro lado comprime, então este também pode
+            self.comprimindo = True
+        datagrama = self.descompressor.descomprimir(quadro)
+        if datagrama is None:
+            _cslip_descartados.incrementar()
+        return datagrama
+
+    def _escrever(self, dados):
+        self.bytes_tx += len(dados)
+        try:
+            self.linha_serial.enviar(dados)
+        except OSError:
+            self.erro_em = time.monotonic()
+            _erros_escrita.incrementar()
+            raise
+
+    def fila_tx(self):
+        """
+        Bytes já entregues à linha serial que ainda não foram transmitidos
+        (0 se a linha serial não informa).
+        """
+        return self._tamanho_fila_tx() if self._tamanho_fila_tx else 0
+
+    def ativo(self, agora):
+        """
+        Falso se a última escrita gerou erro há menos de TEMPO_FALHA
+        segundos, ou se há bytes na fila de transmissão e nenhum foi
+        transmitido nos últimos TEMPO_FALHA segundos.
+        """
+        if self.erro_em is not None:
+            if agora - self.erro_em < TEMPO_FALHA:
+                return False
+            self.erro_em = None
+        fila = self.fila_tx()
+        if not fila:
+            self._progresso_em = None
+            return True
+        drenado = self.bytes_tx - fila
+        if self._progresso_em is None or drenado != self._drenado:
+            self._drenado = drenado
+            self._progresso_em = agora
+            return True
+        return agora - self._progresso_em < TEMPO_FALHA
+
+    @classmethod
+    def _escapar(cls, datagrama):
+        """
+        Aplica as sequências de escape sobre o buffer inteiro de uma vez.
+        O 0xDB precisa ser escapado antes do 0xC0, senão os 0xDB introduzidos
+        pelo escape do 0xC0 seriam escapados novamente.
+        """
+        if not isinstance(datagrama, (bytes, bytearray)):
+            datagrama = bytes(datagrama)
+        return datagrama.replace(cls.ESC, cls.ESC + cls.ESC_ESC) \
+                        .replace(cls.END, cls.ESC + cls.ESC_END)
+
+    # Sequências de escape completas
+    _ESC_END = ESC + ESC_END
+    _ESC_ESC = ESC + ESC_ESC
+
+    # Byte que segue um 0xDB -> byte decodificado (outros valores são descartados)
+    _DESESCAPE = {0xDC: 0xC0, 0xDD: 0xDB}
 
     def __raw_recv(self, dados):
         """
         Passo 3, 4 & 5: Recebe e processa quadros SLIP, tratando escapes e quadros quebrados.
+
+        Em vez de percorrer os dados byte a byte, procura os delimitadores e
+        escapes com buscas sobre o buffer inteiro e copia os trechos entre eles
+        de uma só vez. Quadros incompletos e um escape pendente continuam na
+        próxima chamada.
         """
-        self.buffer.extend(dados)  # Adiciona dados recebidos ao buffer
-        
+        if not isinstance(dados, (bytes, bytearray)):
+            dados = bytes(dados)
+        visao = memoryview(dados)
+        datagrama = self.datagrama
+        n = len(dados)
         i = 0
-        while i < len(self.buffer):
-            byte = self.buffer[i]
-            
+
+        # --- Escape que ficou pendente na chamada anterior (Passo 4) ---
+        if self.escapando and n:
+            self.escapando = False
+            _escapes_rx.incrementar()
+            byte = self._DESESCAPE.get(dados[0])
+            if byte is not None:
+                datagrama.append(byte)
+            else:
+                _escapes_invalidos.incrementar()
+                self.quadro_invalido = True
+            i = 1
+
+        # O próximo END só é procurado de novo depois que i passa dele, e não
+        # a cada escape, para que o quadro seja percorrido uma única vez
+        fim = dados.find(self.END, i)
+        rapido = True
+        while i < n:
+            if 0 <= fim < i:
+                fim = dados.find(self.END, i)
+            limite = n if fim < 0 else fim
+
             # --- Lógica de Decodificação e Escape (Passo 4) ---
-            if self.escapando:
-                self.escapando = False
-                
-                if byte == 0xDC:  # ESC_END (0xDC) -> Decodifica para 0xC0
-                    self.datagrama.append(0xC0)
-                elif byte == 0xDD:  # ESC_ESC (0xDD) -> Decodifica para 0xDB
-                    self.datagrama.append(0xDB)
-                
-                i += 1
-                continue
-            
-            # --- Lógica de Controle (0xDB e 0xC0) ---
-            if byte == 0xDB:
-                # Início de uma sequência de escape (ESC)
-                self.escapando = True
-                i += 1
-                continue
-            
-            if byte == 0xC0:
-                # Delimitador de quadro (END)
-                
-                # Passo 5: Limpeza do datagrama em caso de erro na camada superior
-                if self.datagrama:  # Descarta datagramas vazios (Passo 3)
-                    try:
-                        if self.callback:
-                            self.callback(bytes(self.datagrama))
-                    except:
-                        # Ignora a exceção, mas mostra na tela
-                        import traceback
-                        traceback.print_exc()
-                    finally:
-                        # Limpa o datagrama
-                        self.datagrama = bytearray()
+            esc = dados.find(self.ESC, i, limite)
+            if esc >= 0:
+                datagrama += visao[i:esc]
+                # Caso comum: todo 0xDB do trecho até o END é seguido de 0xDC
+                # ou 0xDD. Então nenhum 0xDB é o segundo byte de um escape e
+                # dois replace() desfazem todos os escapes do trecho de uma vez
+                # (um 0xDB no fim dos dados é um escape cortado: fica pendente)
+                cortado = limite == n and dados[n - 1] == 0xDB
+                trecho = dados[esc:limite - cortado]
+                n_escapes = trecho.count(self.ESC)
+                if rapido and trecho.count(self._ESC_END) + trecho.count(self._ESC_ESC) == n_escapes:
+                    datagrama += trecho.replace(self._ESC_END, self.END).replace(self._ESC_ESC, self.ESC)
+                    _escapes_rx.incrementar(n_escapes)
+                    i = limite - cortado
+                    if cortado:
+                        self.escapando = True
+                        break
+                    continue
+                # Há escape inválido: o resto destes dados vai um escape de cada vez
+                rapido = False
+                if esc + 1 == n:
+                    # O byte escapado só chegará na próxima chamada
+                    self.escapando = True
+                    break
+                # O byte após o 0xDB é sempre consumido, mesmo que seja 0xC0
+                _escapes_rx.incrementar()
+                byte = self._DESESCAPE.get(dados[esc + 1])
+                if byte is not None:
+                    datagrama.append(byte)
                 else:
-                    # Datagrama vazio
-                    self.datagrama = bytearray()
-                
-                self.escapando = False # Limpa o estado de escape
-                i += 1
+                    _escapes_invalidos.incrementar()
+                    self.quadro_invalido = True
+                i = esc + 2
                 continue
-            
+
             # --- Lógica de Dados Normais ---
-            # Byte normal (não é escape nem delimitador)
-            self.datagrama.append(byte)
-            i += 1
-        
-        # --- Lógica de Limpeza do Buffer Bruto (Passo 3) ---
-        # Remove do buffer todos os bytes que foram processados.
-        self.buffer = self.buffer[i:]
\ No newline at end of file
+            datagrama += visao[i:limite]
+            if fim < 0:
+                break
+
+            # --- Delimitador de quadro (END) ---
+            # Passo 5: Limpeza do datagrama em caso de erro na camada superior
+            if datagrama:  # Descarta datagramas vazios (Passo 3)
+                _quadros_rx.incrementar()
+                try:
+                    quadro = bytes(datagrama)
+                    if self.descompressor is not None:
+                        quadro = self._descomprimir(quadro)
+                    if self.callback and quadro is not None:
+                        self.callback(quadro)
+                except:
+                    # Ignora a exceção, mas mostra na tela
+                    import traceback
+                    traceback.print_exc()
+                finally:
+                    # Limpa o datagrama
+                    datagrama.clear()
+            elif self.quadro_invalido and self.descompressor is not None:
+                # Quadro só com escapes inválidos: também conta como erro
+                self.descompressor.erro()
+            self.quadro_invalido = False
+            i = fim + 1
@@ -1,43 +1,377 @@
 import asyncio
+import math
 import random
 import time
+import traceback
+from collections import deque
+import struct
 from tcputils import (
     FLAGS_SYN, FLAGS_ACK, FLAGS_FIN, MSS,
-    read_header, calc_checksum, fix_checksum, make_header
+    read_header
 )
+from checksum import calc_checksum, montar_segmento, soma
+from metricas import registro
 
-DEBUG = True
+DEBUG = False
+
+_segmentos_rx = registro.contador('tcp.segmentos_rx')
+_segmentos_tx = registro.contador('tcp.segmentos_tx')
+_checksum_invalido = registro.contador('tcp.checksum_invalido')
+_retransmissoes = registro.contador('tcp.retransmissoes')
+_rtt = registro.histograma('tcp.rtt', [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0])
+
+# Tempo máximo (em segundos) que um ACK pode ser atrasado à espera de mais
+# dados ou de um segmento de resposta que o leve junto
+ATRASO_ACK = 0.04
+
+# Tamanho do buffer de recepção de cada conexão, que é a janela anunciada
+# quando a aplicação está em dia com os dados recebidos
+JANELA_RECEPCAO = 8*MSS
+
+# MSS assumido quando o SYN não traz a opção MSS (RFC 9293, 3.7.1). Com a
+# opção, vale o menor entre ela, a MTU da rota menos 40 e tcputils.MSS.
+MSS_PADRAO = 536
 
 def debug_print(msg):
     if DEBUG:
         print(f"[TCP] {msg}")
 
-def make_segment(src_addr, dst_addr, src_port, dst_port, seq_no, ack_no, flags, payload=b''):
-    header = make_header(src_port, dst_port, seq_no, ack_no, flags)
-    return fix_checksum(header + payload, src_addr, dst_addr)
+def make_segment(src_addr, dst_addr, src_port, dst_port, seq_no, ack_no, flags, payload=b'',
+                 janela=JANELA_RECEPCAO, soma_payload=None, opcoes=b''):
+    # Mesmo formato de tcputils.make_header, mas com a janela anunciada
+    # variável e opções (tamanho múltiplo de 4)
+    header = struct.pack('!HHIIHHHH', src_port, dst_port, seq_no, ack_no,
+                         ((5 + len(opcoes) // 4) << 12) | flags, janela, 0, 0) + opcoes
+    return montar_segmento(header, payload, src_addr, dst_addr, soma_payload)
+
+def opcao_mss(mss):
+    return struct.pack('!BBH', 2, 4, mss)
+
+def ler_opcao_mss(segment):
+    """
+    Retorna o valor da opção MSS do cabeçalho TCP, ou None se não houver.
+    """
+    fim = 4 * (segment[12] >> 4)
+    i = 20
+    while i < fim:
+        tipo = segment[i]
+        if tipo == 0:       # fim da lista de opções
+            break
+        if tipo == 1:       # NOP
+            i += 1
+            continue
+        if i + 1 >= fim or segment[i + 1] < 2:
+            break
+        if tipo == 2 and segment[i + 1] == 4 and i + 4 <= fim:
+            return struct.unpack_from('!H', segment, i + 2)[0]
+        i += segment[i + 1]
+    return None
+
+def enviar_multicast(conexoes, dados):
+    """
+    Envia os mesmos dados por várias conexões (por exemplo, para todos os
+    membros de um canal). A soma complemento-de-um dos dados é calculada uma
+    única vez e todas as conexões guardam o mesmo objeto bytes, sem cópias;
+    cada segmento que levar a mensagem inteira só soma o próprio cabeçalho.
+
+    Uma conexão que falhar (já fechada, ou com o buffer de envio cheio) não
+    impede a entrega às demais; retorna a lista das conexões que falharam.
+    """
+    dados = bytes(dados)
+    soma_dados = soma(dados)
+    falhas = []
+    for conexao in conexoes:
+        try:
+            conexao.enviar(dados, soma_dados)
+        except (OSError, BufferError):
+            falhas.append(conexao)
+    return falhas
+
+class BufferDeEnvio:
+    """
+    Buffer de envio de uma conexão, formado por duas filas de memoryviews:
+    os dados ainda não enviados (pedaços passados a Conexao.enviar) e os
+    payloads dos segmentos já enviados e ainda não confirmados. Segmentar,
+    retransmitir e liberar bytes confirmados não copiam o restante do buffer.
+
+    Cada pedaço não enviado pode ter a soma do checksum já calculada (em
+    somas, alinhada com nao_enviados), que é aproveitada se o pedaço sair
+    inteiro em um segmento.
+    """
+    def __init__(self, limite=None):
+        self.nao_enviados = deque()
+        self.somas = deque()
+        self.em_voo = deque()
+        self.bytes_nao_enviados = 0
+        self.bytes_em_voo = 0
+        self.limite = limite    # máximo de bytes guardados (None = sem limite)
+
+    def __len__(self):
+        return self.bytes_nao_enviados + self.bytes_em_voo
+
+    def adicionar(self, dados, soma_dados=None):
+        if self.limite is not None and len(self) + len(dados) > self.limite:
+            raise BufferError('buffer de envio cheio')
+        if not isinstance(dados, bytes):
+            dados = bytes(dados)   # o chamador pode alterar os dados depois
+        self.nao_enviados.append(memoryview(dados))
+        self.somas.append(soma_dados)
+        self.bytes_nao_enviados += len(dados)
+
+    def proximo_segmento(self, tamanho):
+        """
+        Retira até `tamanho` bytes dos dados não enviados e os guarda como
+        payload de um segmento em voo. Só copia se o segmento juntar vários
+        pedaços.
+
+        Retorna (payload, soma), onde soma é a soma do checksum do payload,
+        se já for conhecida, ou None.
+        """
+        primeiro = self.nao_enviados[0]
+        soma_payload = None
+        if len(primeiro) >= tamanho:
+            payload = primeiro[:tamanho]
+            if len(primeiro) == tamanho:
+                self.nao_enviados.popleft()
+                soma_payload = self.somas.popleft()
+            else:
+                self.nao_enviados[0] = primeiro[tamanho:]
+                self.somas[0] = None
+        else:
+            partes = []
+            while tamanho and self.nao_enviados:
+                pedaco = self.nao_enviados.popleft()
+                self.somas.popleft()
+                if len(pedaco) > tamanho:
+                    self.nao_enviados.appendleft(pedaco[tamanho:])
+                    self.somas.appendleft(None)
+                    pedaco = pedaco[:tamanho]
+                partes.append(pedaco)
+                tamanho -= len(pedaco)
+            payload = memoryview(b''.join(partes))
+        self.bytes_nao_enviados -= len(payload)
+        self.em_voo.append(payload)
+        self.bytes_em_voo += len(payload)
+        return payload, soma_payload
+
+    def primeiro_em_voo(self):
+        return self.em_voo[0] if self.em_voo else None
+
+    def liberar(self, n):
+        """
+        Descarta os n primeiros bytes em voo, que foram confirmados.
+        """
+        n = min(n, self.bytes_em_voo)
+        self.bytes_em_voo -= n
+        while n:
+            payload = self.em_voo[0]
+            if len(payload) <= n:
+                self.em_voo.popleft()
+                n -= len(payload)
+            else:
+                self.em_voo[0] = payload[n:]
+                n = 0
+
+
+class FilaForaDeOrdem:
+    """
+    Dados recebidos fora de ordem, guardados como intervalos disjuntos
+    [(seq, dados)] em ordem de número de sequência. Intervalos sobrepostos ou
+    adjacentes são unidos, de modo que, quando a lacuna anterior é preenchida,
+    todo o trecho contíguo sai de uma vez.
+    """
+    def __init__(self, limite=JANELA_RECEPCAO):
+        self.intervalos = []
+        self.tamanho = 0
+        self.limite = limite    # máximo de bytes guardados (a janela que anunciamos)
+
+    def inserir(self, seq, dados, seq_esperado):
+        """
+        Guarda `dados`, que começam em `seq`, à frente de `seq_esperado`. Os
+        dados são descartados se, depois de unidos aos intervalos já guardados
+        (sem contar de novo os bytes repetidos), estourarem o limite de memória.
+        """
+        ini = (seq - seq_esperado) & 0xFFFFFFFF
+        if not dados or ini >= 0x80000000:
+            return
+        fim = ini + len(dados)
+        restantes = []
+        for seq_i, dados_i in self.intervalos:
+            ini_i = (seq_i - seq_esperado) & 0xFFFFFFFF
+            fim_i = ini_i + len(dados_i)
+            if fim_i < ini or ini_i > fim:
+                restantes.append((ini_i, dados_i))
+                continue
+            # Sobreposto ou adjacente: une os dois intervalos
+            if ini_i < ini:
+                dados = dados_i[:ini - ini_i] + dados
+                ini = ini_i
+            if fim_i > fim:
+                dados = dados + dados_i[fim - ini_i:]
+                fim = fim_i
+        restantes.append((ini, bytes(dados)))
+        tamanho = sum(len(dados_i) for _, dados_i in restantes)
+        if tamanho > self.limite:
+            return
+        restantes.sort(key=lambda intervalo: intervalo[0])
+        self.intervalos = [((seq_esperado + ini_i) & 0xFFFFFFFF, dados_i)
+                           for ini_i, dados_i in restantes]
+        self.tamanho = tamanho
+
+    def retirar(self, seq_esperado):
+        """
+        Retira e retorna os dados guardados que começam em `seq_esperado`
+        (ou antes dele), descartando o trecho já recebido. Retorna None se
+        ainda houver uma lacuna.
+        """
+        while self.intervalos:
+            seq_i, dados_i = self.intervalos[0]
+            passado = (seq_esperado - seq_i) & 0xFFFFFFFF
+            if passado >= 0x80000000:
+                return None   # o primeiro intervalo ainda está à frente
+            del self.intervalos[0]
+            self.tamanho -= len(dados_i)
+            if passado < len(dados_i):
+                return dados_i[passado:]
+        return None
+
+
+class Temporizador:
+    """
+    Um prazo armado em uma RodaDeTemporizadores. O mesmo objeto é reaproveitado
+    a cada vez que o temporizador é armado de novo.
+    """
+    __slots__ = ('callback', 'prazo', 'slot')
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.prazo = None   # tick em que o temporizador expira
+        self.slot = None    # conjunto da roda em que está (None = desarmado)
+
+    @property
+    def ativo(self):
+        return self.slot is not None
+
+
+class RodaDeTemporizadores:
+    """
+    Roda de temporizadores com hash (Varghese & Lauck): o tempo é dividido em
+    ticks de `resolucao` segundos e cada temporizador fica no slot
+    prazo % n_slots. Armar, rearmar e cancelar custam O(1); prazos mais
+    distantes que uma volta da roda ficam no slot até a volta certa.
+
+    Um único callback do loop (call_at) avança a roda, e só enquanto houver
+    temporizadores armados.
+    """
+    def __init__(self, resolucao=0.01, n_slots=512):
+        self.resolucao = resolucao
+        self.slots = [set() for _ in range(n_slots)]
+        self.armados = 0
+        self.loop = None
+        self.ultimo_tick = None
+        self._handle = None
+
+    def armar(self, temporizador, atraso):
+        """
+        Arma (ou rearma) o temporizador para daqui a `atraso` segundos.
+        Retorna False se não houver loop rodando.
+        """
+        if self.loop is None:
+            try:
+                self.loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return False
+        agora = self.loop.time()
+        if self.ultimo_tick is None:
+            self.ultimo_tick = int(agora / self.resolucao)
+        prazo = max(math.ceil((agora + atraso) / self.resolucao), self.ultimo_tick + 1)
+        self.cancelar(temporizador)
+        temporizador.prazo = prazo
+        temporizador.slot = self.slots[prazo % len(self.slots)]
+        temporizador.slot.add(temporizador)
+        self.armados += 1
+        if self._handle is None:
+            self._agendar_tick()
+        return True
+
+    def cancelar(self, temporizador):
+        if temporizador.slot is not None:
+            temporizador.slot.discard(temporizador)
+            temporizador.slot = None
+            self.armados -= 1
+
+    def _agendar_tick(self):
+        self._handle = self.loop.call_at((self.ultimo_tick + 1) * self.resolucao, self._tick)
+
+    def _tick(self):
+        self._handle = None
+        agora = int(self.loop.time() / self.resolucao)
+        n_slots = len(self.slots)
+        # Processa os slots dos ticks que passaram desde a última vez
+        # (no máximo uma volta inteira, se o loop tiver atrasado muito)
+        ticks = range(self.ultimo_tick + 1, agora + 1)
+        if len(ticks) > n_slots:
+            ticks = range(agora - n_slots + 1, agora + 1)
+        self.ultimo_tick = agora
+        for tick in ticks:
+            slot = self.slots[tick % n_slots]
+            if not slot:
+                continue
+            for temporizador in [t for t in slot if t.prazo <= agora]:
+                self.cancelar(temporizador)
+                try:
+                    temporizador.callback()
+                except:
+                    traceback.print_exc()
+        if self.armados and self._handle is None:
+            self._agendar_tick()
+
 
 class Servidor:
-    def __init__(self, rede, porta):
+    def __init__(self, rede, porta, limite_buffer_envio=None):
         self.rede = rede
         self.porta = porta
+        self.limite_buffer_envio = limite_buffer_envio
+        # Temporizadores de todas as conexões (retransmissão, ACK atrasado, sonda)
+        self.temporizadores = RodaDeTemporizadores()
         self.conexoes = {}
         self.callback = None
         self.rede.registrar_recebedor(self._rdt_rcv)
-        debug_print(f"Servidor iniciado na porta {porta}")
+        registro.registrar_coletor(self._metricas)
+        if DEBUG: debug_print(f"Servidor iniciado na porta {porta}")
 
     def registrar_monitor_de_conexoes_aceitas(self, callback):
         self.callback = callback
 
+    def fechar(self):
+        """
+        Tira as métricas do servidor do registro (as conexões abertas não são
+        afetadas).
+        """
+        registro.remover_coletor(self._metricas)
+
+    def _metricas(self):
+        conexoes = self.conexoes.values()
+        return {
+            'tcp.conexoes': len(self.conexoes),
+            'tcp.cwnd_total': sum(con.cwnd for con in conexoes),
+            'tcp.retransmissoes_rapidas': sum(con.retransmissoes_rapidas for con in conexoes),
+            'tcp.timeouts': sum(con.timeouts for con in conexoes),
+            'tcp.temporizadores_armados': self.temporizadores.armados,
+        }
+
     def _rdt_rcv(self, src_addr, dst_addr, segment):
-        debug_print(f"Segmento recebido de {src_addr}")
+        if DEBUG: debug_print(f"Segmento recebido de {src_addr}")
         src_port, dst_port, seq_no, ack_no, flags, window_size, checksum, urg_ptr = read_header(segment)
         
         if dst_port != self.porta:
-            debug_print(f"Porta errada: {dst_port} != {self.porta}")
+            if DEBUG: debug_print(f"Porta errada: {dst_port} != {self.porta}")
             return
             
+        _segmentos_rx.incrementar()
         if not self.rede.ignore_checksum and calc_checksum(segment, src_addr, dst_addr) != 0:
-            debug_print("Checksum inválido!")
+            _checksum_invalido.incrementar()
+            if DEBUG: debug_print("Checksum inválido!")
             return
             
         data_offset_words = (segment[12] >> 4) & 0xF
@@ -45,141 +379,279 @@ class Servidor:
         conn_id = (src_addr, src_port, dst_addr, dst_port)
 
         if flags & FLAGS_SYN:
-            debug_print(f"SYN recebido! Criando conexão...")
+            if DEBUG: debug_print(f"SYN recebido! Criando conexão...")
             esperado_cli = seq_no + 1
             meu_isn = random.randint(0, 0xFFFFFFFF)
-            con = self.conexoes[conn_id] = Conexao(self, conn_id, meu_isn, esperado_cli)
-            syn_ack = make_segment(dst_addr, src_addr, dst_port, src_port, meu_isn, esperado_cli, FLAGS_SYN | FLAGS_ACK)
+            # MSS limitado pela MTU do enlace de saída, para não fragmentar
+            mtu = self.rede.mtu_rota(src_addr)
+            mss_rota = min(MSS, mtu - 40) if mtu else MSS
+            mss = min(mss_rota, ler_opcao_mss(segment) or MSS_PADRAO)
+            con = self.conexoes[conn_id] = Conexao(self, conn_id, meu_isn, esperado_cli, window_size, mss,
+                                                   mss_rota)
+            syn_ack = make_segment(dst_addr, src_addr, dst_port, src_port, meu_isn, esperado_cli,
+                                   FLAGS_SYN | FLAGS_ACK, opcoes=opcao_mss(mss_rota))
+            _segmentos_tx.incrementar()
             self.rede.enviar(syn_ack, src_addr)
-            debug_print(f"SYN-ACK enviado!")
+            if DEBUG: debug_print(f"SYN-ACK enviado!")
             if self.callback:
                 self.callback(con)
             return
 
         if conn_id in self.conexoes:
-            self.conexoes[conn_id]._rdt_rcv(seq_no, ack_no, flags, payload)
+            self.conexoes[conn_id]._rdt_rcv(seq_no, ack_no, flags, payload, window_size)
 
 class Conexao:
-    def __init__(self, servidor, id_conexao, nosso_isn, prox_esperado_cli):
+    def __init__(self, servidor, id_conexao, nosso_isn, prox_esperado_cli, janela_cliente=JANELA_RECEPCAO,
+                 mss=MSS, mss_rx=None):
         self.servidor = servidor
+        self.mss = mss              # maior payload enviado em um segmento
+        self.mss_rx = mss_rx or mss # MSS anunciado ao cliente: maior segmento que ele nos envia
         self.id_conexao = id_conexao
         self.callback = None
+        self.monitor_envio = None
         self.estado = 'SYN_RCVD'
         self.seq_no_esperado = prox_esperado_cli
         self.seq_no_a_enviar = (nosso_isn + 1) & 0xFFFFFFFF
         self.prox_seq_no_nao_ack = self.seq_no_a_enviar
-        self.buffer_de_envio = []
-        self.dados_pendentes = b''
+        self.buffer_envio = BufferDeEnvio(servidor.limite_buffer_envio)
+        # Fora de ordem, guarda no máximo o que cabe na janela de recepção
+        self.fora_de_ordem = FilaForaDeOrdem(JANELA_RECEPCAO)
+        self.seq_fin = None         # seq do FIN recebido, se ele chegou fora de ordem
+        self.bytes_nao_confirmados = 0   # recebidos em ordem e ainda sem ACK
+        self._timer_ack = Temporizador(self._ack_atrasado_expirou)
+        # Controle de fluxo
+        self.janela_cliente = janela_cliente   # última janela anunciada pelo cliente
+        self._timer_sonda = Temporizador(self._sondar_janela)
+        self.consumo_manual = False   # a aplicação informa o consumo com consumir()
+        self.nao_consumidos = 0       # entregues à aplicação e ainda não consumidos
+        self.janela_anunciada = JANELA_RECEPCAO
+        # Agrupamento de escritas
+        self.nagle = False          # segura segmentos pequenos enquanto houver dados sem ACK
+        self.adiar_envio = False    # junta as escritas feitas na mesma volta do loop
+        self.segurado = 0           # profundidade de segurar_envio()/liberar_envio()
+        self._envio_agendado = False
+        self.fin_pendente = False   # fechar() foi chamado, mas ainda há dados a enviar
+        self.fin_enviado = False
+        self.rtt_seq = None         # seq que, quando confirmado, fornece uma amostra de RTT
+        self.rtt_t = None
         self.estimated_rtt = None
         self.dev_rtt = None
         self.timeout_interval = 1.0
-        self._timer_task = None
-        self.cwnd = MSS
+        self._timer_rto = Temporizador(self._timeout)
+        self.cwnd = self.mss
+        self.ssthresh = 0xFFFFFFFF
         self.bytes_ack_acum = 0
-        self.timer_ativo = False
+        self.acks_duplicados = 0
+        self.em_recuperacao = False
+        self.seq_recuperacao = None  # seq_no_a_enviar quando a recuperação rápida começou
+        # Contadores de recuperação de perdas
+        self.retransmissoes_rapidas = 0
+        self.timeouts = 0
+
+    def _bytes_em_voo(self):
+        # Inclui o FIN, que ocupa um número de sequência
+        return (self.seq_no_a_enviar - self.prox_seq_no_nao_ack) & 0xFFFFFFFF
+
+    @property
+    def timer_ativo(self):
+        return self._timer_rto.ativo
 
     def _start_timer(self):
-        if not self.timer_ativo and self.buffer_de_envio:
-            self.timer_ativo = True
-            try:
-                loop = asyncio.get_running_loop()
-                self._timer_task = loop.create_task(self._timer_coroutine())
-            except RuntimeError:
-                self.timer_ativo = False
+        if not self._timer_rto.ativo and self._bytes_em_voo():
+            self.servidor.temporizadores.armar(self._timer_rto, self.timeout_interval)
 
     def _stop_timer(self):
-        if self._timer_task and not self._timer_task.done():
-            self._timer_task.cancel()
-        self._timer_task = None
-        self.timer_ativo = False
-
-    async def _timer_coroutine(self):
-        try:
-            await asyncio.sleep(self.timeout_interval)
-            self._timeout()
-        except asyncio.CancelledError:
-            raise
+        self.servidor.temporizadores.cancelar(self._timer_rto)
 
     def _timeout(self):
-        self.timer_ativo = False
-        if self.buffer_de_envio:
-            self.cwnd = max(MSS, self.cwnd // 2)
+        if self._bytes_em_voo() and self.janela_cliente == 0:
+            # Sonda de janela zero sem resposta: não é sinal de congestionamento
+            self._retransmitir_primeiro()
+            self._start_timer()
+        elif self._bytes_em_voo():
+            self.timeouts += 1
+            self.ssthresh = max(self._bytes_em_voo() // 2, 2 * self.mss)
+            self.cwnd = max(self.mss, self.cwnd // 2)
             self.bytes_ack_acum = 0
-            
-            seg0 = self.buffer_de_envio[0]
-            cli_ip, cli_port, srv_ip, srv_port = self.id_conexao
-            payload = seg0["seg"][20:]
-            retx = make_segment(srv_ip, cli_ip, srv_port, cli_port, 
-                               seg0["seq"], self.seq_no_esperado, FLAGS_ACK, payload)
-            
-            seg0["seg"] = retx
-            seg0["t"] = time.time()
-            seg0["rtt"] = False
-            
-            self.servidor.rede.enviar(retx, cli_ip)
+            self.em_recuperacao = False
+            self.acks_duplicados = 0
+            self._retransmitir_primeiro()
             self._start_timer()
 
-    def _rdt_rcv(self, seq_no, ack_no, flags, payload):
-        debug_print(f"Conexao._rdt_rcv: estado={self.estado}, flags={flags}, payload_len={len(payload)}")
+    def _retransmitir_primeiro(self):
+        """
+        Retransmite o primeiro segmento não confirmado (ou o FIN, se só ele
+        estiver pendente).
+        """
+        self.rtt_seq = None   # algoritmo de Karn: não medir RTT de retransmissões
+        _retransmissoes.incrementar()
+
+        payload = self.buffer_envio.primeiro_em_voo()
+        if payload is not None:
+            self._enviar_segmento(self.prox_seq_no_nao_ack, FLAGS_ACK, payload)
+        else:
+            # Só o FIN está pendente de confirmação
+            self._enviar_segmento((self.seq_no_a_enviar - 1) & 0xFFFFFFFF, FLAGS_FIN | FLAGS_ACK)
+
+    def _enviar_segmento(self, seq_no, flags, payload=b'', soma_payload=None):
+        """
+        Envia um segmento levando o ACK de tudo o que já recebemos, o que
+        torna desnecessário qualquer ACK atrasado pendente.
+        """
+        cli_ip, cli_port, srv_ip, srv_port = self.id_conexao
+        self.janela_anunciada = self._janela_livre()
+        seg = make_segment(srv_ip, cli_ip, srv_port, cli_port,
+                           seq_no, self.seq_no_esperado, flags, payload, self.janela_anunciada,
+                           soma_payload)
+        self._cancelar_ack_atrasado()
+        _segmentos_tx.incrementar()
+        self.servidor.rede.enviar(seg, cli_ip)
+
+    def _enviar_ack(self):
+        self._enviar_segmento(self.seq_no_a_enviar, FLAGS_ACK)
+        if DEBUG: debug_print("ACK enviado")
+
+    def _agendar_ack_atrasado(self):
+        if self._timer_ack.ativo:
+            return
+        if not self.servidor.temporizadores.armar(self._timer_ack, ATRASO_ACK):
+            self._enviar_ack()
+
+    def _ack_atrasado_expirou(self):
+        if self.bytes_nao_confirmados:
+            self._enviar_ack()
+
+    def _cancelar_ack_atrasado(self):
+        self.bytes_nao_confirmados = 0
+        self.servidor.temporizadores.cancelar(self._timer_ack)
+
+    def _rdt_rcv(self, seq_no, ack_no, flags, payload, janela=JANELA_RECEPCAO):
+        if DEBUG: debug_print(f"Conexao._rdt_rcv: estado={self.estado}, flags={flags}, payload_len={len(payload)}")
         
         if self.estado == 'SYN_RCVD' and (flags & FLAGS_ACK) and ack_no == self.seq_no_a_enviar:
             self.estado = 'ESTABLISHED'
-            debug_print("Conexão ESTABLISHED!")
-
-        if flags & FLAGS_ACK and ack_no > self.prox_seq_no_nao_ack:
-            now = time.time()
-            for item in self.buffer_de_envio:
-                if item["rtt"] and item["seq"] + item["len"] <= ack_no:
-                    sample_rtt = now - item["t"]
-                    self._atualiza_rtt(sample_rtt)
-                    break
+            if DEBUG: debug_print("Conexão ESTABLISHED!")
+
+        janela_anterior = self.janela_cliente
+        if flags & FLAGS_ACK:
+            # Simplificação: toda janela recebida é aceita, sem comparar seq/ack
+            # com os da última atualização (SND.WL1/SND.WL2)
+            self.janela_cliente = janela
+
+        bytes_acked = (ack_no - self.prox_seq_no_nao_ack) & 0xFFFFFFFF
+        if flags & FLAGS_ACK and 0 < bytes_acked <= self._bytes_em_voo():
+            if self.rtt_seq is not None and (ack_no - self.rtt_seq) & 0xFFFFFFFF < 0x80000000:
+                self._atualiza_rtt(time.time() - self.rtt_t)
+                self.rtt_seq = None
             
             self._stop_timer()
             
-            bytes_acked = 0
-            while self.buffer_de_envio and self.buffer_de_envio[0]["seq"] + self.buffer_de_envio[0]["len"] <= ack_no:
-                bytes_acked += self.buffer_de_envio.pop(0)["len"]
-            
+            self.buffer_envio.liberar(bytes_acked)
             self.prox_seq_no_nao_ack = ack_no
+            self.acks_duplicados = 0
             
-            if bytes_acked:
+            if self.em_recuperacao:
+                if (ack_no - self.seq_recuperacao) & 0xFFFFFFFF < 0x80000000:
+                    # ACK completo: tudo o que estava em voo na perda foi confirmado
+                    self.em_recuperacao = False
+                    self.cwnd = self.ssthresh
+                    self.bytes_ack_acum = 0
+                else:
+                    # ACK parcial (NewReno): o próximo segmento também se perdeu
+                    self._retransmitir_primeiro()
+                    self.cwnd = max(self.mss, self.cwnd - bytes_acked + self.mss)
+            else:
                 self.bytes_ack_acum += bytes_acked
                 while self.bytes_ack_acum >= self.cwnd:
-                    self.cwnd += MSS
-                    self.bytes_ack_acum -= (self.cwnd - MSS)
+                    self.cwnd += self.mss
+                    self.bytes_ack_acum -= (self.cwnd - self.mss)
             
             self._try_send_from_pending()
             
-            if self.buffer_de_envio:
+            if self._bytes_em_voo():
                 self._start_timer()
 
+            if self.monitor_envio:
+                self.monitor_envio(self)
+
+        elif flags & FLAGS_ACK and bytes_acked == 0 and not payload and janela == janela_anterior \
+                and not flags & (FLAGS_SYN | FLAGS_FIN) and self._bytes_em_voo():
+            self.acks_duplicados += 1
+            if self.em_recuperacao:
+                # Cada ACK duplicado indica que um segmento saiu da rede
+                self.cwnd += self.mss
+                self._try_send_from_pending()
+            elif self.acks_duplicados == 3:
+                # Retransmissão rápida e início da recuperação rápida
+                self.retransmissoes_rapidas += 1
+                self.ssthresh = max(self._bytes_em_voo() // 2, 2 * self.mss)
+                self.seq_recuperacao = self.seq_no_a_enviar
+                self.em_recuperacao = True
+                self._retransmitir_primeiro()
+                self.cwnd = self.ssthresh + 3 * self.mss
+                self._try_send_from_pending()
+
+        elif flags & FLAGS_ACK and janela > janela_anterior:
+            # Atualização de janela: o cliente consumiu dados
+            self._try_send_from_pending()
+
         if self.estado in ('ESTABLISHED', 'SYN_RCVD'):
-            enviar_ack = False
-            if seq_no == self.seq_no_esperado:
-                if payload:
-                    debug_print(f"Recebido {len(payload)} bytes: {payload[:50]}")
-                    if self.callback:
-                        self.callback(self, payload)
-                    self.seq_no_esperado += len(payload)
-                    enviar_ack = True
+            # Dados novos e em ordem podem ter o ACK atrasado; nos demais casos
+            # (fora de ordem, repetidos, lacuna preenchida ou FIN) o ACK é imediato
+            ack_imediato = False
+            if payload or flags & FLAGS_FIN:
                 if flags & FLAGS_FIN:
-                    debug_print("FIN recebido")
-                    self.seq_no_esperado += 1
-                    if self.callback:
-                        self.callback(self, b'')
-                    self.estado = 'CLOSE_WAIT'
-                    enviar_ack = True
-            else:
-                enviar_ack = True
+                    self.seq_fin = (seq_no + len(payload)) & 0xFFFFFFFF
+                # Descarta o início do segmento, se já foi recebido antes
+                atraso = (self.seq_no_esperado - seq_no) & 0xFFFFFFFF
+                if 0 < atraso < 0x80000000:
+                    ack_imediato = True
+                    payload = payload[atraso:]
+                    seq_no = self.seq_no_esperado
+                if seq_no == self.seq_no_esperado:
+                    if payload:
+                        self._entregar(payload)
+                    if self.fora_de_ordem.intervalos:
+                        ack_imediato = True
+                        # Segmentos guardados que ficaram contíguos com a chegada deste
+                        dados = self.fora_de_ordem.retirar(self.seq_no_esperado)
+                        while dados:
+                            self._entregar(dados)
+                            dados = self.fora_de_ordem.retirar(self.seq_no_esperado)
+                    if self.seq_fin == self.seq_no_esperado:
+                        if DEBUG: debug_print("FIN recebido")
+                        ack_imediato = True
+                        self.seq_no_esperado = (self.seq_no_esperado + 1) & 0xFFFFFFFF
+                        # Muda o estado antes do callback, que pode chamar fechar()
+                        self.estado = 'CLOSE_WAIT'
+                        if self.callback:
+                            self.callback(self, b'')
+                else:
+                    # Fora de ordem: guarda e envia ACK duplicado imediatamente
+                    ack_imediato = True
+                    self.fora_de_ordem.inserir(seq_no, payload, self.seq_no_esperado)
+            elif seq_no != self.seq_no_esperado:
+                ack_imediato = True
             
-            if enviar_ack:
-                cli_ip, cli_port, srv_ip, srv_port = self.id_conexao
-                ack_seg = make_segment(srv_ip, cli_ip, srv_port, cli_port, 
-                                      self.seq_no_a_enviar, self.seq_no_esperado, FLAGS_ACK)
-                self.servidor.rede.enviar(ack_seg, cli_ip)
-                debug_print("ACK enviado")
+            if ack_imediato or self.bytes_nao_confirmados >= 2 * self.mss_rx:
+                # ACK imediato, ou a cada dois segmentos completos
+                self._enviar_ack()
+            elif self.bytes_nao_confirmados:
+                self._agendar_ack_atrasado()
+
+    def _entregar(self, dados):
+        if DEBUG: debug_print(f"Recebido {len(dados)} bytes: {bytes(dados[:50])}")
+        # Avança antes do callback para que uma resposta enviada nele já
+        # leve o ACK destes dados
+        self.seq_no_esperado = (self.seq_no_esperado + len(dados)) & 0xFFFFFFFF
+        self.bytes_nao_confirmados += len(dados)
+        if self.consumo_manual:
+            self.nao_consumidos += len(dados)
+        if self.callback:
+            self.callback(self, dados)
 
     def _atualiza_rtt(self, sample_rtt: float):
+        _rtt.observar(sample_rtt)
         alpha, beta = 0.125, 0.25
         if self.estimated_rtt is None:
             self.estimated_rtt = sample_rtt
@@ -191,72 +663,183 @@ class Conexao:
         rto = self.estimated_rtt + 4 * self.dev_rtt
         self.timeout_interval = max(0.2, min(0.3, rto))
 
-    def registrar_recebedor(self, callback):
+    def registrar_recebedor(self, callback, consumo_manual=False):
+        """
+        Registra a função chamada com os dados recebidos. Com consumo_manual,
+        os dados entregues continuam ocupando a janela de recepção até que a
+        aplicação chame consumir(); caso contrário, são considerados
+        consumidos assim que entregues.
+        """
         self.callback = callback
+        self.consumo_manual = consumo_manual
+
+    def registrar_monitor_de_envio(self, callback):
+        """
+        Registra uma função chamada, com a conexão, sempre que um ACK liberar
+        espaço no buffer de envio.
+        """
+        self.monitor_envio = callback
+
+    def consumir(self, n):
+        """
+        Informa que a aplicação consumiu n bytes entregues ao callback,
+        liberando espaço na janela de recepção. Se a janela reabrir de forma
+        significativa, o cliente é avisado imediatamente.
+        """
+        self.nao_consumidos = max(0, self.nao_consumidos - n)
+        if self._janela_livre() - self.janela_anunciada >= min(self.mss_rx, JANELA_RECEPCAO // 2):
+            self._enviar_ack()
 
-    def enviar(self, dados: bytes):
+    def _janela_livre(self):
+        return max(0, JANELA_RECEPCAO - self.nao_consumidos)
+
+    def enviar(self, dados: bytes, soma_dados=None):
+        """
+        Envia dados pela conexão. Os dados são guardados no buffer de envio e
+        segmentados conforme a janela de congestionamento permitir. Lança
+        BufferError se o limite do buffer de envio for excedido e
+        BrokenPipeError se a conexão já tiver sido fechada com fechar()
+        (os dados sairiam depois do FIN).
+
+        soma_dados é a soma do checksum dos dados (checksum.soma), se já
+        tiver sido calculada; ver enviar_multicast.
+
+        Com adiar_envio, a transmissão fica para o fim da volta atual do
+        loop, juntando em segmentos de até self.mss as escritas feitas no mesmo
+        callback. Entre segurar_envio() e liberar_envio() nada é transmitido.
+        """
+        if self.fin_pendente or self.fin_enviado:
+            raise BrokenPipeError('conexão fechada')
         if dados:
-            self.dados_pendentes += dados
-            debug_print(f"Dados adicionados ao buffer: {len(dados)} bytes, total pendente: {len(self.dados_pendentes)}")
+            self.buffer_envio.adicionar(dados, soma_dados)
+            if DEBUG: debug_print(f"Dados adicionados ao buffer: {len(dados)} bytes, total pendente: {self.buffer_envio.bytes_nao_enviados}")
         
-        if not self.dados_pendentes:
-            debug_print("Nada para enviar")
+        if self.segurado:
+            return
+        if self.adiar_envio and self._agendar_envio():
+            return
+        self._transmitir()
+
+    def segurar_envio(self):
+        """
+        Passa a acumular os dados enviados, sem transmiti-los, até a chamada
+        correspondente a liberar_envio(). Pode ser aninhado.
+        """
+        self.segurado += 1
+
+    def liberar_envio(self):
+        """
+        Desfaz um segurar_envio() e, se for o último, transmite o que foi
+        acumulado.
+        """
+        if self.segurado:
+            self.segurado -= 1
+            if not self.segurado:
+                self._transmitir()
+
+    def _agendar_envio(self):
+        if not self._envio_agendado:
+            try:
+                asyncio.get_running_loop().call_soon(self._envio_adiado)
+            except RuntimeError:
+                return False
+            self._envio_agendado = True
+        return True
+
+    def _envio_adiado(self):
+        self._envio_agendado = False
+        if not self.segurado:
+            self._transmitir()
+
+    def _transmitir(self):
+        """
+        Transmite os dados do buffer de envio que couberem na janela.
+        """
+        if not self.buffer_envio.bytes_nao_enviados:
+            if DEBUG: debug_print("Nada para enviar")
+            self._enviar_fin_se_pendente()
             return
         
-        cli_ip, cli_port, srv_ip, srv_port = self.id_conexao
-        bytes_em_voo = (self.seq_no_a_enviar - self.prox_seq_no_nao_ack) & 0xFFFFFFFF
-        espaco_disponivel = max(0, self.cwnd - bytes_em_voo)
+        bytes_em_voo = self._bytes_em_voo()
+        espaco_disponivel = max(0, min(self.cwnd, self.janela_cliente) - bytes_em_voo)
         
-        debug_print(f"cwnd={self.cwnd}, bytes_em_voo={bytes_em_voo}, espaco={espaco_disponivel}")
+        if DEBUG: debug_print(f"cwnd={self.cwnd}, janela_cliente={self.janela_cliente}, bytes_em_voo={bytes_em_voo}, espaco={espaco_disponivel}")
         
         if espaco_disponivel == 0:
-            debug_print("Janela cheia, aguardando ACK")
+            if self.janela_cliente == 0 and not bytes_em_voo:
+                # Nada em voo para trazer um ACK que reabra a janela
+                self._agendar_sonda()
+            if DEBUG: debug_print("Janela cheia, aguardando ACK")
             return
         
         enviados = 0
         
         # Enviar segmentos enquanto houver dados e espaço
-        while self.dados_pendentes and espaco_disponivel > 0:
-            # Tamanho do próximo segmento: MSS ou o que sobrou (o menor)
-            tamanho_seg = min(MSS, len(self.dados_pendentes), espaco_disponivel)
-            payload = self.dados_pendentes[:tamanho_seg]
-            
-            seg = make_segment(srv_ip, cli_ip, srv_port, cli_port, 
-                            self.seq_no_a_enviar, self.seq_no_esperado, FLAGS_ACK, payload)
-            
-            eh_primeiro = len(self.buffer_de_envio) == 0
-            
-            self.buffer_de_envio.append({
-                "seq": self.seq_no_a_enviar,
-                "seg": seg,
-                "len": tamanho_seg,
-                "t": time.time(),
-                "rtt": eh_primeiro
-            })
-            
-            self.servidor.rede.enviar(seg, cli_ip)
-            debug_print(f"✅ Segmento ENVIADO: seq={self.seq_no_a_enviar}, len={tamanho_seg}")
-            
-            self.seq_no_a_enviar = (self.seq_no_a_enviar + tamanho_seg) & 0xFFFFFFFF
-            self.dados_pendentes = self.dados_pendentes[tamanho_seg:]
+        while self.buffer_envio.bytes_nao_enviados and espaco_disponivel > 0:
+            # Tamanho do próximo segmento: MSS da conexão ou o que sobrou (o menor)
+            tamanho_seg = min(self.mss, self.buffer_envio.bytes_nao_enviados, espaco_disponivel)
+            if self.nagle and tamanho_seg < self.mss and self._bytes_em_voo() and not self.fin_pendente:
+                # Nagle: o segmento pequeno espera o ACK dos dados em voo
+                break
+            self._enviar_dados(tamanho_seg)
             espaco_disponivel -= tamanho_seg
             enviados += 1
-            
-            if eh_primeiro:
-                self._start_timer()
         
-        debug_print(f"Total de segmentos enviados: {enviados}, restam {len(self.dados_pendentes)} bytes pendentes")
+        self._start_timer()
+        self._enviar_fin_se_pendente()
+        if DEBUG: debug_print(f"Total de segmentos enviados: {enviados}, restam {self.buffer_envio.bytes_nao_enviados} bytes pendentes")
+
+    def _enviar_dados(self, tamanho_seg):
+        payload, soma_payload = self.buffer_envio.proximo_segmento(tamanho_seg)
+        
+        if self.rtt_seq is None:
+            # Mede o RTT de um segmento por vez
+            self.rtt_seq = (self.seq_no_a_enviar + tamanho_seg) & 0xFFFFFFFF
+            self.rtt_t = time.time()
+        
+        # O ACK pendente vai junto com os dados
+        self._enviar_segmento(self.seq_no_a_enviar, FLAGS_ACK, payload, soma_payload)
+        if DEBUG: debug_print(f"✅ Segmento ENVIADO: seq={self.seq_no_a_enviar}, len={tamanho_seg}")
+        
+        self.seq_no_a_enviar = (self.seq_no_a_enviar + tamanho_seg) & 0xFFFFFFFF
+
+    def _agendar_sonda(self):
+        if not self._timer_sonda.ativo:
+            self.servidor.temporizadores.armar(self._timer_sonda, self.timeout_interval)
+
+    def _sondar_janela(self):
+        """
+        Sonda de janela zero: envia 1 byte além da janela. A partir daí o
+        timer de retransmissão reenvia a sonda até o cliente reabrir a janela.
+        """
+        if self.janela_cliente == 0 and not self._bytes_em_voo() and self.buffer_envio.bytes_nao_enviados:
+            if DEBUG: debug_print("Sonda de janela zero")
+            self._enviar_dados(1)
+            self._start_timer()
+        else:
+            self._try_send_from_pending()
 
     def _try_send_from_pending(self):
-        if self.dados_pendentes:
-            self.enviar(b'')
+        if (self.buffer_envio.bytes_nao_enviados or self.fin_pendente) and not self.segurado:
+            self._transmitir()
+
+    def _enviar_fin_se_pendente(self):
+        if self.fin_pendente and not self.buffer_envio.bytes_nao_enviados:
+            self.fin_pendente = False
+            self.fin_enviado = True
+            self._enviar_segmento(self.seq_no_a_enviar, FLAGS_FIN | FLAGS_ACK)
+            self.seq_no_a_enviar = (self.seq_no_a_enviar + 1) & 0xFFFFFFFF
+            self._start_timer()
 
     def fechar(self):
+        """
+        Fecha a conexão. O FIN só é enviado depois dos dados que ainda
+        estiverem no buffer de envio, inclusive os segurados.
+        """
         if self.estado in ('CLOSE_WAIT', 'ESTABLISHED'):
-            debug_print("Fechando conexão")
-            cli_ip, cli_port, srv_ip, srv_port = self.id_conexao
-            fin = make_segment(srv_ip, cli_ip, srv_port, cli_port, 
-                             self.seq_no_a_enviar, self.seq_no_esperado, FLAGS_FIN | FLAGS_ACK)
-            self.seq_no_a_enviar = (self.seq_no_a_enviar + 1) & 0xFFFFFFFF
+            if DEBUG: debug_print("Fechando conexão")
             self.estado = 'LAST_ACK'
-            self.servidor.rede.enviar(fin, cli_ip)
\ No newline at end of file
+            self.fin_pendente = True
+            # Dados segurados ou adiados saem antes do FIN
+            self.segurado = 0
+            self._transmitir()
@@ -0,0 +1,321 @@
+"""
+Servidor IRC da placa 3 dividido em processos: o processo da pilha (SLIP,
+IP, TCP) só separa as linhas recebidas, as encaminha aos trabalhadores e
+distribui as respostas; a lógica do IRC (placa3.processar_entrada e
+companhia) roda em processos trabalhadores, ligados à pilha por socketpairs.
+
+Os canais são divididos entre os trabalhadores por hash do nome: JOIN, PART
+e PRIVMSG para um canal vão sempre ao mesmo trabalhador, que tem a lista
+completa de membros. Os demais comandos vão ao trabalhador da conexão.
+NICK, novas conexões e conexões fechadas são enviados a todos, para que
+todos conheçam os apelidos; como cada trabalhador só conhece os canais que
+são seus, as respostas desses eventos vêm de vários trabalhadores e a pilha
+descarta as repetidas.
+
+Ordem das respostas: as respostas de um mesmo trabalhador chegam ao cliente
+na ordem dos comandos, mas não há ordem entre trabalhadores diferentes. Se
+um cliente envia "JOIN #a" e logo depois "PRIVMSG #b :oi", e os dois canais
+são de trabalhadores diferentes, a mensagem em #b pode ser entregue (e
+respondida) antes do JOIN em #a. Cada canal, em si, continua ordenado, que
+é o que os clientes IRC esperam.
+
+Se um trabalhador termina (ou fecha o socketpair), a pilha deixa de contar
+com ele nos eventos pendentes, fecha as conexões que eram dele e passa a
+descartar as linhas dos canais dele, cujo estado se perdeu.
+"""
+import asyncio
+import multiprocessing
+import socket
+import struct
+import zlib
+import placa3
+from tcp import enviar_multicast
+
+# Pilha -> trabalhador
+NOVA_CONEXAO = 1
+LINHA = 2
+FIM_CONEXAO = 3
+# Trabalhador -> pilha
+ENVIAR = 4
+CONCLUIDO = 5
+
+# tamanho do restante do quadro, tipo, evento, número de ids
+_CABECALHO = struct.Struct('!IBII')
+
+
+def quadro(tipo, evento, ids, dados=b''):
+    """
+    Monta um quadro: cabeçalho, ids de conexão (32 bits cada) e dados.
+    Evento 0 indica uma mensagem que não foi enviada a todos os
+    trabalhadores e, portanto, não precisa de eliminação de repetidas.
+    """
+    ids = struct.pack('!%dI' % len(ids), *ids)
+    return b''.join((_CABECALHO.pack(_CABECALHO.size - 4 + len(ids) + len(dados),
+                                     tipo, evento, len(ids) // 4), ids, dados))
+
+
+class DecodificadorDeQuadros:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def alimentar(self, dados):
+        """
+        Retorna a lista dos quadros completos recebidos, como tuplas
+        (tipo, evento, ids, dados).
+        """
+        buffer = self.buffer
+        buffer += dados
+        quadros = []
+        inicio = 0
+        while len(buffer) - inicio >= _CABECALHO.size:
+            tamanho, tipo, evento, n_ids = _CABECALHO.unpack_from(buffer, inicio)
+            fim = inicio + 4 + tamanho
+            if fim > len(buffer):
+                break
+            pos_dados = inicio + _CABECALHO.size + 4 * n_ids
+            ids = struct.unpack_from('!%dI' % n_ids, buffer, inicio + _CABECALHO.size)
+            quadros.append((tipo, evento, ids, bytes(buffer[pos_dados:fim])))
+            inicio = fim
+        del buffer[:inicio]
+        return quadros
+
+
+## ============================================================================
+## Processo da pilha
+## ============================================================================
+
+class _LigacaoTrabalhador(asyncio.Protocol):
+    def __init__(self, distribuidor):
+        self.distribuidor = distribuidor
+        self.decodificador = DecodificadorDeQuadros()
+        self.transporte = None
+        self.viva = True
+
+    def connection_made(self, transporte):
+        self.transporte = transporte
+
+    def data_received(self, dados):
+        for tipo, evento, ids, dados in self.decodificador.alimentar(dados):
+            self.distribuidor._quadro_recebido(self, tipo, evento, ids, dados)
+
+    def connection_lost(self, exc):
+        self.viva = False
+        self.distribuidor._trabalhador_perdido(self)
+
+    def enviar(self, dados):
+        if self.viva:
+            self.transporte.write(dados)
+
+
+class Distribuidor:
+    """
+    Lado da pilha: recebe as conexões do tcp.Servidor (use conexao_aceita
+    como monitor de conexões aceitas), separa as linhas e as encaminha.
+    """
+    def __init__(self):
+        self.ligacoes = []
+        self.conexoes = {}          # id -> Conexao
+        self.ids = {}               # Conexao -> (id, SeparadorDeLinhas)
+        self.proximo_id = 1
+        self.proximo_evento = 1
+        # evento enviado a todos -> [{ligações que ainda não concluíram},
+        # {(id, dados) já enviados}]
+        self.eventos = {}
+
+    async def iniciar(self, n_trabalhadores):
+        """
+        Cria os processos trabalhadores. Deve ser chamado antes de aceitar
+        conexões.
+        """
+        loop = asyncio.get_running_loop()
+        contexto = multiprocessing.get_context('fork')
+        for _ in range(n_trabalhadores):
+            nosso, deles = socket.socketpair()
+            processo = contexto.Process(target=executar_trabalhador, args=(deles,), daemon=True)
+            processo.start()
+            deles.close()
+            _, ligacao = await loop.create_connection(lambda: _LigacaoTrabalhador(self), sock=nosso)
+            self.ligacoes.append(ligacao)
+
+    def _para_todos(self, tipo, id_conexao, dados=b''):
+        vivas = {ligacao for ligacao in self.ligacoes if ligacao.viva}
+        if not vivas:
+            return
+        evento = self.proximo_evento
+        self.proximo_evento = (self.proximo_evento + 1) & 0xFFFFFFFF or 1
+        self.eventos[evento] = [vivas, set()]
+        mensagem = quadro(tipo, evento, (id_conexao,), dados)
+        for ligacao in vivas:
+            ligacao.enviar(mensagem)
+
+    def _ligacao(self, chave):
+        # A divisão não muda quando um trabalhador termina: as chaves dele
+        # continuam apontando para a ligação morta
+        return self.ligacoes[zlib.crc32(chave) % len(self.ligacoes)]
+
+    def _para_um(self, chave, id_conexao, linha):
+        self._ligacao(chave).enviar(quadro(LINHA, 0, (id_conexao,), linha))
+
+    def conexao_aceita(self, conexao):
+        id_conexao = self.proximo_id
+        self.proximo_id += 1
+        self.conexoes[id_conexao] = conexao
+        self.ids[conexao] = (id_conexao, placa3.SeparadorDeLinhas())
+        self._para_todos(NOVA_CONEXAO, id_conexao)
+        conexao.adiar_envio = True
+        conexao.registrar_recebedor(self._dados_recebidos)
+
+    def _encerrar(self, conexao):
+        id_conexao, _ = self.ids.pop(conexao)
+        del self.conexoes[id_conexao]
+        self._para_todos(FIM_CONEXAO, id_conexao)
+        conexao.fechar()
+
+    def _dados_recebidos(self, conexao, dados):
+        if conexao not in self.ids:
+            return      # encerrada pela pilha; o cliente ainda não viu o FIN
+        id_conexao, separador = self.ids[conexao]
+        if dados == b'':
+            self._encerrar(conexao)
+            return
+
+        for linha in separador.alimentar(dados):
+            partes = linha.strip().split(b' ', 2)
+            comando = partes[0].upper()
+            alvo = partes[1].lower() if len(partes) > 1 else b''
+            if comando == b'NICK':
+                self._para_todos(LINHA, id_conexao, linha)
+            elif comando in (b'JOIN', b'PART', b'PRIVMSG') and alvo.startswith(b'#'):
+                self._para_um(alvo, id_conexao, linha)
+            else:
+                self._para_um(b'%d' % id_conexao, id_conexao, linha)
+
+    def _trabalhador_perdido(self, ligacao):
+        for evento, pendente in list(self.eventos.items()):
+            pendente[0].discard(ligacao)
+            if not pendente[0]:
+                del self.eventos[evento]
+        for id_conexao, conexao in list(self.conexoes.items()):
+            if self._ligacao(b'%d' % id_conexao) is ligacao:
+                self._encerrar(conexao)
+
+    def _quadro_recebido(self, ligacao, tipo, evento, ids, dados):
+        # Um evento desconhecido já foi encerrado (por exemplo, por
+        # _trabalhador_perdido): sem o registro do que já foi enviado, o
+        # quadro é ignorado
+        pendente = self.eventos.get(evento) if evento else None
+        if evento and pendente is None:
+            return
+        if tipo == CONCLUIDO:
+            pendente[0].discard(ligacao)
+            if not pendente[0]:
+                del self.eventos[evento]
+            return
+
+        if evento:
+            # Resposta de um evento enviado a todos: descarta o que outro
+            # trabalhador já enviou
+            ja_enviados = pendente[1]
+            novos = [id_conexao for id_conexao in ids if (id_conexao, dados) not in ja_enviados]
+            ja_enviados.update((id_conexao, dados) for id_conexao in novos)
+            ids = novos
+        conexoes = self.conexoes
+        falhas = enviar_multicast([conexoes[id_conexao] for id_conexao in ids if id_conexao in conexoes],
+                                  dados)
+        # Buffer de envio cheio: desconecta, como placa3.difundir
+        for conexao in falhas:
+            if conexao in self.ids:
+                self._encerrar(conexao)
+
+
+## ============================================================================
+## Processos trabalhadores
+## ============================================================================
+
+class ConexaoRemota:
+    """
+    Representa, no trabalhador, uma conexão que está no processo da pilha.
+    Tem a interface de Conexao usada por placa3.
+    """
+    def __init__(self, trabalhador, id_conexao):
+        self.trabalhador = trabalhador
+        self.id_conexao = id_conexao
+        self.adiar_envio = False
+
+    def __repr__(self):
+        return '<ConexaoRemota %d>' % self.id_conexao
+
+    def registrar_recebedor(self, callback):
+        pass
+
+    def enviar(self, dados, soma_dados=None):
+        self.trabalhador.enviar_multicast((self,), dados)
+
+    def fechar(self):
+        # Quem fecha a conexão TCP é a pilha
+        pass
+
+
+class Trabalhador(asyncio.Protocol):
+    """
+    Lado do trabalhador: executa a lógica do IRC de placa3 sobre os quadros
+    recebidos da pilha. As respostas de cada lote de quadros saem em uma
+    única escrita não bloqueante; se a pilha não estiver lendo, o
+    trabalhador para de ler até o buffer de escrita esvaziar, em vez de
+    bloquear enquanto a pilha também escreve para ele.
+    """
+    def __init__(self):
+        self.transporte = None
+        self.decodificador = DecodificadorDeQuadros()
+        self.conexoes = {}
+        self.saida = []
+        self.evento = 0
+        self.encerrado = asyncio.get_running_loop().create_future()
+        # As difusões de placa3 viram um único quadro para a pilha
+        placa3.definir_envio(self.enviar_multicast)
+
+    def enviar_multicast(self, conexoes, dados):
+        ids = [conexao.id_conexao for conexao in conexoes]
+        if ids:
+            self.saida.append(quadro(ENVIAR, self.evento, ids, bytes(dados)))
+        # Os envios só acontecem (e falham) no processo da pilha
+        return []
+
+    def connection_made(self, transporte):
+        self.transporte = transporte
+
+    def data_received(self, dados):
+        for tipo, evento, ids, dados in self.decodificador.alimentar(dados):
+            self.evento = evento
+            if tipo == NOVA_CONEXAO:
+                conexao = self.conexoes[ids[0]] = ConexaoRemota(self, ids[0])
+                placa3.conexao_aceita(conexao)
+            elif tipo == LINHA:
+                placa3.processar_entrada(self.conexoes[ids[0]], dados)
+            elif tipo == FIM_CONEXAO:
+                placa3.remover_conexao(self.conexoes.pop(ids[0]))
+            if evento:
+                self.saida.append(quadro(CONCLUIDO, evento, ()))
+        # Uma única escrita para todas as respostas deste lote
+        if self.saida:
+            self.transporte.write(b''.join(self.saida))
+            self.saida.clear()
+
+    def pause_writing(self):
+        self.transporte.pause_reading()
+
+    def resume_writing(self):
+        self.transporte.resume_reading()
+
+    def connection_lost(self, exc):
+        if not self.encerrado.done():
+            self.encerrado.set_result(None)
+
+
+async def _executar_trabalhador(sock):
+    _, trabalhador = await asyncio.get_running_loop().create_connection(Trabalhador, sock=sock)
+    await trabalhador.encerrado
+
+
+def executar_trabalhador(sock):
+    asyncio.run(_executar_trabalhador(sock))